@@ -1,4 +1,11 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def ensure_search_index(sender, using, **kwargs):
+    from django.db import connections
+    from .search import install_search_index
+    install_search_index(connections[using])
 
 
 class ClientConfig(AppConfig):
@@ -7,3 +14,4 @@ class ClientConfig(AppConfig):
 
     def ready(self):
         import client.signals
+        post_migrate.connect(ensure_search_index, sender=self)
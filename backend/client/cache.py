@@ -0,0 +1,168 @@
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+# Cached payloads live under the namespace's current generation. Bumping the
+# generation orphans every entry of that namespace at once; the orphans age out
+# through RESPONSE_CACHE_TIMEOUT.
+KEY_PREFIX = 'response'
+
+SERVICE_REQUESTS = 'service_requests'
+BUSINESS_PROFILES = 'business_profiles'
+NAMESPACES = [SERVICE_REQUESTS, BUSINESS_PROFILES]
+
+
+def chat_rooms_namespace(user_id):
+    return f'chat_rooms:{user_id}'
+
+
+def get_cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def generation_key(namespace):
+    return f'{KEY_PREFIX}:{namespace}:generation'
+
+
+def stats_key(namespace, outcome):
+    return f'{KEY_PREFIX}:{namespace}:{outcome}'
+
+
+def modified_key(namespace):
+    return f'{KEY_PREFIX}:{namespace}:modified'
+
+
+def get_generation(namespace):
+    return get_cache().get(generation_key(namespace), 0)
+
+
+def get_version(namespace):
+    """
+    (generation, last-modified epoch seconds) of a namespace. A namespace that
+    has never been written to since the cache was emptied starts at "now", so
+    validators handed out before a cache flush never match again.
+    """
+    cache = get_cache()
+    values = cache.get_many([generation_key(namespace), modified_key(namespace)])
+    modified = values.get(modified_key(namespace))
+    if modified is None:
+        cache.add(modified_key(namespace), int(time.time()), timeout=None)
+        modified = cache.get(modified_key(namespace))
+    return values.get(generation_key(namespace), 0), modified
+
+
+def _increment(key):
+    cache = get_cache()
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr().
+        cache.set(key, 1, timeout=None)
+
+
+def invalidate(*namespaces):
+    """
+    Drop every cached response of the given namespaces. The bump is repeated
+    after commit so a reader that re-filled the cache from pre-commit data in
+    between cannot keep serving it.
+    """
+    def bump():
+        now = int(time.time())
+        for namespace in namespaces:
+            _increment(generation_key(namespace))
+            get_cache().set(modified_key(namespace), now, timeout=None)
+    bump()
+    transaction.on_commit(bump)
+
+
+def response_key(namespace, request, kwargs):
+    params = sorted((key, sorted(values)) for key, values in request.query_params.lists())
+    digest = hashlib.sha1(repr((request.path, sorted(kwargs.items()), params)).encode()).hexdigest()
+    return f'{KEY_PREFIX}:{namespace}:{get_generation(namespace)}:{digest}'
+
+
+def cache_response(namespace):
+    """
+    Cache a view method's successful payload per path and query-parameter set
+    until the namespace is invalidated (see signals.py).
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            cache = get_cache()
+            key = response_key(namespace, request, kwargs)
+            data = cache.get(key)
+            if data is not None:
+                _increment(stats_key(namespace, 'hits'))
+                return Response(data)
+            _increment(stats_key(namespace, 'misses'))
+            response = method(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data, settings.RESPONSE_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
+
+
+def cache_stats(namespaces=NAMESPACES):
+    cache = get_cache()
+    stats = {}
+    for namespace in namespaces:
+        hits = cache.get(stats_key(namespace, 'hits'), 0)
+        misses = cache.get(stats_key(namespace, 'misses'), 0)
+        stats[namespace] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+            'generation': get_generation(namespace),
+        }
+    return stats
+
+
+def etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    return etag in (tag.strip() for tag in header.split(','))
+
+
+def conditional_response(namespace):
+    """
+    Answer If-None-Match / If-Modified-Since with 304 from the namespace's
+    version counter alone, before the view runs any query. `namespace` may be
+    a callable taking the request, for per-user namespaces.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            name = namespace(request) if callable(namespace) else namespace
+            generation, modified = get_version(name)
+            params = sorted((key, sorted(values)) for key, values in request.query_params.lists())
+            validator = repr((name, generation, modified, request.path, sorted(kwargs.items()),
+                              params, request.META.get('HTTP_ACCEPT', '')))
+            etag = '"%s"' % hashlib.sha1(validator.encode()).hexdigest()
+            headers = {'ETag': etag, 'Last-Modified': http_date(modified)}
+
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+            if if_none_match is not None:
+                not_modified = etag_matches(if_none_match, etag)
+            else:
+                not_modified = if_modified_since is not None and modified <= if_modified_since
+            if not_modified:
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+            response = method(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                for header, value in headers.items():
+                    response[header] = value
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,346 @@
+"""
+Channel layer shared by every worker process on one host through a SQLite
+file, so group_send() from one daphne worker reaches sockets held by another.
+
+Each process polls the file for messages addressed to its own
+process-specific channels (the part of the name up to "!"), one query for
+all of its sockets, and hands them to per-channel queues in memory. Polling is
+cheap while nothing happens: PRAGMA data_version only changes when another
+connection has committed, and sends from this process wake the poller
+directly. Messages are JSON, so they may only hold JSON types.
+"""
+import asyncio
+import json
+import random
+import sqlite3
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channel_messages_target_idx ON channel_messages (target, id);
+CREATE INDEX IF NOT EXISTS channel_messages_channel_idx ON channel_messages (channel, expires);
+CREATE TABLE IF NOT EXISTS channel_groups (
+    group_name TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (group_name, channel)
+);
+"""
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 poll_interval=0.05, timeout=5, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.client_prefix = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+        self.dropped = 0
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        # The poller keeps one connection on one thread so data_version is comparable between polls.
+        self._poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel-layer-poll')
+        self._poll_connection = None
+        self._data_version = None
+        self._reset_local_state(None)
+
+    def _reset_local_state(self, loop):
+        # Queues, events and the poller task belong to one event loop.
+        self._loop = loop
+        self._queues = {}
+        self._receiving = {}
+        self._poller = None
+        self._wakeup = asyncio.Event() if loop else None
+
+    # Database access
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with self._schema_lock:
+            if not self._schema_ready:
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+        return connection
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _insert(self, channels, body):
+        """Queue body on each channel that has room; returns the channels that were full."""
+        connection = self._connection()
+        now = time.time()
+        full = []
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for channel in channels:
+                (pending,) = connection.execute(
+                    'SELECT COUNT(*) FROM channel_messages WHERE channel = ? AND expires > ?', (channel, now),
+                ).fetchone()
+                if pending >= self.get_capacity(channel):
+                    full.append(channel)
+                    continue
+                connection.execute(
+                    'INSERT INTO channel_messages (target, channel, expires, body) VALUES (?, ?, ?, ?)',
+                    (self.non_local_name(channel), channel, now + self.expiry, body),
+                )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return full
+
+    def _take(self, connection, target):
+        """Remove and return (channel, expires, body) rows queued for target, oldest first."""
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'DELETE FROM channel_messages WHERE target = ? RETURNING id, channel, expires, body', (target,),
+            ).fetchall()
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return [row[1:] for row in sorted(rows)]
+
+    def _take_one(self, channel):
+        connection = self._connection()
+        row = connection.execute(
+            'DELETE FROM channel_messages WHERE id = ('
+            ' SELECT id FROM channel_messages WHERE target = ? AND expires > ? ORDER BY id LIMIT 1'
+            ') RETURNING body', (channel, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _poll(self, target):
+        if self._poll_connection is None:
+            self._poll_connection = self._connect()
+        (version,) = self._poll_connection.execute('PRAGMA data_version').fetchone()
+        changed, self._data_version = version != self._data_version, version
+        if not changed:
+            return None
+        (waiting,) = self._poll_connection.execute(
+            'SELECT EXISTS (SELECT 1 FROM channel_messages WHERE target = ?)', (target,),
+        ).fetchone()
+        if not waiting:
+            return []
+        return self._take(self._poll_connection, target)
+
+    def _clean_expired(self):
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # A channel nobody has read from for `expiry` seconds belongs to a socket or
+            # worker that is gone; drop it from its groups, as InMemoryChannelLayer does.
+            connection.execute(
+                'DELETE FROM channel_groups WHERE expires <= ? OR channel IN ('
+                ' SELECT channel FROM channel_messages WHERE expires <= ?)', (now, now),
+            )
+            connection.execute('DELETE FROM channel_messages WHERE expires <= ?', (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert '__asgi_channel__' not in message
+        self.require_valid_channel_name(channel)
+        if await self._run(self._insert, [channel], json.dumps(message)):
+            raise ChannelFull(channel)
+        self._notify()
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._ensure_loop()
+        if '!' not in channel:
+            # Plain channels can be read by any process, so claim rows one at a time.
+            while True:
+                body = await self._run(self._take_one, channel)
+                if body is not None:
+                    return json.loads(body)
+                await asyncio.sleep(self.poll_interval)
+
+        queue = self._queue(channel)
+        self._receiving[channel] = self._receiving.get(channel, 0) + 1
+        self._ensure_poller()
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires > time.time():
+                    return message
+        finally:
+            self._receiving[channel] -= 1
+            if not self._receiving[channel]:
+                del self._receiving[channel]
+            if queue.empty() and self._queues.get(channel) is queue:
+                del self._queues[channel]
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.%s!%s' % (
+            prefix, self.client_prefix, ''.join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    async def flush(self):
+        def delete_all():
+            connection = self._connection()
+            connection.execute('DELETE FROM channel_messages')
+            connection.execute('DELETE FROM channel_groups')
+        await self._run(delete_all)
+        self._queues = {}
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        self._reset_local_state(None)
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        def add():
+            self._connection().execute(
+                'INSERT OR REPLACE INTO channel_groups (group_name, channel, expires) VALUES (?, ?, ?)',
+                (group, channel, time.time() + self.group_expiry),
+            )
+        await self._run(add)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        def discard():
+            self._connection().execute(
+                'DELETE FROM channel_groups WHERE group_name = ? AND channel = ?', (group, channel),
+            )
+        await self._run(discard)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        body = json.dumps(message)
+        def send():
+            channels = [channel for (channel,) in self._connection().execute(
+                'SELECT channel FROM channel_groups WHERE group_name = ? AND expires > ?', (group, time.time()),
+            )]
+            # Members that are full miss the message, as with the other layers.
+            return len(self._insert(channels, body)) if channels else 0
+        self.dropped += await self._run(send)
+        self._notify()
+
+    # Per-process delivery
+
+    def _ensure_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._reset_local_state(loop)
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _ensure_poller(self):
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll_forever())
+
+    def _notify(self):
+        if self._wakeup is not None and self._loop is asyncio.get_running_loop():
+            self._wakeup.set()
+
+    async def _poll_forever(self):
+        loop = asyncio.get_running_loop()
+        target = self.non_local_name(await self.new_channel())
+        last_cleanup = 0
+        while self._queues or self._receiving:
+            rows = await loop.run_in_executor(self._poll_executor, self._poll, target)
+            for channel, expires, body in rows or ():
+                self._deliver(channel, expires, json.loads(body))
+            if time.time() - last_cleanup > self.expiry:
+                last_cleanup = time.time()
+                await self._run(self._clean_expired)
+                self._clean_queues()
+            if not rows:
+                # Nothing for us, even if another connection wrote (a send to
+                # other workers, a group change): wait rather than spin.
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    # Our own commit does not move data_version for the poll connection.
+                    self._data_version = None
+                self._wakeup.clear()
+
+    def _deliver(self, channel, expires, message):
+        # The consumer may be between two receive() calls, so hold the message for it.
+        queue = self._queue(channel)
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait((expires, message))
+
+    def _clean_queues(self):
+        # Queues nobody is waiting on drain only through expiry: their socket is gone.
+        now = time.time()
+        for channel, queue in list(self._queues.items()):
+            if channel in self._receiving:
+                continue
+            while not queue.empty() and queue._queue[0][0] <= now:
+                queue.get_nowait()
+            if queue.empty():
+                del self._queues[channel]
+
+    # Metrics
+
+    def stats(self):
+        """Queue depth per channel against its capacity, group sizes and this process's drop count."""
+        connection = self._connection()
+        now = time.time()
+        channels = {
+            channel: {'pending': pending, 'capacity': self.get_capacity(channel)}
+            for channel, pending in connection.execute(
+                'SELECT channel, COUNT(*) FROM channel_messages WHERE expires > ? GROUP BY channel', (now,),
+            )
+        }
+        groups = dict(connection.execute(
+            'SELECT group_name, COUNT(*) FROM channel_groups WHERE expires > ? GROUP BY group_name', (now,),
+        ).fetchall())
+        return {
+            'pending': sum(channel['pending'] for channel in channels.values()),
+            'full_channels': sorted(name for name, channel in channels.items()
+                                    if channel['pending'] >= channel['capacity']),
+            'channels': channels,
+            'groups': groups,
+            'local_queues': {name: queue.qsize() for name, queue in self._queues.items()},
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,89 @@
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .models import Message
+from .signals import messages_saved
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """
+    Per-process write-behind buffer for chat messages.
+
+    Consumers hand messages to write() and wait for them to be stored. Writes
+    from every socket in the process are batched into one bulk_create once
+    CHAT_WRITE_BUFFER_MAX_BATCH messages are waiting or
+    CHAT_WRITE_BUFFER_INTERVAL seconds have passed, so a busy worker takes
+    SQLite's write lock once per batch instead of once per frame. Each message
+    comes back with its database id and server timestamp.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._timer = None
+        # Timer-started flushes: the loop only keeps weak references to tasks.
+        self._tasks = set()
+
+    async def write(self, room_id, sender_id, content):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((Message(room_id=room_id, sender_id=sender_id, content=content), future))
+        if len(self._pending) >= settings.CHAT_WRITE_BUFFER_MAX_BATCH:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(settings.CHAT_WRITE_BUFFER_INTERVAL, self._scheduled_flush)
+        return await future
+
+    def _scheduled_flush(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Chat message flush failed', exc_info=task.exception())
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            # database_sync_to_async runs on one thread, so batches land in order.
+            await database_sync_to_async(self.insert)([message for message, _ in batch])
+        except Exception as e:
+            logger.exception('Could not write %d chat messages', len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for message, future in batch:
+            if not future.done():
+                future.set_result(message)
+
+    @staticmethod
+    def insert(messages):
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            messages_saved(messages)
+        return messages
+
+    def flush_sync(self):
+        # Interpreter shutdown: the event loop is gone, so write what is left directly.
+        batch, self._pending = self._pending, []
+        if batch:
+            self.insert([message for message, _ in batch])
+
+
+message_buffer = MessageWriteBuffer()
+atexit.register(message_buffer.flush_sync)
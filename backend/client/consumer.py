@@ -1,74 +1,532 @@
+import asyncio
+import functools
 import json
+import zlib
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import ChatRoom, Message, ReadCursor
+from .projections import CHAT_MESSAGE_COLUMNS, render_chat_messages
+from .signals import invalidate_inboxes
+from .chat_buffer import message_buffer
+from .presence import presence_registry, typing_coalescer
+from .rate_limit import TokenBucket, user_buckets
+
+# Subprotocols a client can offer on connect to get batched frames.
+BATCH_PROTOCOL = 'chat.batch'
+BATCH_DEFLATE_PROTOCOL = 'chat.batch.deflate'
+
+# Application close codes (4000-4999).
+CLOSE_TOO_SLOW = 4008
+CLOSE_RATE_LIMITED = 4029
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
+
+def transport_backlog(send):
+    """
+    Bytes written to the client that are still waiting in the server's own
+    buffers. daphne's send is partial(server.handle_reply, protocol): it hands
+    each frame to Twisted, which buffers it in the TCP transport instead of
+    ever making send() wait. 0 when the server is not daphne.
+    """
+    protocol = send.args[0] if isinstance(send, functools.partial) and send.args else None
+    transport = getattr(protocol, 'transport', None)
+    # TLS wraps the TCP transport, which holds the buffer.
+    while transport is not None and not hasattr(transport, 'dataBuffer'):
+        transport = getattr(transport, 'transport', None)
+    if transport is None:
+        return 0
+    return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+
+
+def history_params(params):
+    """
+    (last_seen_id, count) from a connect query string or subscribe frame;
+    (None, None) when the client asked for no history. ValueError if malformed.
+    """
+    last_seen_id, count = params.get('last_seen_id'), params.get('history')
+    last_seen_id = None if last_seen_id in (None, '') else int(last_seen_id)
+    count = None if count in (None, '') else max(int(count), 0)
+    return last_seen_id, count
+
+
+def encode_frame(frame):
+    """JSON text of a frame for chat sockets."""
+    return json.dumps(frame, separators=(',', ':'))
+
+
+class FrameMixin:
+    """
+    Outgoing frames, already JSON-encoded. Broadcast events carry their frame
+    encoded once by the sender, so fan-out to N sockets costs no json.dumps.
+
+    Clients that offer the chat.batch subprotocol get every frame produced
+    within CHAT_BATCH_TICK in one {"type": "batch", "frames": [...]} frame.
+    chat.batch.deflate sends those as binary raw-DEFLATE data instead, with the
+    compression context kept for the whole connection (as permessage-deflate
+    does); each frame ends on a sync flush, so one inflater per socket reads them.
+
+    Frames reach the socket through a queue of at most CHAT_SEND_QUEUE_LIMIT
+    entries. Under daphne send() never blocks, so that queue hardly fills;
+    what a slow client holds up piles up in the Twisted transport instead,
+    and CHAT_SEND_BUFFER_LIMIT bounds that (see transport_backlog). A client
+    over either limit is disconnected with CLOSE_TOO_SLOW rather than
+    buffered without bound.
+    """
+    protocol = None
+    closing = False
+
+    async def accept_protocol(self):
+        offered = self.scope.get('subprotocols') or []
+        self.protocol = next((p for p in (BATCH_DEFLATE_PROTOCOL, BATCH_PROTOCOL) if p in offered), None)
+        self._outbox = []
+        self._flush_timer = None
+        self._deflate = zlib.compressobj(wbits=-15) if self.protocol == BATCH_DEFLATE_PROTOCOL else None
+        self._send_queue = asyncio.Queue(maxsize=settings.CHAT_SEND_QUEUE_LIMIT)
+        await self.accept(subprotocol=self.protocol)
+        self._writer = asyncio.ensure_future(self.write_frames())
+
+    async def send_frame(self, frame):
+        if self.protocol is None:
+            self.enqueue({"text_data": frame})
+            return
+        self._outbox.append(frame)
+        if len(self._outbox) >= settings.CHAT_BATCH_MAX_FRAMES:
+            await self.flush_frames()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                settings.CHAT_BATCH_TICK, lambda: asyncio.ensure_future(self.flush_frames()),
+            )
+
+    async def flush_frames(self):
+        self.cancel_flush()
+        frames, self._outbox = self._outbox, []
+        if not frames:
+            return
+        payload = '{"type":"batch","frames":[' + ','.join(frames) + ']}'
+        if self._deflate is None:
+            self.enqueue({"text_data": payload})
+        else:
+            self.enqueue({"bytes_data": self._deflate.compress(payload.encode()) + self._deflate.flush(zlib.Z_SYNC_FLUSH)})
+
+    def enqueue(self, frame):
+        if self.closing:
+            return
+        try:
+            self._send_queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # The writer is stuck on this client; abandon what's queued and hang up.
+            self.closing = True
+            self._writer.cancel()
+            asyncio.ensure_future(self.close(code=CLOSE_TOO_SLOW))
+
+    def close_after_sending(self, code):
+        """Close the socket once the frames already queued have been written."""
+        if self.closing:
+            return
+        self.closing = True
+        try:
+            self._send_queue.put_nowait({"close": code})
+        except asyncio.QueueFull:
+            self._writer.cancel()
+            asyncio.ensure_future(self.close(code=code))
+
+    async def write_frames(self):
+        while True:
+            frame = await self._send_queue.get()
+            try:
+                if "close" in frame:
+                    await self.close(code=frame["close"])
+                    return
+                await self.send(**frame)
+            finally:
+                self._send_queue.task_done()
+            if transport_backlog(self.base_send) > settings.CHAT_SEND_BUFFER_LIMIT:
+                self.closing = True
+                await self.close(code=CLOSE_TOO_SLOW)
+                return
+
+    def cancel_flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def discard_frames(self):
+        # The socket is gone; nothing queued can be delivered.
+        if hasattr(self, '_send_queue'):
+            self.cancel_flush()
+            self._outbox = []
+            self._writer.cancel()
+
+
+class RateLimitMixin:
+    """
+    Token buckets on inbound frames, per socket and per user (CHAT_*_RATE
+    frames per second, CHAT_*_BURST at once). Frames over the limit are
+    answered with an error; after CHAT_RATE_LIMIT_STRIKES of them in a row the
+    socket is closed with CLOSE_RATE_LIMITED.
+    """
+    async def admit_frame(self):
+        if self.closing:
+            return False
+        if not hasattr(self, 'connection_bucket'):
+            self.connection_bucket = TokenBucket(settings.CHAT_CONNECTION_RATE, settings.CHAT_CONNECTION_BURST)
+            self.strikes = 0
+        user_bucket = user_buckets.bucket(self.scope['user'].id, settings.CHAT_USER_RATE, settings.CHAT_USER_BURST)
+        # Take from both buckets or neither: a frame one of them refuses costs the other nothing.
+        if self.connection_bucket.ready() and user_bucket.ready():
+            self.connection_bucket.take()
+            user_bucket.take()
+            self.strikes = 0
+            return True
+        self.strikes += 1
+        if self.strikes > settings.CHAT_RATE_LIMIT_STRIKES:
+            self.close_after_sending(CLOSE_RATE_LIMITED)
+            return False
+        retry_after = max(self.connection_bucket.retry_after(), user_bucket.retry_after())
+        await self.send_frame(encode_frame({
+            "type": "error",
+            "room_id": None,
+            "error": "Rate limit exceeded",
+            "retry_after": round(retry_after, 3),
+        }))
+        return False
+
+
+class ChatMessagingMixin(RateLimitMixin, FrameMixin):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # room_id -> newest message id sent as history; live copies of those are skipped.
+        self.replayed = {}
+
+    def query_params(self):
+        return {key: values[-1] for key, values in parse_qs(self.scope.get('query_string', b'').decode()).items()}
+
+    async def replay(self, room_ids, last_seen_id=None, count=None):
+        """
+        Send messages after last_seen_id (or the newest `count`) in batched
+        history frames, oldest first. The socket must already be in the rooms'
+        groups, so anything written after the query still arrives live.
+        """
+        history, truncated = await self.load_history(room_ids, last_seen_id, count)
+        by_room = {}
+        for room_id, message in history:
+            by_room.setdefault(room_id, []).append(message)
+            self.replayed[room_id] = max(self.replayed.get(room_id, 0), message['id'])
+        frames = [
+            (room_id, messages[start:start + settings.CHAT_REPLAY_BATCH])
+            for room_id, messages in by_room.items()
+            for start in range(0, len(messages), settings.CHAT_REPLAY_BATCH)
+        ] or [(room_ids[0] if len(room_ids) == 1 else None, [])]
+        for index, (room_id, messages) in enumerate(frames):
+            await self.send_frame(encode_frame({
+                "type": "history",
+                "room_id": room_id,
+                "messages": messages,
+                # More than CHAT_REPLAY_LIMIT were missed; older ones need chat-rooms/<id>/messages/.
+                "truncated": truncated,
+                "done": index == len(frames) - 1,
+            }))
+
+    def already_replayed(self, event):
+        return event["id"] <= self.replayed.get(event["room_id"], 0)
+
+    @database_sync_to_async
+    def load_history(self, room_ids, last_seen_id, count):
+        limit = settings.CHAT_REPLAY_LIMIT if count is None else min(count, settings.CHAT_REPLAY_LIMIT)
+        messages = Message.objects.filter(room_id__in=room_ids)
+        if last_seen_id is not None:
+            messages = messages.filter(id__gt=last_seen_id)
+        rows = list(messages.order_by('-timestamp', '-id').values(*CHAT_MESSAGE_COLUMNS, 'room_id')[:limit + 1])
+        truncated = len(rows) > limit
+        rows = rows[:limit][::-1]
+        return list(zip([row['room_id'] for row in rows], render_chat_messages(rows))), truncated
+
+    async def send_error(self, room_id, error):
+        await self.send_frame(encode_frame({"type": "error", "room_id": room_id, "error": error}))
+
+    async def post_message(self, room_id, message, time=None):
+        sender = self.scope['user']
+        saved = await message_buffer.write(room_id, sender.id, message)
+        await self.channel_layer.group_send(
+            room_group_name(room_id), {
+                "type": "sendMessage",
+                "room_id": room_id,
+                "id": saved.id,
+                "frame": encode_frame({
+                    "type": "message",
+                    "room_id": room_id,
+                    "id": saved.id,
+                    "message": message,
+                    "username": sender.username,
+                    "time": time,
+                    "timestamp": saved.timestamp.isoformat(),
+                }),
+            }
+        )
+
+    async def message_frame(self, room_id, data):
+        # Checked here, before the buffer: a bad message would fail the whole batch it is flushed with.
+        message, time = data.get("message"), data.get("time")
+        if not isinstance(message, str) or not message.strip():
+            await self.send_error(room_id, 'Message is required')
+        elif time is not None and not isinstance(time, str):
+            await self.send_error(room_id, 'time must be a string')
+        else:
+            await self.post_message(room_id, message, time)
+
+    async def read_frame(self, room_id, data):
+        try:
+            message_id = int(data["message_id"])
+        except (ValueError, TypeError, KeyError):
+            await self.send_error(room_id, 'message_id must be an integer')
+            return
+        await self.mark_read(room_id, message_id)
+
+    async def mark_read(self, room_id, message_id):
+        last_read, unread_count = await self.save_read_cursor(room_id, message_id)
+        await self.send_frame(encode_frame({
+            "type": "read",
+            "room_id": room_id,
+            "message_id": last_read,
+            "unread_count": unread_count,
+        }))
+
+    @database_sync_to_async
+    def save_read_cursor(self, room_id, message_id):
+        user_id = self.scope['user'].id
+        cursor = ReadCursor.mark_read(room_id, user_id, message_id)
+        invalidate_inboxes([user_id])
+        return (cursor.last_read_message_id, cursor.unread_count) if cursor else (0, 0)
+
+
+class PresenceMixin:
+    async def enter_room(self, room_id):
+        user = self.scope['user']
+        if presence_registry.join(room_id, user.id, user.username):
+            await self.broadcast_presence(room_id, True)
 
-from .models import ChatRoom, Message
+    async def leave_room(self, room_id):
+        if presence_registry.leave(room_id, self.scope['user'].id):
+            await self.broadcast_presence(room_id, False)
 
-class ChatConsumer(AsyncWebsocketConsumer):
+    async def broadcast_presence(self, room_id, online):
+        user = self.scope['user']
+        await self.channel_layer.group_send(room_group_name(room_id), {
+            "type": "presenceChanged",
+            "room_id": room_id,
+            "frame": encode_frame({
+                "type": "presence",
+                "room_id": room_id,
+                "user": {"id": user.id, "username": user.username},
+                "online": online,
+            }),
+        })
+
+    def user_typing(self, room_id):
+        user = self.scope['user']
+        typing_coalescer.typing(room_id, user.id, user.username, self.broadcast_typing)
+
+    async def broadcast_typing(self, room_id, users):
+        await self.channel_layer.group_send(room_group_name(room_id), {
+            "type": "typingChanged",
+            "room_id": room_id,
+            "frame": encode_frame({"type": "typing", "room_id": room_id, "users": users}),
+        })
+
+    async def presenceChanged(self, event):
+        await self.send_frame(event["frame"])
+
+    async def typingChanged(self, event):
+        await self.send_frame(event["frame"])
+
+
+class ChatConsumer(PresenceMixin, ChatMessagingMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # Get room_id from the URL route
         self.room_id = self.scope['url_route']['kwargs']['room_name']  # room_name contains the ID in the URL
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_group_name = room_group_name(self.room_id)
 
-        # Check if the user has access to this room
-        room = await self.get_room(self.room_id)
-        if room and self.scope["user"] in await self.get_room_participants(room):
+        # Look up the room and check access once; receive() reuses the result.
+        self.room = await self.get_authorized_room(self.room_id, self.scope["user"])
+        if self.room:
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-            await self.accept()
+            await self.accept_protocol()
+            await self.enter_room(self.room.id)
+            try:
+                last_seen_id, count = history_params(self.query_params())
+            except ValueError:
+                await self.send_error(self.room.id, 'last_seen_id and history must be integers')
+                return
+            if last_seen_id is not None or count is not None:
+                await self.replay([self.room.id], last_seen_id, count)
         else:
             await self.close()
 
     async def disconnect(self, close_code):
+        self.discard_frames()
+        await message_buffer.flush()
+        if self.room:
+            await self.leave_room(self.room.id)
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data["message"]
-        username = self.scope["user"].username
-        time = data.get("time", None)
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.admit_frame():
+            return
+        # Any frame shows the client is alive; heartbeats only exist for idle ones.
+        presence_registry.heartbeat([self.room.id], self.scope['user'].id)
+        try:
+            data = json.loads(text_data)
+            frame_type = data.get("type", "message")
+        except (ValueError, TypeError, AttributeError):
+            await self.send_error(self.room.id, 'Frames must be JSON objects')
+            return
+        if frame_type == "typing":
+            self.user_typing(self.room.id)
+        elif frame_type == "heartbeat":
+            pass
+        elif frame_type == "read":
+            await self.read_frame(self.room.id, data)
+        else:
+            await self.message_frame(self.room.id, data)
 
-        room = await self.get_room(self.room_id)  # Changed from self.room_name to self.room_id
-        sender = self.scope['user']
+    async def sendMessage(self, event):
+        if not self.already_replayed(event):
+            await self.send_frame(event["frame"])
 
-        if room:
-            await self.save_message(room, sender, message)
+    @database_sync_to_async
+    def get_authorized_room(self, room_id, user):
+        if not user.is_authenticated:
+            return None
+        return ChatRoom.objects.filter(id=room_id, participants=user).first()
+
+
+class UserChatConsumer(PresenceMixin, ChatMessagingMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user for all of their rooms. Frames in both directions carry
+    a room_id; clients may subscribe/unsubscribe rooms while connected.
+    ?last_seen_id= on connect (or in a subscribe frame) replays what was
+    missed; ?history=N sends the newest N instead:
+
+        {"type": "subscribe", "room_id": 3, "last_seen_id": 40}
+        {"type": "unsubscribe", "room_id": 3}
+        {"type": "message", "room_id": 3, "message": "...", "time": "..."}
+        {"type": "typing", "room_id": 3}
+        {"type": "read", "room_id": 3, "message_id": 41}
+        {"type": "heartbeat"}
+    """
+    async def connect(self):
+        user = self.scope["user"]
+        if not user.is_authenticated:
+            await self.close()
+            return
+        self.subscribed = set()
+        await self.accept_protocol()
+        room_ids = await self.get_room_ids(user)
+        for room_id in room_ids:
+            await self.subscribe(room_id)
+        try:
+            last_seen_id, count = history_params(self.query_params())
+        except ValueError:
+            await self.send_error(None, 'last_seen_id and history must be integers')
+            return
+        # Message ids are global, so one last_seen_id covers every room.
+        if room_ids and (last_seen_id is not None or count is not None):
+            await self.replay(room_ids, last_seen_id, count)
+
+    async def disconnect(self, close_code):
+        self.discard_frames()
+        await message_buffer.flush()
+        for room_id in getattr(self, 'subscribed', ()):
+            await self.leave_room(room_id)
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.admit_frame():
+            return
+        # Any frame shows the client is alive; heartbeats only exist for idle ones.
+        presence_registry.heartbeat(self.subscribed, self.scope['user'].id)
+        try:
+            data = json.loads(text_data)
+            frame_type = data.get("type", "message")
+            if frame_type == "heartbeat":
+                return
+            room_id = int(data["room_id"])
+        except (ValueError, TypeError, KeyError, AttributeError):
+            await self.send_error(None, 'Frames need a type and an integer room_id')
+            return
+
+        if frame_type == "subscribe":
+            try:
+                last_seen_id, count = history_params(data)
+            except (ValueError, TypeError):
+                await self.send_error(room_id, 'last_seen_id and history must be integers')
+                return
+            if room_id in self.subscribed or await self.is_participant(room_id):
+                await self.subscribe(room_id)
+                await self.send_frame(encode_frame({"type": "subscribed", "room_id": room_id}))
+                if last_seen_id is not None or count is not None:
+                    await self.replay([room_id], last_seen_id, count)
+            else:
+                await self.send_error(room_id, 'Chat room not found')
+        elif frame_type == "unsubscribe":
+            if room_id in self.subscribed:
+                self.subscribed.discard(room_id)
+                await self.leave_room(room_id)
+                await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+            await self.send_frame(encode_frame({"type": "unsubscribed", "room_id": room_id}))
+        elif frame_type == "typing":
+            if room_id in self.subscribed:
+                self.user_typing(room_id)
+        elif frame_type == "read":
+            if room_id in self.subscribed:
+                await self.read_frame(room_id, data)
+            else:
+                await self.send_error(room_id, 'Not subscribed to this room')
+        elif frame_type == "message":
+            if room_id not in self.subscribed:
+                await self.send_error(room_id, 'Not subscribed to this room')
+            else:
+                await self.message_frame(room_id, data)
         else:
-            # Optionally: log missing room
-            print(f"[ERROR] Chatroom '{self.room_id}' not found — message not saved.")
+            await self.send_error(room_id, f'Unknown frame type: {frame_type}')
 
-        await self.channel_layer.group_send(
-            self.room_group_name, {
-                "type": "sendMessage",
-                "message": message,
-                "username": username,
-                "time": time
-            }
-        )
+    async def subscribe(self, room_id):
+        if room_id in self.subscribed:
+            return
+        self.subscribed.add(room_id)
+        await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        await self.enter_room(room_id)
 
     async def sendMessage(self, event):
-        await self.send(text_data=json.dumps({
-            "message": event["message"],
-            "username": event["username"],
-            "time": event["time"]
-        }))
+        if event["room_id"] not in self.subscribed or self.already_replayed(event):
+            # Raced with an unsubscribe, or already sent as history.
+            return
+        await self.send_frame(event["frame"])
 
-    @database_sync_to_async
-    def get_room(self, room_id):
-        try:
-            return ChatRoom.objects.get(id=room_id)
-        except ChatRoom.DoesNotExist:
-            return None
+    async def presenceChanged(self, event):
+        if event["room_id"] in self.subscribed:
+            await super().presenceChanged(event)
+
+    async def typingChanged(self, event):
+        if event["room_id"] in self.subscribed:
+            await super().typingChanged(event)
 
     @database_sync_to_async
-    def save_message(self, room, sender, content):
-        return Message.objects.create(room=room, sender=sender, content=content)
+    def get_room_ids(self, user):
+        return list(ChatRoom.objects.filter(participants=user).values_list('id', flat=True))
 
     @database_sync_to_async
-    def get_room_participants(self, room):
-        return list(room.participants.all())
\ No newline at end of file
+    def is_participant(self, room_id):
+        return ChatRoom.objects.filter(id=room_id, participants=self.scope["user"]).exists()
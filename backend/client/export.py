@@ -0,0 +1,113 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, time
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import BusinessProfile, Message, ServiceRequest
+
+# dataset -> (model, exported columns, column used by since=)
+DATASETS = {
+    'service_requests': (ServiceRequest, [
+        'id', 'user_id', 'user__username', 'title', 'description', 'price', 'location',
+        'latitude', 'longitude', 'services_needed', 'industry', 'business_posted', 'created_at', 'updated_at',
+    ], 'updated_at'),
+    'business_profiles': (BusinessProfile, [
+        'id', 'user_profile__user_id', 'user_profile__user__username', 'business_name',
+        'industry', 'services', 'updated_at',
+    ], 'updated_at'),
+    'messages': (Message, [
+        'id', 'room_id', 'sender_id', 'sender__username', 'content', 'timestamp',
+    ], 'timestamp'),
+}
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+CHUNK_ROWS = 2000
+FLUSH_BYTES = 64 * 1024
+
+
+def parse_since(value):
+    """Datetime or date (midnight, current timezone) from ?since=; ValueError if unparseable."""
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Invalid since: {value}')
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def export_rows(dataset, since=None):
+    model, columns, since_field = DATASETS[dataset]
+    queryset = model.objects.order_by('id')
+    if since is not None:
+        queryset = queryset.filter(**{f'{since_field}__gte': since})
+    # values() skips model instantiation; iterator() streams from the cursor in chunks.
+    return queryset.values_list(*columns).iterator(chunk_size=CHUNK_ROWS)
+
+
+def jsonl_lines(columns, rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    for row in rows:
+        yield encoder.encode(dict(zip(columns, row))) + '\n'
+
+
+def csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([','.join(value) if isinstance(value, list) else value for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_chunks(dataset, output='jsonl', since=None, compress=False):
+    """
+    Yield the export as bytes in ~FLUSH_BYTES chunks, optionally gzipped.
+    Memory use is bounded by the chunk size, not the number of rows.
+    """
+    columns = DATASETS[dataset][1]
+    lines = (jsonl_lines if output == 'jsonl' else csv_lines)(columns, export_rows(dataset, since))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    pending, size = [], 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= FLUSH_BYTES:
+            data = ''.join(pending).encode()
+            pending, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = ''.join(pending).encode()
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+async def aiterate(iterator):
+    # ASGI servers would buffer a sync iterator whole; pull one chunk at a time
+    # on the thread that owns the database connection instead.
+    pull = sync_to_async(next, thread_sensitive=True)
+    done = object()
+    while True:
+        chunk = await pull(iterator, done)
+        if chunk is done:
+            return
+        yield chunk
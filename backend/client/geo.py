@@ -0,0 +1,121 @@
+import csv
+import math
+import re
+from functools import lru_cache
+from pathlib import Path
+
+from django.db.models import F, Q
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+DATA_DIR = Path(__file__).resolve().parent / 'data'
+EARTH_RADIUS_KM = 6371.0088
+MAX_RADIUS_KM = 500
+
+POSTAL_CODE_RE = re.compile(r'\b([A-Za-z]\d[A-Za-z])\s?\d[A-Za-z]\d\b')
+
+
+def normalize(text):
+    return ' '.join(re.sub(r"[^\w\s]", ' ', text.lower().replace("'", '')).split())
+
+
+@lru_cache(maxsize=None)
+def load_gazetteer():
+    """
+    Return ({normalized place name: (lat, lng)}, {postal prefix: (lat, lng)})
+    from the CSVs bundled in client/data. Names are indexed both bare and
+    with their region ("london" and "london on").
+    """
+    places = {}
+    with open(DATA_DIR / 'gazetteer.csv', newline='') as f:
+        for row in csv.DictReader(f):
+            point = (float(row['latitude']), float(row['longitude']))
+            name = normalize(row['name'])
+            places.setdefault(name, point)
+            places[f"{name} {row['region'].lower()}"] = point
+    prefixes = {}
+    with open(DATA_DIR / 'postal_prefixes.csv', newline='') as f:
+        for row in csv.DictReader(f):
+            prefixes[row['prefix'].upper()] = (float(row['latitude']), float(row['longitude']))
+    return places, prefixes
+
+
+def geocode(location):
+    """Best-effort offline lookup of a free-text location; None if nothing matches."""
+    if not location:
+        return None
+    places, prefixes = load_gazetteer()
+
+    postal = POSTAL_CODE_RE.search(location)
+    if postal and postal.group(1).upper() in prefixes:
+        return prefixes[postal.group(1).upper()]
+
+    # "123 Main St, Oshawa, ON" -> try each comma-separated part, then the
+    # longest run of words that names a known place, rightmost first.
+    parts = [normalize(part) for part in location.split(',')]
+    for part in reversed(parts):
+        if part in places:
+            return places[part]
+    words = normalize(location).split()
+    for size in (4, 3, 2, 1):
+        for start in range(len(words) - size, -1, -1):
+            candidate = ' '.join(words[start:start + size])
+            if candidate in places:
+                return places[candidate]
+    return None
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def bounding_box(lat, lng, radius_km):
+    """(min_lat, max_lat, min_lng, max_lng) enclosing the circle; longitudes are not wrapped."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = math.cos(math.radians(lat))
+    dlng = 180.0 if cos_lat < 1e-6 else min(180.0, math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat)))
+    return max(-90.0, lat - dlat), min(90.0, lat + dlat), max(-180.0, lng - dlng), min(180.0, lng + dlng)
+
+
+def parse_near(near, radius_km):
+    """Parse ?near=lat,lng&radius_km= into floats, raising ValueError on bad input."""
+    try:
+        lat, lng = (float(v) for v in near.split(','))
+        radius = float(radius_km) if radius_km else 25.0
+    except (TypeError, ValueError):
+        raise ValueError('near must be "lat,lng" and radius_km a number')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('near is out of range')
+    if not 0 < radius <= MAX_RADIUS_KM:
+        raise ValueError(f'radius_km must be between 0 and {MAX_RADIUS_KM}')
+    return lat, lng, radius
+
+
+def distance_km(lat, lng):
+    """Haversine distance from (lat, lng) to each row's latitude/longitude, as a SQL expression."""
+    half_dlat = Radians(F('latitude') - lat) / 2.0
+    half_dlng = Radians(F('longitude') - lng) / 2.0
+    a = Power(Sin(half_dlat), 2) + math.cos(math.radians(lat)) * Cos(Radians(F('latitude'))) * Power(Sin(half_dlng), 2)
+    return 2 * EARTH_RADIUS_KM * ASin(Sqrt(a))
+
+
+def nearby(queryset, lat, lng, radius_km, after=None, limit=None):
+    """
+    [(distance_km, id)] for rows of a queryset with latitude/longitude columns
+    within radius_km, nearest first, starting after the (distance, id) key
+    `after`. The bounding box is answered from the (latitude, longitude) index;
+    the exact distance, the key, the ordering and the limit are all applied in
+    SQL, so a page reads only `limit` rows whatever the radius holds.
+    """
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_km)
+    rows = queryset.filter(
+        latitude__range=(min_lat, max_lat),
+        longitude__range=(min_lng, max_lng),
+    ).annotate(distance=distance_km(lat, lng)).filter(distance__lte=radius_km)
+    if after is not None:
+        rows = rows.filter(Q(distance__gt=after[0]) | Q(distance=after[0], id__gt=after[1]))
+    rows = rows.order_by('distance', 'id').values_list('distance', 'id')
+    return list(rows if limit is None else rows[:limit])
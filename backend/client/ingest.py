@@ -0,0 +1,147 @@
+"""
+Creating a service request together with its images.
+
+Everything the client sent is checked before anything is written. The image
+files are then written concurrently on a thread pool (hashing and disk writes
+release the GIL), and the request and image rows are inserted in one
+transaction, the images with a single bulk_create. If the transaction fails,
+the written files are handed to the blob sweep (storage.py) rather than
+deleted: identical bytes share one blob, which a concurrent request may be
+about to commit an image for.
+"""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from PIL import Image
+
+from .models import INDUSTRY_CHOICES, SERVICES_CHOICES, ImageBlob, ServiceRequest, ServiceRequestImage
+from .signals import images_saved
+from .storage import schedule_sweep
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class IngestError(Exception):
+    pass
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.INGEST_WRITE_WORKERS, thread_name_prefix='ingest')
+        return _executor
+
+
+def parse_choices(data, name, choices, label):
+    # A JSON list (what the app sends) or repeated form values.
+    values = data.getlist(name) if hasattr(data, 'getlist') else data.get(name, [])
+    if isinstance(values, str):
+        values = [values]
+    if values is None:
+        values = []
+    if not isinstance(values, list):
+        raise IngestError(f'{name} must be a list')
+    if len(values) == 1 and isinstance(values[0], str) and values[0].lstrip().startswith('['):
+        try:
+            values = json.loads(values[0])
+        except ValueError:
+            raise IngestError(f'{name} must be a JSON list')
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        raise IngestError(f'{name} must be a list of strings')
+    known = {choice for choice, _ in choices}
+    unknown = [value for value in values if value not in known]
+    if unknown:
+        raise IngestError(f"Unknown {label}: {', '.join(map(str, unknown))}")
+    return list(values)
+
+
+def clean_field(name, value):
+    # The model field's own checks: max_length, max_digits, decimal_places.
+    try:
+        return ServiceRequest._meta.get_field(name).clean(value, None)
+    except ValidationError as e:
+        raise IngestError(f"{name}: {' '.join(e.messages)}")
+
+
+def validate_image(upload):
+    if upload.size > settings.UPLOAD_MAX_LENGTH:
+        raise IngestError(f'{upload.name} is larger than {settings.UPLOAD_MAX_LENGTH} bytes')
+    try:
+        with Image.open(upload) as image:
+            image.verify()
+    except Exception:
+        raise IngestError(f'{upload.name} is not an image')
+    finally:
+        upload.seek(0)
+
+
+def validate(data, files):
+    """Cleaned ServiceRequest fields and image files, or IngestError."""
+    if not all(data.get(name) for name in ('title', 'description', 'location')):
+        raise IngestError('Title, description, and location are required.')
+    fields = {name: clean_field(name, data.get(name)) for name in ('title', 'description', 'location')}
+    business_posted = data.get('business_posted', False)
+    if isinstance(business_posted, str):
+        business_posted = business_posted.lower() in ['true', 'yes', '1']
+    fields.update(
+        price=clean_field('price', data.get('price') or None),
+        services_needed=parse_choices(data, 'services_needed', SERVICES_CHOICES, 'services'),
+        industry=parse_choices(data, 'industry', INDUSTRY_CHOICES, 'industries'),
+        business_posted=bool(business_posted),
+    )
+    if len(files) > settings.INGEST_MAX_IMAGES:
+        raise IngestError(f'At most {settings.INGEST_MAX_IMAGES} images per request.')
+    for upload in files:
+        validate_image(upload)
+    return fields
+
+
+def write_files(service_request, files):
+    """Storage names of the written files, in order, writing them concurrently."""
+    field = ServiceRequestImage._meta.get_field('image')
+    def write(upload):
+        name = field.generate_filename(ServiceRequestImage(service_request=service_request), upload.name)
+        return field.storage.save(name, upload, max_length=field.max_length)
+    futures = [executor().submit(write, upload) for upload in files]
+    names, error = [], None
+    for future in futures:
+        try:
+            names.append(future.result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        release_files(names)
+        raise error
+    return names
+
+
+def release_files(names):
+    # Blobs without images start at refcount 0; the sweep collects them after
+    # the grace period unless an image has started pointing at them by then.
+    storage = ServiceRequestImage._meta.get_field('image').storage
+    for name in names:
+        ImageBlob.objects.get_or_create(name=name, defaults={'size': storage.size(name)})
+    transaction.on_commit(schedule_sweep)
+
+
+def ingest_service_request(user, data, files):
+    fields = validate(data, files)
+    service_request = ServiceRequest(user=user, **fields)
+    names = write_files(service_request, files)
+    try:
+        with transaction.atomic():
+            service_request.save()
+            images = ServiceRequestImage.objects.bulk_create([
+                ServiceRequestImage(service_request=service_request, image=name) for name in names
+            ])
+            images_saved(images)
+    except Exception:
+        release_files(names)
+        raise
+    return service_request
@@ -0,0 +1,25 @@
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+@contextmanager
+def scratch_database():
+    """Point the default connection at a throwaway test database for the duration."""
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def best_of(repeat, func):
+    """Fastest wall-clock time of `repeat` calls, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
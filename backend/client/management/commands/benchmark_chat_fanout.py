@@ -0,0 +1,83 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from client.consumer import BATCH_DEFLATE_PROTOCOL, BATCH_PROTOCOL, UserChatConsumer, encode_frame
+
+
+def make_event(room_id, message_id):
+    return {
+        "type": "sendMessage",
+        "room_id": room_id,
+        "id": message_id,
+        "frame": encode_frame({
+            "type": "message",
+            "room_id": room_id,
+            "id": message_id,
+            "message": f"Benchmark message {message_id}: the tiles arrive Thursday morning",
+            "username": "bench",
+            "time": None,
+            "timestamp": "2026-10-18T12:00:00.000000+00:00",
+        }),
+    }
+
+
+async def fan_out(protocol, recipients, messages, burst):
+    """Deliver `messages` events to `recipients` sockets; returns (seconds, frames written, bytes written)."""
+    sent = [0, 0]
+
+    async def base_send(message):
+        if message['type'] == 'websocket.send':
+            sent[0] += 1
+            sent[1] += len(message.get('text') or message.get('bytes') or b'')
+
+    consumers = []
+    for _ in range(recipients):
+        consumer = UserChatConsumer()
+        consumer.scope = {'subprotocols': [protocol] if protocol else []}
+        consumer.base_send = base_send
+        consumer.subscribed = {1}
+        await consumer.accept_protocol()
+        consumers.append(consumer)
+    events = [make_event(1, i + 1) for i in range(messages)]
+
+    start = time.perf_counter()
+    for offset in range(0, messages, burst):
+        for event in events[offset:offset + burst]:
+            if protocol == 'legacy':
+                # What sendMessage did before frames were encoded once per group.
+                frame = json.loads(event["frame"])
+                for consumer in consumers:
+                    await consumer.send(text_data=json.dumps(frame))
+            else:
+                for consumer in consumers:
+                    await consumer.sendMessage(event)
+        # One batching tick elapses between bursts, and the writers catch up.
+        for consumer in consumers:
+            if consumer.protocol:
+                await consumer.flush_frames()
+            await consumer._send_queue.join()
+    return time.perf_counter() - start, sent[0], sent[1]
+
+
+class Command(BaseCommand):
+    help = 'Measure chat fan-out: message deliveries per second (one core) and bytes per delivery.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--burst', type=int, default=10, help='messages arriving within one batching tick')
+
+    def handle(self, *args, **options):
+        recipients, messages, burst = options['recipients'], options['messages'], options['burst']
+        deliveries = recipients * messages
+        # The socket write itself is stubbed out; in daphne each frame also costs a
+        # transport write, which is what batching saves.
+        self.stdout.write(f"{'mode':<20} {'deliveries/s':>14} {'frames/delivery':>16} {'bytes/delivery':>15}")
+        for name, protocol in [('per-socket json', 'legacy'), ('shared frame', None),
+                               (BATCH_PROTOCOL, BATCH_PROTOCOL), (BATCH_DEFLATE_PROTOCOL, BATCH_DEFLATE_PROTOCOL)]:
+            seconds, frames, written = asyncio.run(fan_out(protocol, recipients, messages, burst))
+            self.stdout.write(f'{name:<20} {deliveries / seconds:>14,.0f} {frames / deliveries:>16.2f} '
+                              f'{written / deliveries:>15.1f}')
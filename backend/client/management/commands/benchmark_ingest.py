@@ -0,0 +1,78 @@
+import io
+import shutil
+import statistics
+import tempfile
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from PIL import Image
+
+from client.ingest import ingest_service_request
+from client.models import ServiceRequest, ServiceRequestImage
+
+from ._bench import scratch_database
+
+DATA = {'title': 'Bathroom tiles', 'description': 'Benchmark request ' * 8, 'location': 'Oshawa, ON',
+        'price': '125.00', 'services_needed': '["Renovation", "Repair"]'}
+
+
+def make_photos(count, size):
+    """`count` distinct JPEGs of noise, roughly the size of phone photos."""
+    photos = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        Image.effect_noise(size, 40 + i).convert('RGB').save(buffer, 'JPEG', quality=90)
+        photos.append(buffer.getvalue())
+    return photos
+
+
+def serial_create(user, data, files):
+    # What ServiceRequestView.post did before: no transaction, one INSERT and one file write at a time.
+    sr = ServiceRequest.objects.create(user=user, title=data['title'], description=data['description'],
+                                       price=data['price'], location=data['location'], services_needed=['Renovation', 'Repair'])
+    for upload in files:
+        ServiceRequestImage.objects.create(service_request=sr, image=upload)
+    return sr
+
+
+class Command(BaseCommand):
+    help = 'Latency of creating a service request with 1, 5 and 10 images, serially and through the ingest path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', default='1,5,10')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--size', type=int, default=1600, help='photo width in pixels (height is 3/4 of it)')
+
+    def handle(self, *args, **options):
+        counts = [int(count) for count in options['images'].split(',')]
+        photos = make_photos(sum(counts) * options['repeat'] * 2, (options['size'], options['size'] * 3 // 4))
+        self.stdout.write(f'photo size: {statistics.mean(map(len, photos)) / 1024:,.0f} KiB')
+        self.stdout.write(f"{'images':>6} {'serial ms':>10} {'ingest ms':>10}")
+        media_root = tempfile.mkdtemp()
+        try:
+            # Renditions are made after the response, and the serial path (autocommit) would start
+            # them while it is still writing; leave them out of both.
+            with override_settings(MEDIA_ROOT=media_root), scratch_database(), \
+                    mock.patch('client.signals.schedule_renditions'):
+                user = User.objects.create_user(username='bench', email='bench@example.com', password='!')
+                # Every request gets photos nobody sent before, so nothing is deduplicated.
+                unused = iter(photos)
+                def run(create, count):
+                    timings = []
+                    for _ in range(options['repeat']):
+                        files = [SimpleUploadedFile(f'{i}.jpg', next(unused), content_type='image/jpeg')
+                                 for i in range(count)]
+                        start = time.perf_counter()
+                        create(user, DATA, files)
+                        timings.append(time.perf_counter() - start)
+                    return statistics.median(timings) * 1000
+                for count in counts:
+                    serial = run(serial_create, count)
+                    ingest = run(ingest_service_request, count)
+                    self.stdout.write(f'{count:>6} {serial:>10.1f} {ingest:>10.1f}')
+        finally:
+            shutil.rmtree(media_root)
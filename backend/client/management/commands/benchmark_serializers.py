@@ -0,0 +1,93 @@
+"""
+Rows/second of the DRF list serializers against the values() projections in
+client/projections.py, at 1k, 10k and 100k rows by default. A full run seeds
+100k rows of each kind into a scratch database and takes about two minutes.
+Best of 2 on a development machine:
+
+    endpoint               rows  serializer rows/s  projection rows/s  speedup
+    service_requests       1000              8,229             34,811     4.2x
+    service_requests      10000              8,536             25,916     3.0x
+    service_requests     100000              6,871             25,527     3.7x
+    business_profiles      1000             25,940            161,282     6.2x
+    business_profiles     10000             22,108            160,755     7.3x
+    business_profiles    100000             19,880            101,482     5.1x
+    chat_messages          1000              6,160              9,351     1.5x
+    chat_messages         10000             19,521             43,703     2.2x
+    chat_messages        100000             25,666             67,083     2.6x
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from client.models import BusinessProfile, ChatRoom, Message, ServiceRequest, ServiceRequestImage, UserProfile
+from client.projections import (
+    business_profile_values, chat_message_values, render_business_profiles,
+    render_chat_messages, render_service_requests, service_request_values,
+)
+from client.views import BusinessProfileListSerializer, ChatMessageSerializer, ServiceRequestListSerializer
+
+from ._bench import best_of, scratch_database
+
+
+def seed(count):
+    users = User.objects.bulk_create(
+        User(username=f'bench{i}', email=f'bench{i}@example.com', password='!') for i in range(count)
+    )
+    profiles = UserProfile.objects.bulk_create(UserProfile(user=user, is_business_owner=True) for user in users)
+    BusinessProfile.objects.bulk_create(
+        BusinessProfile(user_profile=profile, business_name=f'Business {i}', industry=['Plumbing'],
+                        services=['Repair', 'Installation'])
+        for i, profile in enumerate(profiles)
+    )
+    requests = ServiceRequest.objects.bulk_create(
+        ServiceRequest(user=users[i % len(users)], title=f'Request {i}', description='Benchmark row ' * 8,
+                       price='125.00', location='Oshawa, ON', services_needed=['Repair', 'Design'])
+        for i in range(count)
+    )
+    ServiceRequestImage.objects.bulk_create(
+        ServiceRequestImage(service_request=sr, image=f'service_request_images/bench/{sr.id}.jpg') for sr in requests
+    )
+    room = ChatRoom.objects.create(service_request=requests[0], room_name='bench')
+    Message.objects.bulk_create(
+        Message(room=room, sender=users[i % 2], content=f'Message {i}') for i in range(count)
+    )
+
+
+class Command(BaseCommand):
+    help = 'Compare rows/second of the DRF list serializers and their values() projections.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        renderer = JSONRenderer()
+        cases = {
+            'service_requests': (
+                lambda n: renderer.render(ServiceRequestListSerializer(
+                    ServiceRequest.objects.select_related('user').prefetch_related('images').order_by('-id')[:n], many=True).data),
+                lambda n: renderer.render(render_service_requests(
+                    service_request_values(ServiceRequest.objects.order_by('-id')[:n]))),
+            ),
+            'business_profiles': (
+                lambda n: renderer.render(BusinessProfileListSerializer(
+                    BusinessProfile.objects.select_related('user_profile__user').order_by('id')[:n], many=True).data),
+                lambda n: renderer.render(render_business_profiles(
+                    business_profile_values(BusinessProfile.objects.order_by('id')[:n]))),
+            ),
+            'chat_messages': (
+                lambda n: renderer.render(ChatMessageSerializer(
+                    Message.objects.select_related('sender').order_by('-timestamp')[:n], many=True).data),
+                lambda n: renderer.render(render_chat_messages(
+                    chat_message_values(Message.objects.order_by('-timestamp')[:n]))),
+            ),
+        }
+        with scratch_database():
+            seed(max(sizes))
+            self.stdout.write(f"{'endpoint':<18} {'rows':>8} {'serializer rows/s':>18} {'projection rows/s':>18} {'speedup':>8}")
+            for name, (slow, fast) in cases.items():
+                for n in sizes:
+                    before = best_of(options['repeat'], lambda: slow(n))
+                    after = best_of(options['repeat'], lambda: fast(n))
+                    self.stdout.write(f'{name:<18} {n:>8} {n / before:>18,.0f} {n / after:>18,.0f} {before / after:>7.1f}x')
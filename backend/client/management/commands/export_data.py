@@ -0,0 +1,32 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from client.export import DATASETS, FORMATS, export_chunks, parse_since
+
+
+class Command(BaseCommand):
+    help = 'Stream a dataset as JSON Lines or CSV without loading it into memory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', dest='output', choices=sorted(FORMATS), default='jsonl')
+        parser.add_argument('--since', help='Only rows created/updated at or after this date or datetime.')
+        parser.add_argument('--gzip', action='store_true', help='Gzip the output.')
+        parser.add_argument('-o', '--output-file', help='Write here instead of stdout.')
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_since(options['since'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        chunks = export_chunks(options['dataset'], options['output'], since, options['gzip'])
+        if options['output_file']:
+            with open(options['output_file'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            out = sys.stdout.buffer
+            for chunk in chunks:
+                out.write(chunk)
+            out.flush()
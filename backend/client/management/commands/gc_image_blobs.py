@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from client.storage import sweep_blobs
+
+
+class Command(BaseCommand):
+    help = 'Delete image blobs (and their renditions) that no service request image refers to.'
+
+    def handle(self, *args, **options):
+        deleted = sweep_blobs(scan=True)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} unreferenced blobs.'))
@@ -0,0 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from client.models import ServiceRequestImage
+from client.renditions import render_image_id
+
+
+class Command(BaseCommand):
+    help = 'Create the downsized renditions of service request images that do not have them yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.IMAGE_RENDITION_WORKERS)
+        parser.add_argument('--all', action='store_true', help='re-render images that already have renditions')
+
+    def handle(self, *args, **options):
+        images = ServiceRequestImage.objects.exclude(image='')
+        if not options['all']:
+            images = images.filter(renditions={})
+        ids = list(images.order_by('id').values_list('id', flat=True))
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            rendered = sum(pool.map(partial(render_image_id, force=options['all']), ids))
+        failed = len(ids) - rendered
+        self.stdout.write(self.style.SUCCESS(f'Rendered {rendered} images.'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} images could not be rendered; see the log.'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from client.search import install_search_index, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the service request full-text search index from scratch.'
+
+    def handle(self, *args, **options):
+        install_search_index()
+        count = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} service requests.'))
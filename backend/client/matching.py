@@ -0,0 +1,257 @@
+import bisect
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .geo import haversine_km
+
+logger = logging.getLogger(__name__)
+
+# Relative weight of each signal in a request's score for a business.
+OVERLAP_WEIGHT = 0.6
+RECENCY_WEIGHT = 0.25
+DISTANCE_WEIGHT = 0.15
+RECENCY_HALF_LIFE_DAYS = 7
+DISTANCE_SCALE_KM = 25
+
+
+def bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+
+def recency(created, now):
+    return RECENCY_WEIGHT * 0.5 ** (max(0.0, now - created) / 86400 / RECENCY_HALF_LIFE_DAYS)
+
+
+def overlap(needed, wanted, offered, trades):
+    """Share of a request's services and industries that a business covers."""
+    asked = popcount(needed) + popcount(wanted)
+    if not asked:
+        return 0.0
+    return (popcount(needed & offered) + popcount(wanted & trades)) / asked
+
+
+class MatchIndex:
+    """
+    In-process inverted indexes from service bit and industry bit -> request
+    ids / business ids, with just enough per-row data (masks, timestamps,
+    coordinates) to score candidates without touching the database. Loaded
+    lazily and kept current by the model signals in signals.py, once their
+    transaction commits. Every MATCHING_INDEX_TTL seconds it is rebuilt in a
+    background thread to pick up writes made by other processes; requests keep
+    reading the old copy until the new one is swapped in.
+
+    Request postings are kept newest first as (-created, id) keys, so the best
+    requests for a business come from merging its buckets and stopping once
+    the most any remaining request could score cannot beat the current Nth.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held by whoever is rebuilding; there is only ever one rebuild.
+        self._reload_lock = threading.Lock()
+        self._loaded_at = None
+        # Changes made while a rebuild runs, replayed onto its result.
+        self._replay = None
+        self._reset()
+
+    def _reset(self):
+        self.requests = {}
+        self.businesses = {}
+        self.requests_by_service = defaultdict(list)
+        self.requests_by_industry = defaultdict(list)
+        self.businesses_by_service = defaultdict(set)
+        self.businesses_by_industry = defaultdict(set)
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def ensure_loaded(self):
+        if self.loaded:
+            if time.monotonic() - self._loaded_at >= settings.MATCHING_INDEX_TTL:
+                self.reload_in_background()
+            return
+        with self._reload_lock:
+            if not self.loaded:
+                self.reload()
+
+    def reload_in_background(self):
+        if self._reload_lock.acquire(blocking=False):
+            threading.Thread(target=self._background_reload, name='match-index', daemon=True).start()
+
+    def _background_reload(self):
+        close_old_connections()
+        try:
+            self.reload()
+        except Exception:
+            logger.exception('Reloading the match index failed')
+        finally:
+            self._reload_lock.release()
+            connections.close_all()
+
+    def reload(self):
+        """Build a fresh copy from the database without holding the lock, then swap it in."""
+        from .models import BusinessProfile, ServiceRequest
+        with self._lock:
+            self._replay = []
+        try:
+            fresh = MatchIndex()
+            rows = ServiceRequest.objects.values_list(
+                'id', 'user_id', 'services_mask', 'industry_mask', 'created_at', 'latitude', 'longitude')
+            for pk, user_id, services, industries, created_at, lat, lng in rows.iterator(chunk_size=5000):
+                fresh._add_request(pk, user_id, services, industries, created_at.timestamp(), lat, lng)
+            rows = BusinessProfile.objects.values_list('id', 'user_profile__user_id', 'services_mask', 'industry_mask')
+            for pk, user_id, services, industries in rows.iterator(chunk_size=5000):
+                fresh._add_business(pk, user_id, services, industries)
+            with self._lock:
+                for method, args in self._replay:
+                    getattr(fresh, method)(*args)
+                self.requests, self.businesses = fresh.requests, fresh.businesses
+                self.requests_by_service, self.requests_by_industry = fresh.requests_by_service, fresh.requests_by_industry
+                self.businesses_by_service, self.businesses_by_industry = fresh.businesses_by_service, fresh.businesses_by_industry
+                self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._replay = None
+
+    def clear(self):
+        with self._lock:
+            self._loaded_at = None
+            self._reset()
+
+    def _apply(self, method, *args):
+        # Applied now if loaded, and again onto a rebuild that may have read the row before it changed.
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((method, args))
+            if self.loaded:
+                getattr(self, method)(*args)
+
+    def add_request(self, pk, user_id, services, industries, created_at, lat=None, lng=None):
+        self._apply('_add_request', pk, user_id, services, industries, created_at.timestamp(), lat, lng)
+
+    def remove_request(self, pk):
+        self._apply('_remove_request', pk)
+
+    def add_business(self, pk, user_id, services, industries):
+        self._apply('_add_business', pk, user_id, services, industries)
+
+    def remove_business(self, pk):
+        self._apply('_remove_business', pk)
+
+    def _add_request(self, pk, user_id, services, industries, created, lat, lng):
+        self._remove_request(pk)
+        self.requests[pk] = (user_id, services, industries, created, lat, lng)
+        key = (-created, pk)
+        for bit in bits(services):
+            bisect.insort(self.requests_by_service[bit], key)
+        for bit in bits(industries):
+            bisect.insort(self.requests_by_industry[bit], key)
+
+    def _remove_request(self, pk):
+        row = self.requests.pop(pk, None)
+        if row:
+            key = (-row[3], pk)
+            for bit in bits(row[1]):
+                postings = self.requests_by_service[bit]
+                del postings[bisect.bisect_left(postings, key)]
+            for bit in bits(row[2]):
+                postings = self.requests_by_industry[bit]
+                del postings[bisect.bisect_left(postings, key)]
+
+    def _add_business(self, pk, user_id, services, industries):
+        self._remove_business(pk)
+        self.businesses[pk] = (user_id, services, industries)
+        for bit in bits(services):
+            self.businesses_by_service[bit].add(pk)
+        for bit in bits(industries):
+            self.businesses_by_industry[bit].add(pk)
+
+    def _remove_business(self, pk):
+        row = self.businesses.pop(pk, None)
+        if row:
+            for bit in bits(row[1]):
+                self.businesses_by_service[bit].discard(pk)
+            for bit in bits(row[2]):
+                self.businesses_by_industry[bit].discard(pk)
+
+    def top_requests_for_business(self, business_id, limit, near=None):
+        """[(score, request_id)] best first; near=(lat, lng) adds a proximity term."""
+        self.ensure_loaded()
+        with self._lock:
+            business = self.businesses.get(business_id)
+            if business is None or limit < 1:
+                return []
+            user_id, offered, trades = business
+            postings = [
+                *(self.requests_by_service[bit] for bit in bits(offered)),
+                *(self.requests_by_industry[bit] for bit in bits(trades)),
+            ]
+            # Everything but recency is at most its full weight.
+            ceiling = OVERLAP_WEIGHT + (DISTANCE_WEIGHT if near else 0.0)
+            now = time.time()
+            top = []  # min-heap of the best `limit` (score, -pk) so far
+            previous = None
+            for key in heapq.merge(*postings):
+                if key == previous:
+                    # In more than one bucket; equal keys come out together.
+                    continue
+                previous = key
+                created, pk = -key[0], key[1]
+                fresh = recency(created, now)
+                if len(top) == limit and ceiling + fresh < top[0][0]:
+                    # Every later request is older, so none can do better.
+                    break
+                owner, needed, wanted, _, lat, lng = self.requests[pk]
+                if owner == user_id:
+                    continue
+                score = OVERLAP_WEIGHT * overlap(needed, wanted, offered, trades) + fresh
+                if near and lat is not None:
+                    distance = haversine_km(near[0], near[1], lat, lng)
+                    score += DISTANCE_WEIGHT * math.exp(-distance / DISTANCE_SCALE_KM)
+                if len(top) < limit:
+                    heapq.heappush(top, (score, -pk))
+                elif (score, -pk) > top[0]:
+                    heapq.heapreplace(top, (score, -pk))
+        return [(score, -neg_pk) for score, neg_pk in sorted(top, reverse=True)]
+
+    def top_businesses_for_request(self, request_id, limit):
+        """[(score, business_id)] best first, ranked by how much of the request each covers."""
+        self.ensure_loaded()
+        with self._lock:
+            request = self.requests.get(request_id)
+            if request is None:
+                return []
+            owner, needed, wanted = request[:3]
+            candidates = set().union(
+                *(self.businesses_by_service[bit] for bit in bits(needed)),
+                *(self.businesses_by_industry[bit] for bit in bits(wanted)),
+            )
+            scored = []
+            for pk in candidates:
+                user_id, offered, trades = self.businesses[pk]
+                if user_id == owner:
+                    continue
+                # Full coverage first; among equals prefer specialists over generalists.
+                shared = popcount(needed & offered) + popcount(wanted & trades)
+                breadth = popcount(offered) + (popcount(trades) if wanted else 0)
+                score = overlap(needed, wanted, offered, trades) + 0.1 * shared / breadth
+                scored.append((score, -pk))
+        return [(score, -neg_pk) for score, neg_pk in heapq.nlargest(limit, scored)]
+
+
+match_index = MatchIndex()
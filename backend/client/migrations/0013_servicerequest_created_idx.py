@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0012_alter_chatroom_unique_together_chatroom_room_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['-created_at', '-id'], name='servicerequest_created_idx'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+# Frozen copies of the choice lists and client.models.choices_mask as of this
+# migration, so later edits to either don't change what it writes.
+INDUSTRY_CHOICES = ['Construction', 'Plumbing', 'Electrical', 'Landscaping', 'Painting', 'Other']
+SERVICES_CHOICES = ['Renovation', 'Repair', 'Installation', 'Consultation', 'Maintenance', 'Inspection', 'Design', 'Other']
+BATCH_SIZE = 500
+
+
+def choices_mask(values, choices):
+    if not values:
+        return 0
+    if isinstance(values, str):
+        values = values.split(',')
+    mask = 0
+    for value in values:
+        if value in choices:
+            mask |= 1 << choices.index(value)
+    return mask
+
+
+def backfill_masks(apps, schema_editor):
+    masked = [
+        ('UserProfile', {'industry_mask': ('industry', INDUSTRY_CHOICES), 'services_mask': ('services', SERVICES_CHOICES)}),
+        ('BusinessProfile', {'industry_mask': ('industry', INDUSTRY_CHOICES), 'services_mask': ('services', SERVICES_CHOICES)}),
+        ('ServiceRequest', {'services_mask': ('services_needed', SERVICES_CHOICES)}),
+    ]
+    for model_name, masks in masked:
+        model = apps.get_model('client', model_name)
+        rows = []
+        for obj in model.objects.only('id', *[source for source, _ in masks.values()]).iterator(chunk_size=2000):
+            for mask_field, (source, choices) in masks.items():
+                setattr(obj, mask_field, choices_mask(getattr(obj, source), choices))
+            rows.append(obj)
+            if len(rows) == BATCH_SIZE:
+                model.objects.bulk_update(rows, list(masks))
+                rows = []
+        if rows:
+            model.objects.bulk_update(rows, list(masks))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0013_servicerequest_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='businessprofile',
+            name='industry_mask',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='businessprofile',
+            name='services_mask',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='services_mask',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='industry_mask',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='services_mask',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_masks, migrations.RunPython.noop),
+    ]
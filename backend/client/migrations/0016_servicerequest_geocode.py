@@ -0,0 +1,91 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:12
+
+import csv
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.db import migrations, models
+
+# A frozen copy of client.geo.geocode as of this migration, so later edits to
+# the lookup don't change what it writes. The gazetteer CSVs it reads only gain rows.
+DATA_DIR = Path(__file__).resolve().parent.parent / 'data'
+POSTAL_CODE_RE = re.compile(r'\b([A-Za-z]\d[A-Za-z])\s?\d[A-Za-z]\d\b')
+
+
+def normalize(text):
+    return ' '.join(re.sub(r"[^\w\s]", ' ', text.lower().replace("'", '')).split())
+
+
+def load_gazetteer():
+    places = {}
+    with open(DATA_DIR / 'gazetteer.csv', newline='') as f:
+        for row in csv.DictReader(f):
+            point = (float(row['latitude']), float(row['longitude']))
+            name = normalize(row['name'])
+            places.setdefault(name, point)
+            places[f"{name} {row['region'].lower()}"] = point
+    prefixes = {}
+    with open(DATA_DIR / 'postal_prefixes.csv', newline='') as f:
+        for row in csv.DictReader(f):
+            prefixes[row['prefix'].upper()] = (float(row['latitude']), float(row['longitude']))
+    return places, prefixes
+
+
+def geocode(location, places, prefixes):
+    if not location:
+        return None
+    postal = POSTAL_CODE_RE.search(location)
+    if postal and postal.group(1).upper() in prefixes:
+        return prefixes[postal.group(1).upper()]
+    parts = [normalize(part) for part in location.split(',')]
+    for part in reversed(parts):
+        if part in places:
+            return places[part]
+    words = normalize(location).split()
+    for size in (4, 3, 2, 1):
+        for start in range(len(words) - size, -1, -1):
+            candidate = ' '.join(words[start:start + size])
+            if candidate in places:
+                return places[candidate]
+    return None
+
+
+def backfill_coordinates(apps, schema_editor):
+    ServiceRequest = apps.get_model('client', 'ServiceRequest')
+    places, prefixes = load_gazetteer()
+    rows = []
+    for sr in ServiceRequest.objects.only('id', 'location').iterator(chunk_size=2000):
+        sr.latitude, sr.longitude = geocode(sr.location, places, prefixes) or (None, None)
+        rows.append(sr)
+        if len(rows) == 500:
+            ServiceRequest.objects.bulk_update(rows, ['latitude', 'longitude'])
+            rows = []
+    if rows:
+        ServiceRequest.objects.bulk_update(rows, ['latitude', 'longitude'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0015_servicerequest_fts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicerequest',
+            name='latitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='longitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['latitude', 'longitude'], name='servicerequest_latlng_idx'),
+        ),
+        migrations.RunPython(backfill_coordinates, migrations.RunPython.noop),
+    ]
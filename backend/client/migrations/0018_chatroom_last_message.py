@@ -0,0 +1,56 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:28
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_last_message(apps, schema_editor):
+    ChatRoom = apps.get_model('client', 'ChatRoom')
+    Message = apps.get_model('client', 'Message')
+    for room in ChatRoom.objects.iterator(chunk_size=500):
+        latest = Message.objects.filter(room_id=room.id).order_by('-timestamp', '-id').first()
+        if latest:
+            room.last_message_content = latest.content
+            room.last_message_sender_id = latest.sender_id
+            room.last_message_at = room.last_activity_at = latest.timestamp
+        else:
+            room.last_activity_at = room.created_at
+        room.save(update_fields=['last_message_content', 'last_message_sender', 'last_message_at', 'last_activity_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0017_sync_tracking'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_content',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['-last_activity_at', '-id'], name='chatroom_activity_idx'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
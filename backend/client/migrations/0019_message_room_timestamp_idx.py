@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0018_chatroom_last_message'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-timestamp', '-id'], name='message_room_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.3 on 2026-10-18 19:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_cursors(apps, schema_editor):
+    # Nothing was tracked before, so existing conversations start out read.
+    ChatRoom = apps.get_model('client', 'ChatRoom')
+    Message = apps.get_model('client', 'Message')
+    ReadCursor = apps.get_model('client', 'ReadCursor')
+    for room in ChatRoom.objects.iterator(chunk_size=500):
+        latest = Message.objects.filter(room_id=room.id).order_by('-id').values_list('id', flat=True).first() or 0
+        ReadCursor.objects.bulk_create(
+            [ReadCursor(room_id=room.id, user_id=user_id, last_read_message_id=latest)
+             for user_id in room.participants.values_list('id', flat=True)],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0019_message_room_timestamp_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='client.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('room', 'user'), name='readcursor_room_user_unique')],
+            },
+        ),
+        migrations.RunPython(open_cursors, migrations.RunPython.noop),
+    ]
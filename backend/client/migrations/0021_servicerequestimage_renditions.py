@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0020_readcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicerequestimage',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
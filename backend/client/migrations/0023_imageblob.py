@@ -0,0 +1,33 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:20
+
+import client.models
+import client.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0022_imageupload'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='servicerequestimage',
+            name='image',
+            field=models.ImageField(storage=client.storage.get_image_storage, upload_to=client.models.service_request_image_path),
+        ),
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['refcount', 'updated_at'], name='imageblob_refcount_idx')],
+            },
+        ),
+    ]
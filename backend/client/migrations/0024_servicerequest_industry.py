@@ -0,0 +1,24 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:49
+
+import multiselectfield.db.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0023_imageblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicerequest',
+            name='industry',
+            field=multiselectfield.db.fields.MultiSelectField(blank=True, choices=[('Construction', 'Construction'), ('Plumbing', 'Plumbing'), ('Electrical', 'Electrical'), ('Landscaping', 'Landscaping'), ('Painting', 'Painting'), ('Other', 'Other')], max_length=59, null=True),
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='industry_mask',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+    ]
@@ -1,7 +1,13 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.utils import timezone
 from multiselectfield import MultiSelectField
 
+from .geo import geocode
+from .storage import get_image_storage, is_blob, schedule_sweep
+
 INDUSTRY_CHOICES = [
     ('Construction', 'Construction'),
     ('Plumbing', 'Plumbing'),
@@ -22,12 +28,44 @@ SERVICES_CHOICES = [
     ('Other', 'Other'),
 ]
 
+def choices_mask(values, choices):
+    # One bit per choice, in declaration order: 'Repair' is bit 1 of SERVICES_CHOICES.
+    if not values:
+        return 0
+    if isinstance(values, str):
+        values = values.split(',')
+    positions = {key: i for i, (key, _) in enumerate(choices)}
+    mask = 0
+    for value in values:
+        if value in positions:
+            mask |= 1 << positions[value]
+    return mask
+
+def masks_matching(mask, choices, match='any'):
+    # Every stored mask that satisfies the bitwise predicate. The choice lists are
+    # small, so this turns `col & mask` into an IN lookup that can use the index.
+    if match == 'all':
+        return [m for m in range(1 << len(choices)) if m & mask == mask]
+    return [m for m in range(1 << len(choices)) if m & mask]
+
+class ChoiceMaskMixin:
+    # mask field name -> (multi-select field name, choices)
+    choice_masks = {}
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        for mask_field, (source, choices) in self.choice_masks.items():
+            setattr(self, mask_field, choices_mask(getattr(self, source), choices))
+            if update_fields is not None and source in update_fields:
+                kwargs['update_fields'] = update_fields = set(update_fields) | {mask_field}
+        super().save(*args, **kwargs)
+
 def service_request_image_path(instance, filename):
     # Debug print
     print("Uploading image for:", instance.service_request.user.email, filename)
     return f"service_request_images/{instance.service_request.user.email}/{filename}"
 
-class UserProfile(models.Model):
+class UserProfile(ChoiceMaskMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     is_verified = models.BooleanField(default=False)
     verification_code = models.CharField(max_length=20, blank=True, null=True)
@@ -35,54 +73,278 @@ class UserProfile(models.Model):
     business_name = models.CharField(max_length=255, blank=True, null=True)
     industry = MultiSelectField(choices=INDUSTRY_CHOICES, blank=True, null=True)
     services = MultiSelectField(choices=SERVICES_CHOICES, blank=True, null=True)
+    industry_mask = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    services_mask = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+
+    choice_masks = {
+        'industry_mask': ('industry', INDUSTRY_CHOICES),
+        'services_mask': ('services', SERVICES_CHOICES),
+    }
 
     def __str__(self):
         return self.user.username
 
-class BusinessProfile(models.Model):
+class BusinessProfile(ChoiceMaskMixin, models.Model):
     user_profile = models.OneToOneField(UserProfile, on_delete=models.CASCADE, related_name='business_profile')
     business_name = models.CharField(max_length=255)
     industry = MultiSelectField(choices=INDUSTRY_CHOICES, blank=True, null=True)
     services = MultiSelectField(choices=SERVICES_CHOICES, blank=True, null=True)
+    industry_mask = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    services_mask = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    choice_masks = {
+        'industry_mask': ('industry', INDUSTRY_CHOICES),
+        'services_mask': ('services', SERVICES_CHOICES),
+    }
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='businessprofile_updated_idx'),
+        ]
 
     def __str__(self):
         return f"Business: {self.business_name} ({self.user_profile.user.username})"
 
-class ServiceRequest(models.Model):
+class ServiceRequest(ChoiceMaskMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='related_requests')
     title = models.CharField(max_length=255)
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     location = models.CharField(max_length=255)
+    # Filled from the bundled gazetteer on save; null when the location is not recognised.
+    latitude = models.FloatField(blank=True, null=True, editable=False)
+    longitude = models.FloatField(blank=True, null=True, editable=False)
     services_needed = MultiSelectField(choices=SERVICES_CHOICES, blank=True, null=True)
+    services_mask = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    # Optional: the trades the work falls under, matched against BusinessProfile.industry.
+    industry = MultiSelectField(choices=INDUSTRY_CHOICES, blank=True, null=True)
+    industry_mask = models.PositiveIntegerField(default=0, db_index=True, editable=False)
     business_posted = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    choice_masks = {
+        'services_mask': ('services_needed', SERVICES_CHOICES),
+        'industry_mask': ('industry', INDUSTRY_CHOICES),
+    }
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='servicerequest_created_idx'),
+            models.Index(fields=['latitude', 'longitude'], name='servicerequest_latlng_idx'),
+            models.Index(fields=['updated_at', 'id'], name='servicerequest_updated_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'location' in update_fields:
+            self.latitude, self.longitude = geocode(self.location) or (None, None)
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'latitude', 'longitude'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.title
 
+class Tombstone(models.Model):
+    # Left behind by deleted rows so delta sync can tell clients what to drop.
+    model = models.CharField(max_length=50)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='tombstone_deleted_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.model} {self.object_id} deleted at {self.deleted_at}"
+
 class ServiceRequestImage(models.Model):
     service_request = models.ForeignKey('ServiceRequest', related_name='images', on_delete=models.CASCADE)
-    image = models.ImageField(upload_to=service_request_image_path)
+    image = models.ImageField(upload_to=service_request_image_path, storage=get_image_storage)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # {size: storage name} of the downsized copies (see renditions.py); empty until they are made.
+    renditions = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"Image for {self.service_request.title}"
 
+class ImageBlob(models.Model):
+    """
+    A file in the content-addressed image store (see storage.py) and how many
+    ServiceRequestImages point at it. Blobs at zero are collected by the sweep.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    refcount = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['refcount', 'updated_at'], name='imageblob_refcount_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} references)"
+
+    @classmethod
+    def acquire(cls, name):
+        if not is_blob(name):
+            return
+        if not cls.objects.filter(name=name).update(refcount=F('refcount') + 1, updated_at=timezone.now()):
+            blob, created = cls.objects.get_or_create(name=name, defaults={
+                'refcount': 1, 'size': get_image_storage().size(name)})
+            if not created:
+                cls.objects.filter(id=blob.id).update(refcount=F('refcount') + 1, updated_at=timezone.now())
+
+    @classmethod
+    def release(cls, name):
+        if not is_blob(name):
+            return
+        cls.objects.filter(name=name).update(refcount=F('refcount') - 1, updated_at=timezone.now())
+        transaction.on_commit(schedule_sweep)
+
+class ImageUpload(models.Model):
+    # A resumable upload in progress (see uploads.py); becomes a ServiceRequestImage when finalized.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='image_uploads')
+    service_request = models.ForeignKey(ServiceRequest, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    # Storage name of the partial file, next to where the finished image will go.
+    path = models.CharField(max_length=500)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at'], name='imageupload_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"Upload of {self.filename} ({self.offset}/{self.length})"
+
 class ChatRoom(models.Model):
     room_name = models.CharField(max_length=100, unique=True)
     participants = models.ManyToManyField(User, related_name="chat_rooms")
     service_request = models.ForeignKey(ServiceRequest, on_delete=models.CASCADE, related_name='chat_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized from the newest Message so the inbox never has to look at messages.
+    last_message_content = models.TextField(blank=True, default='')
+    last_message_sender = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    last_message_at = models.DateTimeField(blank=True, null=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity_at', '-id'], name='chatroom_activity_idx'),
+        ]
 
     def __str__(self):
         return f"Chat for {self.service_request.title}"
 
+    @classmethod
+    def record_latest(cls, message):
+        """Make `message` the room's latest unless a newer one is already recorded."""
+        cls.objects.filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.timestamp),
+            id=message.room_id,
+        ).update(
+            last_message_content=message.content,
+            last_message_sender_id=message.sender_id,
+            last_message_at=message.timestamp,
+            last_activity_at=message.timestamp,
+        )
+
+    @classmethod
+    def forget_message(cls, message):
+        """Recompute the room's latest message if `message`, now deleted, may have been it."""
+        latest = Message.objects.filter(room_id=OuterRef('id')).order_by('-timestamp', '-id')
+        return cls.objects.filter(id=message.room_id, last_message_at__lte=message.timestamp).update(
+            last_message_content=Coalesce(Subquery(latest.values('content')[:1]), Value('')),
+            last_message_sender_id=Subquery(latest.values('sender_id')[:1]),
+            last_message_at=Subquery(latest.values('timestamp')[:1]),
+        )
+
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="messages")
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', '-timestamp', '-id'], name='message_room_timestamp_idx'),
+        ]
+
     def __str__(self):
-        return f"Message from {self.sender.username} at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
\ No newline at end of file
+        return f"Message from {self.sender.username} at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
+
+class ReadCursor(models.Model):
+    """
+    How far a participant has read a room. unread_count is kept up to date as
+    messages are written (see signals.messages_saved), so the inbox never
+    counts messages.
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_cursors')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors')
+    # Plain id rather than a foreign key: the message may be deleted later.
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='readcursor_room_user_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read room {self.room_id} up to {self.last_read_message_id}"
+
+    @classmethod
+    def record_messages(cls, messages):
+        """Count new messages as unread for everyone but their sender; sending counts as reading."""
+        sent = {}
+        for message in messages:
+            sent.setdefault((message.room_id, message.sender_id), []).append(message)
+        for (room_id, sender_id), own in sent.items():
+            cls.objects.filter(room_id=room_id).exclude(user_id=sender_id).update(
+                unread_count=F('unread_count') + len(own),
+            )
+        for (room_id, sender_id), own in sent.items():
+            last_sent = max(message.id for message in own)
+            unread = sum(
+                len([message for message in others if message.id > last_sent])
+                for (other_room_id, other_sender_id), others in sent.items()
+                if other_room_id == room_id and other_sender_id != sender_id
+            )
+            cls.objects.filter(room_id=room_id, user_id=sender_id, last_read_message_id__lt=last_sent).update(
+                last_read_message_id=last_sent, unread_count=unread,
+            )
+
+    @classmethod
+    def mark_read(cls, room_id, user_id, message_id):
+        """
+        Move the user's cursor forward to message_id (never back). Returns the
+        cursor, or None if the user has no cursor in the room.
+        """
+        # Clients send any id they like; only the room's own messages may become the cursor,
+        # or an id past the newest message would hide every later one.
+        message_id = Message.objects.filter(room_id=room_id, id__lte=message_id).aggregate(latest=Max('id'))['latest']
+        if message_id is None:
+            return cls.objects.filter(room_id=room_id, user_id=user_id).first()
+        unread = Message.objects.filter(room_id=room_id, id__gt=message_id).exclude(sender_id=user_id).count()
+        cls.objects.filter(room_id=room_id, user_id=user_id, last_read_message_id__lt=message_id).update(
+            last_read_message_id=message_id, unread_count=unread,
+        )
+        return cls.objects.filter(room_id=room_id, user_id=user_id).first()
+
+    @classmethod
+    def open_for(cls, room_id, user_ids):
+        """Cursors for new participants start after the room's existing messages."""
+        latest = Message.objects.filter(room_id=room_id).order_by('-id').values_list('id', flat=True).first() or 0
+        cls.objects.bulk_create(
+            [cls(room_id=room_id, user_id=user_id, last_read_message_id=latest) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
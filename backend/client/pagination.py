@@ -0,0 +1,120 @@
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def is_row_id(value):
+    """An int (not a bool) that fits a SQLite INTEGER primary key."""
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 2 ** 63
+
+
+def encode_cursor(payload):
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+class Page:
+    def __init__(self, rows, next_cursor, previous_cursor):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def response_data(self, results):
+        return {
+            'next': self.next_cursor,
+            'previous': self.previous_cursor,
+            'results': results,
+        }
+
+
+class KeysetPagination:
+    """
+    Cursor pagination over a unique, descending composite key such as
+    ('-created_at', '-id'). Each page is a single indexed range scan instead
+    of an OFFSET, so deep pages cost the same as the first one.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def __init__(self, ordering, page_size=None, max_page_size=None):
+        self.fields = [field.lstrip('-') for field in ordering]
+        self.page_size = page_size or settings.PAGINATION_PAGE_SIZE
+        self.max_page_size = max_page_size or settings.PAGINATION_MAX_PAGE_SIZE
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def key_for(self, row):
+        values = []
+        for field in self.fields:
+            value = row[field] if isinstance(row, dict) else getattr(row, field)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return values
+
+    def parse_key(self, model, values):
+        # Key columns are never null, so neither is any value of a cursor we issued.
+        if not isinstance(values, list) or len(values) != len(self.fields) or None in values:
+            raise InvalidCursor(values)
+        try:
+            # clean() also runs the field's validators, which keep integers within the column's range.
+            return [model._meta.get_field(field).clean(value, None) for field, value in zip(self.fields, values)]
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidCursor(values)
+
+    def range_filter(self, key, after):
+        # Expands (a, b) < (x, y) into a < x OR (a = x AND b < y).
+        lookup = 'lt' if after else 'gt'
+        condition = Q()
+        for i in reversed(range(len(self.fields))):
+            step = Q(**{f'{self.fields[i]}__{lookup}': key[i]})
+            if i < len(self.fields) - 1:
+                step |= Q(**{self.fields[i]: key[i]}) & condition
+            condition = step
+        return condition
+
+    def paginate(self, queryset, request):
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        forward = True
+        if cursor:
+            payload = decode_cursor(cursor)
+            if not isinstance(payload, dict) or payload.get('d') not in ('n', 'p'):
+                raise InvalidCursor(cursor)
+            forward = payload['d'] == 'n'
+            key = self.parse_key(queryset.model, payload.get('k'))
+            queryset = queryset.filter(self.range_filter(key, after=forward))
+
+        ordering = [f'-{field}' if forward else field for field in self.fields]
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if not forward:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or not forward:
+                next_cursor = encode_cursor({'d': 'n', 'k': self.key_for(rows[-1])})
+            if cursor and (forward or has_more):
+                previous_cursor = encode_cursor({'d': 'p', 'k': self.key_for(rows[0])})
+        return Page(rows, next_cursor, previous_cursor)
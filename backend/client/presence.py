@@ -0,0 +1,108 @@
+"""
+Who is connected to which chat room, and who is typing, kept in process
+memory only. Nothing here touches the database.
+
+Each worker process knows about the sockets it holds itself; online/offline
+changes are broadcast to the room's group so clients on other workers hear
+about them too. The presence endpoint answers from the worker serving it.
+"""
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+
+
+class PresenceRegistry:
+    def __init__(self):
+        # room_id -> {user_id: {'username', 'connections', 'seen'}}
+        self._rooms = {}
+        # Consumers update from the event loop, PresenceView reads from a worker thread.
+        self._lock = threading.Lock()
+
+    def join(self, room_id, user_id, username):
+        """Count a connection; True if the user was not online in the room before."""
+        with self._lock:
+            users = self._rooms.setdefault(room_id, {})
+            entry = users.get(user_id)
+            if entry is None:
+                users[user_id] = {'username': username, 'connections': 1, 'seen': time.monotonic()}
+                return True
+            # A user whose heartbeats had stopped counts as coming back online.
+            returned = self._stale(entry)
+            entry['connections'] += 1
+            entry['seen'] = time.monotonic()
+            return returned
+
+    def leave(self, room_id, user_id):
+        """Drop a connection; True if that was the user's last one in the room."""
+        with self._lock:
+            users = self._rooms.get(room_id, {})
+            entry = users.get(user_id)
+            if entry is None:
+                return False
+            entry['connections'] -= 1
+            if entry['connections'] > 0:
+                return False
+            del users[user_id]
+            if not users:
+                del self._rooms[room_id]
+            return True
+
+    def heartbeat(self, room_ids, user_id):
+        now = time.monotonic()
+        with self._lock:
+            for room_id in room_ids:
+                entry = self._rooms.get(room_id, {}).get(user_id)
+                if entry is not None:
+                    entry['seen'] = now
+
+    def online(self, room_ids):
+        """{room_id: [{'id', 'username'}, ...]} for the given rooms, skipping users whose heartbeats stopped."""
+        with self._lock:
+            return {
+                room_id: [
+                    {'id': user_id, 'username': entry['username']}
+                    for user_id, entry in sorted(self._rooms.get(room_id, {}).items())
+                    if not self._stale(entry)
+                ]
+                for room_id in room_ids
+            }
+
+    def clear(self):
+        with self._lock:
+            self._rooms = {}
+
+    @staticmethod
+    def _stale(entry):
+        return time.monotonic() - entry['seen'] > settings.PRESENCE_TIMEOUT
+
+
+class TypingCoalescer:
+    """
+    Collects typing notifications per room and hands them to `broadcast` at
+    most once per CHAT_TYPING_INTERVAL, listing everyone who typed during the
+    interval.
+    """
+    def __init__(self):
+        self._pending = {}
+        self._timers = {}
+
+    def typing(self, room_id, user_id, username, broadcast):
+        self._pending.setdefault(room_id, {})[user_id] = username
+        if room_id not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[room_id] = loop.call_later(
+                settings.CHAT_TYPING_INTERVAL,
+                lambda: asyncio.ensure_future(self.flush(room_id, broadcast)),
+            )
+
+    async def flush(self, room_id, broadcast):
+        self._timers.pop(room_id, None)
+        users = self._pending.pop(room_id, {})
+        if users:
+            await broadcast(room_id, [{'id': user_id, 'username': username} for user_id, username in sorted(users.items())])
+
+
+presence_registry = PresenceRegistry()
+typing_coalescer = TypingCoalescer()
@@ -0,0 +1,148 @@
+"""
+Read-only fast paths for the list serializers in views.py.
+
+Each projection selects exactly the columns a serializer reads (joins
+included) with values(), then formats them with the same rules DRF applies,
+so the rendered JSON is byte-for-byte what the serializer would produce
+without building a model instance or running field machinery per row.
+Keep these in step with the serializers; tests compare the two.
+"""
+from urllib.parse import urljoin
+
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+
+from .models import INDUSTRY_CHOICES, SERVICES_CHOICES, ServiceRequest, ServiceRequestImage
+from .renditions import rendition_urls
+
+
+def format_datetime(value):
+    # rest_framework.fields.DateTimeField.to_representation with ISO 8601 output.
+    if not value:
+        return None
+    value = value.astimezone(timezone.get_current_timezone()).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def format_decimal(value, places=2):
+    # rest_framework.fields.DecimalField with COERCE_DECIMAL_TO_STRING.
+    if value is None:
+        return None
+    return '{:f}'.format(value.quantize(type(value)(1).scaleb(-places)))
+
+
+def choice_formatter(choices):
+    # rest_framework.fields.ChoiceField.to_representation; a multi-select value
+    # holding a single choice comes out as that bare string, as it does there.
+    lookup = {str(key): key for key, _ in choices}
+    def format_choice(value):
+        if value in ('', None):
+            return value
+        return lookup.get(str(value), value)
+    return format_choice
+
+
+format_service = choice_formatter(SERVICES_CHOICES)
+format_industry = choice_formatter(INDUSTRY_CHOICES)
+
+SERVICE_REQUEST_COLUMNS = (
+    'id', 'title', 'description', 'price', 'location', 'services_needed', 'industry',
+    'business_posted', 'created_at', 'user__username',
+)
+BUSINESS_PROFILE_COLUMNS = (
+    'id', 'business_name', 'industry', 'services', 'user_profile__user__username', 'user_profile__user__email',
+)
+CHAT_MESSAGE_COLUMNS = ('id', 'content', 'sender__username', 'sender_id', 'timestamp')
+
+
+def url_builder(storage):
+    # FileSystemStorage.url() spends most of its time in urljoin(); for plain
+    # relative paths that is just base_url + path, so skip it when it's safe.
+    if not isinstance(storage, FileSystemStorage):
+        return storage.url
+    base_url = storage.base_url
+    def url(name):
+        path = filepath_to_uri(name).lstrip('/')
+        if ':' in path or '/.' in f'/{path}' or not base_url.endswith('/'):
+            return urljoin(base_url, path)
+        return base_url + path
+    return url
+
+
+def image_urls(request_ids):
+    """
+    {service_request_id: ([url, ...], [renditions, ...])} in one query, in the
+    order the ORM prefetch returns them.
+    """
+    url = url_builder(ServiceRequestImage._meta.get_field('image').storage)
+    urls = {}
+    rows = ServiceRequestImage.objects.filter(service_request_id__in=request_ids).values_list(
+        'service_request_id', 'image', 'renditions')
+    for request_id, name, renditions in rows:
+        images, image_renditions = urls.setdefault(request_id, ([], []))
+        images.append(url(name) if name else None)
+        image_renditions.append(rendition_urls(renditions, url))
+    return urls
+
+
+def service_request_values(queryset):
+    return queryset.values(*SERVICE_REQUEST_COLUMNS)
+
+
+def render_service_requests(rows):
+    """ServiceRequestListSerializer(many=True).data for values() rows."""
+    rows = list(rows)
+    urls = image_urls([row['id'] for row in rows])
+    return [{
+        'id': row['id'],
+        'title': row['title'],
+        'description': row['description'],
+        'price': format_decimal(row['price']),
+        'location': row['location'],
+        'services_needed': format_service(row['services_needed']),
+        'industry': format_industry(row['industry']),
+        'business_posted': row['business_posted'],
+        'created_at': format_datetime(row['created_at']),
+        'user': row['user__username'],
+        'images': urls.get(row['id'], ([], []))[0],
+        'renditions': urls.get(row['id'], ([], []))[1],
+    } for row in rows]
+
+
+def business_profile_values(queryset):
+    return queryset.values(*BUSINESS_PROFILE_COLUMNS)
+
+
+def render_business_profiles(rows):
+    """BusinessProfileListSerializer(many=True).data for values() rows."""
+    return [{
+        'id': row['id'],
+        'business_name': row['business_name'],
+        'industry': format_industry(row['industry']),
+        'services': format_service(row['services']),
+        'user': row['user_profile__user__username'],
+        'email': row['user_profile__user__email'],
+    } for row in rows]
+
+
+def chat_message_values(queryset):
+    return queryset.values(*CHAT_MESSAGE_COLUMNS)
+
+
+def render_chat_messages(rows):
+    """ChatMessageSerializer(many=True).data for values() rows."""
+    return [{
+        'id': row['id'],
+        'content': row['content'],
+        'sender': {'username': row['sender__username'], 'id': row['sender_id']},
+        'timestamp': format_datetime(row['timestamp']),
+    } for row in rows]
+
+
+def service_requests_by_id(ids):
+    """{id: rendered row} for callers that rank ids themselves (search, distance, matches)."""
+    rows = render_service_requests(service_request_values(ServiceRequest.objects.filter(id__in=ids)))
+    return {row['id']: row for row in rows}
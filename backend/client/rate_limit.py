@@ -0,0 +1,65 @@
+import time
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`; starts full."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self):
+        """Whether take() would succeed now; takes nothing."""
+        self.refill(time.monotonic())
+        return self.tokens >= 1
+
+    def take(self):
+        self.refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        """Seconds until the next token."""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class UserBuckets:
+    """
+    One bucket per user, shared by all of that user's sockets in this process.
+    Buckets that have refilled completely carry no state and are pruned.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._prune_at = 1024
+
+    def bucket(self, user_id, rate, burst):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self._prune_at:
+                self.prune()
+            bucket = self._buckets[user_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def prune(self):
+        now = time.monotonic()
+        self._buckets = {user_id: bucket for user_id, bucket in self._buckets.items() if not bucket.full(now)}
+        self._prune_at = max(1024, 2 * len(self._buckets))
+
+    def clear(self):
+        self._buckets = {}
+
+
+user_buckets = UserBuckets()
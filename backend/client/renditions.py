@@ -0,0 +1,136 @@
+"""
+Downsized copies of service request images for screens that only show
+previews.
+
+Every uploaded image gets one rendition per IMAGE_RENDITIONS entry, scaled to
+fit that many pixels on its longest edge (never enlarged), turned upright and
+re-encoded without EXIF, so GPS tags from the phone are not served either.
+Renditions are produced after the upload commits on a small thread pool:
+Pillow releases the GIL while decoding, resizing and encoding, so threads
+run in parallel and the request thread never waits for them.
+"""
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connections, transaction
+from PIL import Image, ImageOps, features
+
+from .models import ServiceRequestImage
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def output_format():
+    # WebP when this Pillow build can write it, JPEG otherwise.
+    fmt = settings.IMAGE_RENDITION_FORMAT.upper()
+    if fmt == 'WEBP' and not features.check('webp'):
+        return 'JPEG'
+    return fmt
+
+
+def rendition_name(name, size, fmt):
+    stem = os.path.splitext(name)[0]
+    return f'renditions/{stem}_{size}.{EXTENSIONS[fmt]}'
+
+
+def encode(image, edge, fmt, icc_profile):
+    copy = image.copy()
+    copy.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+    # Metadata read from the original (EXIF, XMP, comments) rides along in
+    # info and some encoders write it back out; only the colour profile stays.
+    copy.info = {}
+    buffer = io.BytesIO()
+    options = {'quality': settings.IMAGE_RENDITION_QUALITY}
+    if icc_profile:
+        options['icc_profile'] = icc_profile
+    if fmt == 'JPEG':
+        options.update(optimize=True, progressive=True)
+    else:
+        options['method'] = 4
+    copy.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def render_image(image, force=False):
+    """
+    Write the renditions of a ServiceRequestImage and record their names on it.
+    Images share blobs (see storage.py) and renditions are named after the
+    blob, so a blob that was rendered before is not rendered again unless forced.
+    """
+    fmt = output_format()
+    names = {size: rendition_name(image.image.name, size, fmt) for size in settings.IMAGE_RENDITIONS}
+    # Renditions are derived files, not blobs: they go to the plain storage.
+    storage = default_storage
+    if not force and all(storage.exists(name) for name in names.values()):
+        image.renditions = names
+        image.save(update_fields=['renditions'])
+        return names
+
+    largest = max(settings.IMAGE_RENDITIONS.values())
+    with image.image.storage.open(image.image.name, 'rb') as f:
+        original = Image.open(f)
+        # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale, much faster than at
+        # full size, as long as the result still covers the largest rendition.
+        original.draft('RGB', (largest, largest))
+        # A CMYK profile no longer applies once the pixels are converted to RGB.
+        icc_profile = original.info.get('icc_profile') if original.mode != 'CMYK' else None
+        original = ImageOps.exif_transpose(original)
+        mode = 'RGBA' if fmt != 'JPEG' and original.has_transparency_data else 'RGB'
+        if original.mode != mode:
+            original = original.convert(mode)
+
+    for size, edge in settings.IMAGE_RENDITIONS.items():
+        if storage.exists(names[size]):
+            storage.delete(names[size])
+        names[size] = storage.save(names[size], ContentFile(encode(original, edge, fmt, icc_profile)))
+    image.renditions = names
+    image.save(update_fields=['renditions'])
+    return names
+
+
+def render_image_id(image_id, force=False):
+    """Worker entry point: renders one image by id and releases the thread's connection."""
+    close_old_connections()
+    try:
+        image = ServiceRequestImage.objects.filter(id=image_id).first()
+        if image is None:
+            return False
+        render_image(image, force)
+        return True
+    except Exception:
+        logger.exception('Could not render image %s', image_id)
+        return False
+    finally:
+        connections.close_all()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_RENDITION_WORKERS,
+                                           thread_name_prefix='renditions')
+        return _executor
+
+
+def schedule_renditions(image_id):
+    """Render an image in the background once the transaction that created it has committed."""
+    transaction.on_commit(lambda: executor().submit(render_image_id, image_id))
+
+
+def rendition_urls(renditions, url):
+    """{size: url} for a renditions field, or None while they are still being made."""
+    if not renditions:
+        return None
+    return {size: url(name) for size, name in renditions.items()}
@@ -1,7 +1,8 @@
 from django.urls import path, include
-from .consumer import ChatConsumer
+from .consumer import ChatConsumer, UserChatConsumer
 
 # the empty string routes to ChatConsumer, which manages the chat functionality.
 websocket_urlpatterns = [
+    path("chat/", UserChatConsumer.as_asgi()),
     path("chat/<str:room_name>/", ChatConsumer.as_asgi()),
 ]
\ No newline at end of file
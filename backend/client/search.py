@@ -0,0 +1,151 @@
+import html
+import math
+import re
+
+from django.db import connection
+
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, is_row_id
+
+FTS_TABLE = 'client_servicerequest_fts'
+CONTENT_TABLE = 'client_servicerequest'
+
+# Title matches count for more than description matches.
+BM25_WEIGHTS = (10.0, 1.0)
+HIGHLIGHT_OPEN = '<mark>'
+HIGHLIGHT_CLOSE = '</mark>'
+# FTS5 marks matches with these private-use characters; the text around them
+# is user input, so it is escaped before they become the tags above.
+MATCH_OPEN = '\ue000'
+MATCH_CLOSE = '\ue001'
+SNIPPET_TOKENS = 16
+
+# External-content FTS5 table: the index stores only tokens, the text stays in
+# client_servicerequest. Triggers keep it in sync row by row.
+CREATE_TABLE_SQL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+    title, description,
+    content='{CONTENT_TABLE}', content_rowid='id',
+    tokenize='porter unicode61'
+)
+"""
+
+TRIGGERS_SQL = {
+    f'{FTS_TABLE}_ai': f"""
+CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {CONTENT_TABLE} BEGIN
+    INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+END
+""",
+    f'{FTS_TABLE}_ad': f"""
+CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {CONTENT_TABLE} BEGIN
+    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+END
+""",
+    f'{FTS_TABLE}_au': f"""
+CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, description ON {CONTENT_TABLE} BEGIN
+    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+    INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+END
+""",
+}
+
+
+def install_search_index(schema_connection=None):
+    """
+    Create the FTS table and its sync triggers if they are missing. SQLite
+    drops triggers whenever a migration rebuilds client_servicerequest, so
+    this also runs after every migrate and rebuilds the index if it had to
+    put triggers back.
+    """
+    conn = schema_connection or connection
+    if conn.vendor != 'sqlite':
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [CONTENT_TABLE]
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        cursor.execute(CREATE_TABLE_SQL)
+        for name, sql in TRIGGERS_SQL.items():
+            cursor.execute(sql)
+        if not existing.issuperset(TRIGGERS_SQL):
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def uninstall_search_index(schema_connection=None):
+    conn = schema_connection or connection
+    if conn.vendor != 'sqlite':
+        return
+    with conn.cursor() as cursor:
+        for name in TRIGGERS_SQL:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def rebuild_search_index():
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        cursor.execute(f'SELECT count(*) FROM {FTS_TABLE}')
+        return cursor.fetchone()[0]
+
+
+def build_match_query(text):
+    # Quote every term so user input can never be parsed as FTS5 syntax; the
+    # last term is a prefix match so results show up while the user types.
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def render_highlights(text):
+    """highlight()/snippet() output as HTML: escaped text, matches in <mark>."""
+    # A marker character a user typed can at worst add a stray <mark>, never other markup.
+    return html.escape(text).replace(MATCH_OPEN, HIGHLIGHT_OPEN).replace(MATCH_CLOSE, HIGHLIGHT_CLOSE)
+
+
+def search_service_requests(text, page_size, cursor=None):
+    """
+    Return (hits, next_cursor) where hits are dicts with id, score, title and
+    snippet, best BM25 score first. Pages continue from a (score, id) key.
+    """
+    match = build_match_query(text)
+    if match is None:
+        return [], None
+
+    params = [*BM25_WEIGHTS, MATCH_OPEN, MATCH_CLOSE,
+              MATCH_OPEN, MATCH_CLOSE, SNIPPET_TOKENS, match]
+    after = ''
+    if cursor:
+        key = decode_cursor(cursor)
+        # Scores are always encoded as floats; anything else could overflow SQLite's integers.
+        if not (isinstance(key, list) and len(key) == 2
+                and isinstance(key[0], float) and math.isfinite(key[0]) and is_row_id(key[1])):
+            raise InvalidCursor(cursor)
+        after = 'AND (score > %s OR (score = %s AND rowid > %s))'
+        params += [key[0], key[0], key[1]]
+    params.append(page_size + 1)
+
+    with connection.cursor() as db:
+        db.execute(f"""
+            SELECT * FROM (
+                SELECT rowid, bm25({FTS_TABLE}, %s, %s) AS score,
+                       highlight({FTS_TABLE}, 0, %s, %s) AS title,
+                       snippet({FTS_TABLE}, 1, %s, %s, '…', %s) AS snippet
+                FROM {FTS_TABLE}
+                WHERE {FTS_TABLE} MATCH %s
+            )
+            WHERE 1 = 1 {after}
+            ORDER BY score, rowid
+            LIMIT %s
+        """, params)
+        rows = db.fetchall()
+
+    hits = [{'id': r[0], 'score': r[1], 'title': render_highlights(r[2]), 'snippet': render_highlights(r[3])}
+            for r in rows[:page_size]]
+    next_cursor = None
+    if len(rows) > page_size:
+        next_cursor = encode_cursor([hits[-1]['score'], hits[-1]['id']])
+    return hits, next_cursor
@@ -1,7 +1,16 @@
-from django.db.models.signals import post_save
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile, BusinessProfile
+from django.utils import timezone
+from .models import UserProfile, BusinessProfile, ServiceRequest, ServiceRequestImage, ImageBlob, ImageUpload, ChatRoom, Message, ReadCursor, Tombstone
+from .matching import match_index
+from .cache import invalidate, chat_rooms_namespace, SERVICE_REQUESTS, BUSINESS_PROFILES
+from .token_cache import token_cache
+from .renditions import schedule_renditions
+from .uploads import delete_partial_file
+from rest_framework.authtoken.models import Token
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -22,3 +31,159 @@ def create_business_profile(sender, instance, **kwargs):
     else:
         # Optionally, delete BusinessProfile if user is no longer a business owner
         BusinessProfile.objects.filter(user_profile=instance).delete()
+
+# The match index only hears about rows once they are committed; a rolled-back
+# save must not leave a phantom match behind.
+@receiver(post_save, sender=ServiceRequest)
+def index_service_request(sender, instance, **kwargs):
+    transaction.on_commit(partial(match_index.add_request, instance.id, instance.user_id, instance.services_mask,
+                                  instance.industry_mask, instance.created_at, instance.latitude, instance.longitude))
+
+@receiver(post_delete, sender=ServiceRequest)
+def unindex_service_request(sender, instance, **kwargs):
+    transaction.on_commit(partial(match_index.remove_request, instance.id))
+
+@receiver(post_save, sender=BusinessProfile)
+def index_business_profile(sender, instance, **kwargs):
+    transaction.on_commit(partial(match_index.add_business, instance.id, instance.user_profile.user_id,
+                                  instance.services_mask, instance.industry_mask))
+
+@receiver(post_delete, sender=BusinessProfile)
+def unindex_business_profile(sender, instance, **kwargs):
+    transaction.on_commit(partial(match_index.remove_business, instance.id))
+
+def images_saved(images):
+    """
+    Blob references and renditions for new images. Called for every single
+    save, and directly by code that inserts images in bulk.
+    """
+    for image in images:
+        ImageBlob.acquire(image.image.name)
+        if image.image:
+            schedule_renditions(image.id)
+
+@receiver(post_save, sender=ServiceRequestImage)
+def image_saved(sender, instance, created, **kwargs):
+    if created:
+        images_saved([instance])
+
+@receiver(post_delete, sender=ServiceRequestImage)
+def release_image_blob(sender, instance, **kwargs):
+    ImageBlob.release(instance.image.name)
+
+@receiver(post_delete, sender=ImageUpload)
+def remove_partial_upload(sender, instance, **kwargs):
+    delete_partial_file(instance)
+
+# Response cache invalidation: each model only drops the listings it appears in.
+@receiver([post_save, post_delete], sender=ServiceRequest)
+@receiver([post_save, post_delete], sender=ServiceRequestImage)
+def invalidate_service_requests(sender, **kwargs):
+    invalidate(SERVICE_REQUESTS)
+
+@receiver([post_save, post_delete], sender=BusinessProfile)
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_business_profiles(sender, **kwargs):
+    invalidate(BUSINESS_PROFILES)
+
+@receiver(post_save, sender=User)
+def invalidate_usernames(sender, instance, update_fields=None, **kwargs):
+    # Usernames and emails are embedded in both listings; logins only touch last_login.
+    if update_fields is None or {'username', 'email'} & set(update_fields):
+        invalidate(SERVICE_REQUESTS, BUSINESS_PROFILES)
+        invalidate_inboxes(room_participant_ids(chatroom__participants=instance))
+
+# Cached tokens carry a copy of their user, so any change to the user (most
+# importantly deactivation) drops them; logins only touch last_login.
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, update_fields=None, **kwargs):
+    if not created and (update_fields is None or set(update_fields) - {'last_login'}):
+        token_cache.invalidate(*Token.objects.filter(user=instance).values_list('key', flat=True))
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+# Per-user inbox versions: anything shown in chat-rooms/ bumps the version of
+# every participant of the affected rooms.
+def invalidate_inboxes(user_ids):
+    namespaces = {chat_rooms_namespace(user_id) for user_id in user_ids}
+    if namespaces:
+        invalidate(*namespaces)
+
+def room_participant_ids(**room_filter):
+    return ChatRoom.participants.through.objects.filter(**room_filter).values_list('user_id', flat=True)
+
+def messages_saved(messages):
+    """
+    Bookkeeping for newly written messages: the room's denormalized latest
+    message, participants' unread counts and their inbox versions. Called for
+    every single save, and directly by code that inserts messages in bulk.
+    """
+    latest = {}
+    for message in messages:
+        if message.room_id not in latest or message.timestamp >= latest[message.room_id].timestamp:
+            latest[message.room_id] = message
+    for message in latest.values():
+        ChatRoom.record_latest(message)
+    ReadCursor.record_messages(messages)
+    invalidate_inboxes(room_participant_ids(chatroom_id__in=list(latest)))
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    if created:
+        messages_saved([instance])
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    if ChatRoom.forget_message(instance):
+        invalidate_inboxes(room_participant_ids(chatroom_id=instance.room_id))
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def invalidate_inbox_on_membership(sender, instance, action, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear') and isinstance(instance, ChatRoom):
+        invalidate_inboxes(set(pk_set or ()) | set(room_participant_ids(chatroom_id=instance.id)))
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def sync_read_cursors(sender, instance, action, pk_set, **kwargs):
+    if action == 'post_add':
+        if isinstance(instance, ChatRoom):
+            ReadCursor.open_for(instance.id, pk_set)
+        else:
+            for room_id in pk_set:
+                ReadCursor.open_for(room_id, [instance.id])
+    elif action == 'post_remove':
+        if isinstance(instance, ChatRoom):
+            ReadCursor.objects.filter(room_id=instance.id, user_id__in=pk_set).delete()
+        else:
+            ReadCursor.objects.filter(room_id__in=pk_set, user_id=instance.id).delete()
+    elif action == 'pre_clear':
+        if isinstance(instance, ChatRoom):
+            ReadCursor.objects.filter(room_id=instance.id).delete()
+        else:
+            ReadCursor.objects.filter(user_id=instance.id).delete()
+
+@receiver([post_save, pre_delete], sender=ChatRoom)
+def invalidate_inbox_on_room(sender, instance, **kwargs):
+    invalidate_inboxes(room_participant_ids(chatroom_id=instance.id))
+
+@receiver([post_save, pre_delete], sender=ServiceRequest)
+def invalidate_inbox_on_request(sender, instance, **kwargs):
+    invalidate_inboxes(room_participant_ids(chatroom__service_request_id=instance.id))
+
+@receiver([post_save, post_delete], sender=ServiceRequestImage)
+def invalidate_inbox_on_image(sender, instance, **kwargs):
+    invalidate_inboxes(room_participant_ids(chatroom__service_request_id=instance.service_request_id))
+
+# Delta sync: deletions leave tombstones, image changes count as a change to the request.
+@receiver(post_delete, sender=ServiceRequest)
+def tombstone_service_request(sender, instance, **kwargs):
+    Tombstone.objects.create(model='service_request', object_id=instance.id)
+
+@receiver(post_delete, sender=BusinessProfile)
+def tombstone_business_profile(sender, instance, **kwargs):
+    Tombstone.objects.create(model='business_profile', object_id=instance.id)
+
+@receiver([post_save, post_delete], sender=ServiceRequestImage)
+def touch_service_request(sender, instance, **kwargs):
+    ServiceRequest.objects.filter(id=instance.service_request_id).update(updated_at=timezone.now())
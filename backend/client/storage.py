@@ -0,0 +1,233 @@
+"""
+Content-addressed storage for service request images.
+
+A saved file is hashed while it is copied into place and stored once, as
+blobs/<d0d1>/<d2d3>/<sha256 digest><ext>, whatever name it was uploaded
+under; saving the same bytes again hands back the existing blob. A blob's
+content never changes, so its URL can be cached forever.
+
+ImageBlob rows count the ServiceRequestImages that point at each blob (kept
+by the signals in signals.py). sweep_blobs() deletes blobs nobody has pointed
+at for BLOB_GC_GRACE seconds, together with their renditions. It runs on a
+background timer once released blobs are due, and from
+`manage.py gc_image_blobs`, which also finds files that never got a row.
+
+Saving a blob that already exists only touches its file, so the sweep also
+leaves files modified within the grace period alone. The two meet on a lock
+file next to blobs/: saves hold it shared, the sweep holds it exclusively
+from its mtime check until the files are gone, across processes.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import locks
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+BLOB_PREFIX = 'blobs/'
+# Outside blobs/, where the orphan scan would take it for a blob.
+LOCK_NAME = '.blobs.lock'
+HASH_BUFFER = 64 * 1024
+
+
+def blob_name(digest, ext):
+    return f'{BLOB_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{ext.lower()}'
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_PREFIX)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # Names are digests: an existing file already has the right content.
+        return name
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1]
+        digest = hashlib.sha256()
+        if hasattr(content, 'temporary_file_path'):
+            # Large uploads are already on disk: hash them there, then move them.
+            with open(content.temporary_file_path(), 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_BUFFER), b''):
+                    digest.update(chunk)
+            return self._place(content.temporary_file_path(), blob_name(digest.hexdigest(), ext))
+
+        directory = self.path(BLOB_PREFIX)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks(HASH_BUFFER):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    f.write(chunk)
+            return self._place(tmp_path, blob_name(digest.hexdigest(), ext))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def adopt(self, path, ext):
+        """Hash a local file and move it into the store; returns its blob name."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_BUFFER), b''):
+                digest.update(chunk)
+        return self._place(path, blob_name(digest.hexdigest(), ext))
+
+    def _place(self, path, name):
+        full_path = self.path(name)
+        with blob_lock(shared=True):
+            try:
+                # Already stored? Touching it keeps a sweep that is about to
+                # collect the blob away from it (see sweep_blobs).
+                os.utime(full_path)
+            except FileNotFoundError:
+                pass
+            else:
+                os.remove(path)
+                return name
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            file_move_safe(path, full_path, allow_overwrite=True)
+            # A move keeps the source's mtime; the sweep must see a fresh file.
+            os.utime(full_path)
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+
+image_storage = ContentAddressedStorage()
+
+
+def get_image_storage():
+    return image_storage
+
+
+@contextmanager
+def blob_lock(shared=False):
+    """Saves share this lock; the sweep takes it alone while it deletes."""
+    path = image_storage.path(LOCK_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        locks.lock(f, locks.LOCK_SH if shared else locks.LOCK_EX)
+        try:
+            yield
+        finally:
+            locks.unlock(f)
+
+
+def delete_blob_files(name):
+    from .renditions import EXTENSIONS, rendition_name
+    image_storage.delete(name)
+    for size in settings.IMAGE_RENDITIONS:
+        for fmt in EXTENSIONS:
+            default_storage.delete(rendition_name(name, size, fmt))
+
+
+def sweep_blobs(scan=False):
+    """
+    Delete blobs unreferenced for BLOB_GC_GRACE seconds; with scan, also files
+    under blobs/ that have no ImageBlob row (bulk-inserted images, crashes
+    between saving a file and its row). Returns the number of blobs deleted.
+    """
+    from .models import ImageBlob, ServiceRequestImage
+    cutoff = timezone.now() - timedelta(seconds=settings.BLOB_GC_GRACE)
+    deleted = 0
+    for blob in ImageBlob.objects.filter(refcount__lte=0, updated_at__lt=cutoff):
+        # Rows written without signals (bulk_create) are not counted; recount before trusting zero.
+        references = ServiceRequestImage.objects.filter(image=blob.name).count()
+        if references:
+            ImageBlob.objects.filter(id=blob.id).update(refcount=references)
+            continue
+        with blob_lock():
+            # Saved again meanwhile: keep the row too, so a later sweep still sees the blob.
+            if recently_touched(blob.name):
+                continue
+            if ImageBlob.objects.filter(id=blob.id, refcount__lte=0, updated_at__lt=cutoff).delete()[0]:
+                delete_blob_files(blob.name)
+                deleted += 1
+    if scan:
+        deleted += sweep_orphan_files()
+    return deleted
+
+
+def recently_touched(name):
+    try:
+        return time.time() - os.path.getmtime(image_storage.path(name)) < settings.BLOB_GC_GRACE
+    except FileNotFoundError:
+        return False
+
+
+def sweep_orphan_files():
+    from .models import ImageBlob, ServiceRequestImage
+    root = image_storage.path(BLOB_PREFIX)
+    deleted = 0
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            full_path = os.path.join(directory, filename)
+            name = BLOB_PREFIX + os.path.relpath(full_path, root).replace(os.sep, '/')
+            if recently_touched(name):
+                continue
+            if name.endswith('.tmp'):
+                # Left behind by a save that crashed halfway.
+                os.remove(full_path)
+                continue
+            if ImageBlob.objects.filter(name=name).exists():
+                continue
+            references = ServiceRequestImage.objects.filter(image=name).count()
+            if references:
+                ImageBlob.objects.get_or_create(name=name, defaults={
+                    'refcount': references, 'size': os.path.getsize(full_path)})
+                continue
+            with blob_lock():
+                if recently_touched(name):
+                    continue
+                delete_blob_files(name)
+                deleted += 1
+    return deleted
+
+
+_sweep_lock = threading.Lock()
+_sweep_timer = None
+
+
+def run_sweep():
+    global _sweep_timer
+    with _sweep_lock:
+        _sweep_timer = None
+    close_old_connections()
+    try:
+        from .models import ImageBlob
+        sweep_blobs()
+        # Blobs released after this sweep was scheduled are not due yet.
+        if ImageBlob.objects.filter(refcount__lte=0).exists():
+            schedule_sweep()
+    except Exception:
+        logger.exception('Blob sweep failed')
+    finally:
+        connections.close_all()
+
+
+def schedule_sweep():
+    """Sweep in the background once a blob released now is due, unless a sweep is already pending."""
+    global _sweep_timer
+    with _sweep_lock:
+        if _sweep_timer is not None:
+            return
+        _sweep_timer = threading.Timer(settings.BLOB_GC_GRACE + 1, run_sweep)
+        _sweep_timer.daemon = True
+        _sweep_timer.start()
@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import BusinessProfile, ServiceRequest, Tombstone
+from .pagination import InvalidCursor, decode_cursor, encode_cursor
+
+SERVICE_REQUESTS = 'service_requests'
+BUSINESS_PROFILES = 'business_profiles'
+DELETED = 'deleted'
+
+STREAMS = {
+    SERVICE_REQUESTS: ('updated_at', ServiceRequest.objects.select_related('user').prefetch_related('images')),
+    BUSINESS_PROFILES: ('updated_at', BusinessProfile.objects.select_related('user_profile__user')),
+    DELETED: ('deleted_at', Tombstone.objects.all()),
+}
+
+
+def parse_sync_token(token):
+    """{stream: (timestamp, id)} from a token; an empty token starts from scratch."""
+    if not token:
+        return {}
+    payload = decode_cursor(token)
+    if not isinstance(payload, dict):
+        raise InvalidCursor(token)
+    positions = {}
+    for stream in STREAMS:
+        if stream not in payload:
+            continue
+        try:
+            stamp, pk = payload[stream]
+            stamp = parse_datetime(stamp)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise InvalidCursor(token)
+        if stamp is None:
+            raise InvalidCursor(token)
+        positions[stream] = (stamp, pk)
+    return positions
+
+
+def collect_changes(token, limit=None):
+    """
+    Rows changed (or deleted) after the positions in `token`, at most `limit`
+    per stream, plus the token to send next time.
+
+    Once a stream is caught up its position is pulled back to
+    SYNC_OVERLAP_SECONDS before now: a row saved just before the request but
+    committed just after it still has an older timestamp, and would otherwise
+    be skipped forever. Clients apply rows as idempotent upserts, so the
+    occasional repeat is harmless.
+    """
+    limit = limit or settings.SYNC_PAGE_SIZE
+    positions = parse_sync_token(token)
+    horizon = (timezone.now() - timedelta(seconds=settings.SYNC_OVERLAP_SECONDS), 0)
+    changes, next_positions, has_more = {}, {}, False
+
+    for stream, (field, queryset) in STREAMS.items():
+        position = positions.get(stream)
+        if position:
+            stamp, pk = position
+            queryset = queryset.filter(Q(**{f'{field}__gt': stamp}) | Q(**{field: stamp, 'id__gt': pk}))
+        rows = list(queryset.order_by(field, 'id')[:limit + 1])
+        if len(rows) > limit:
+            rows = rows[:limit]
+            has_more = True
+            position = (getattr(rows[-1], field), rows[-1].id)
+        else:
+            last = (getattr(rows[-1], field), rows[-1].id) if rows else position
+            position = min(last, horizon) if last else horizon
+        changes[stream] = rows
+        next_positions[stream] = [position[0].isoformat(), position[1]]
+
+    return changes, encode_cursor(next_positions), has_more
@@ -1,11 +1,73 @@
-from django.test import TestCase
-from rest_framework.test import APIClient
+import asyncio
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .email_utils import send_verification_email
-from .models import UserProfile, ServiceRequest
-from rest_framework import status
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
-import os
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+from PIL import Image
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .cache import cache_stats
+from .channel_layers import SQLiteChannelLayer
+from .chat_buffer import MessageWriteBuffer
+from .consumer import ChatConsumer, UserChatConsumer
+from .email_utils import send_verification_email
+from .geo import haversine_km
+from .matching import (
+    DISTANCE_SCALE_KM, DISTANCE_WEIGHT, OVERLAP_WEIGHT, MatchIndex, match_index, overlap, recency,
+)
+from .models import (
+    INDUSTRY_CHOICES, SERVICES_CHOICES, BusinessProfile, ChatRoom, ImageBlob, ImageUpload, Message,
+    ReadCursor, ServiceRequest, ServiceRequestImage, UserProfile, choices_mask,
+)
+from .pagination import encode_cursor
+from .presence import presence_registry
+from .projections import (
+    business_profile_values, chat_message_values, render_business_profiles,
+    render_chat_messages, render_service_requests, service_request_values,
+)
+from .rate_limit import user_buckets
+from .renditions import rendition_name
+from .storage import blob_lock, blob_name, image_storage, sweep_blobs
+from .token_auth_middleware import get_user
+from .token_cache import token_cache
+from .uploads import finalize_upload, locked_partial_file
+from .views import BusinessProfileListSerializer, ChatMessageSerializer, ServiceRequestListSerializer
 
 User = get_user_model()
 
@@ -168,8 +230,15 @@ class ServiceRequestTestCase(TestCase):
         self.token = login_response.data['key']
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
 
-        # Create a dummy image for upload
-        self.image = SimpleUploadedFile("test_image.jpg", b"file_content", content_type="image/jpeg")
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.image = self.jpeg("test_image.jpg")
+
+    def jpeg(self, name, color='white'):
+        buffer = io.BytesIO()
+        Image.new('RGB', (32, 32), color).save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/jpeg")
 
     def test_create_service_request_with_image(self):
         service_data = {
@@ -190,3 +259,1463 @@ class ServiceRequestTestCase(TestCase):
         self.assertTrue(os.path.exists(sr.images.first().image.path))
         # Clean up the created file
         os.remove(sr.images.first().image.path)
+
+    def test_invalid_requests_write_nothing(self):
+        base = {'title': 'Leaky Faucet', 'description': 'Dripping', 'location': '123 Main St'}
+        for data, error in [
+            ({'image1': SimpleUploadedFile('notes.jpg', b'file_content')}, 'notes.jpg is not an image'),
+            ({'services_needed': '["Repair", "Juggling"]'}, 'Unknown services: Juggling'),
+            ({'price': 'cheap'}, 'price: '),
+        ]:
+            response = self.client.post(self.service_request_url, {**base, 'image0': self.jpeg('ok.jpg'), **data}, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(error, response.data['error'])
+        for services, error in [(5, 'services_needed must be a list'), ({'a': 1}, 'services_needed must be a list'),
+                                ([['Repair']], 'must be a list of strings'), ('["Repair", 3]', 'must be a list of strings')]:
+            response = self.client.post(self.service_request_url, {**base, 'services_needed': services}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, services)
+            self.assertIn(error, response.data['error'])
+        self.assertFalse(ServiceRequest.objects.exists())
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'blobs')))
+
+    def test_images_are_inserted_together_or_not_at_all(self):
+        data = {'title': 'Tiles', 'description': 'Bathroom', 'location': 'x', 'services_needed': '["Renovation"]',
+                'industry': '["Construction"]', 'image0': self.jpeg('a.jpg', 'red'), 'image1': self.jpeg('b.jpg', 'green'), 'image2': self.jpeg('c.jpg', 'blue')}
+        with mock.patch.object(ServiceRequestImage.objects, 'bulk_create', side_effect=IntegrityError('boom')):
+            with self.assertRaises(IntegrityError):
+                self.client.post(self.service_request_url, data, format='multipart')
+        self.assertFalse(ServiceRequest.objects.exists())
+        # The files stay for the sweep: another request may share them.
+        self.assertEqual(ImageBlob.objects.filter(refcount=0).count(), 3)
+        self.assertTrue(all(image_storage.exists(name) for name in ImageBlob.objects.values_list('name', flat=True)))
+
+        for upload in data.values():
+            if hasattr(upload, 'seek'):
+                upload.seek(0)
+        response = self.client.post(self.service_request_url, data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        sr = ServiceRequest.objects.get(id=response.data['id'])
+        self.assertEqual(sr.services_needed, ['Renovation'])
+        self.assertEqual((sr.industry, sr.industry_mask), (['Construction'], 1))
+        self.assertEqual(ImageBlob.objects.filter(refcount=1).count(), 3)
+        self.assertEqual(sr.images.count(), 3)
+        with override_settings(BLOB_GC_GRACE=0):
+            self.assertEqual(sweep_blobs(), 0)
+
+    def test_rolled_back_files_are_swept(self):
+        data = {'title': 'Tiles', 'description': 'Bathroom', 'location': 'x', 'image0': self.jpeg('a.jpg', 'red')}
+        with mock.patch.object(ServiceRequestImage.objects, 'bulk_create', side_effect=IntegrityError('boom')):
+            with self.assertRaises(IntegrityError):
+                self.client.post(self.service_request_url, data, format='multipart')
+        name = ImageBlob.objects.get().name
+        with override_settings(BLOB_GC_GRACE=0):
+            self.assertEqual(sweep_blobs(), 1)
+        self.assertFalse(image_storage.exists(name))
+
+class ServiceRequestListPaginationTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.list_url = '/api/service-requests/'
+        self.user = User.objects.create_user(username='lister', email='lister@example.com', password='Testpass123!')
+        for i in range(5):
+            sr = ServiceRequest.objects.create(
+                user=self.user,
+                title=f'Request {i}',
+                description='Needs work',
+                location='123 Main St',
+                services_needed=['Repair'],
+            )
+            ServiceRequestImage.objects.create(service_request=sr, image=f'service_request_images/lister@example.com/{i}.jpg')
+
+    def test_pages_follow_cursors_without_overlap(self):
+        response = self.client.get(self.list_url, {'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['previous'])
+        titles = [row['title'] for row in response.data['results']]
+        self.assertEqual(titles, ['Request 4', 'Request 3'])
+
+        seen = list(titles)
+        cursor = response.data['next']
+        while cursor:
+            response = self.client.get(self.list_url, {'page_size': 2, 'cursor': cursor})
+            seen.extend(row['title'] for row in response.data['results'])
+            cursor = response.data['next']
+        self.assertEqual(seen, [f'Request {i}' for i in range(4, -1, -1)])
+
+        previous = self.client.get(self.list_url, {'page_size': 2, 'cursor': response.data['previous']})
+        self.assertEqual([row['title'] for row in previous.data['results']], ['Request 2', 'Request 1'])
+
+    def test_page_uses_fixed_number_of_queries(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(self.list_url, {'page_size': 5})
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(len(response.data['results'][0]['images']), 1)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(self.list_url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+        # Well-formed cursors whose key has the wrong types or an out-of-range id.
+        for key in [[[1], 1], [{'a': 1}, 1], ['2024-01-01T00:00:00Z', 10 ** 30], [None, 1]]:
+            response = self.client.get(self.list_url, {'cursor': encode_cursor({'d': 'n', 'k': key})})
+            self.assertEqual(response.status_code, 400, key)
+
+class ChoiceMaskFilterTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        for name, industry, services in [
+            ('plumber', ['Plumbing'], ['Repair', 'Installation']),
+            ('sparky', ['Electrical'], ['Repair']),
+            ('builder', ['Construction', 'Plumbing'], ['Renovation']),
+        ]:
+            user = User.objects.create_user(username=name, email=f'{name}@example.com', password='Testpass123!')
+            profile = user.userprofile
+            profile.is_business_owner = True
+            profile.business_name = name.title()
+            profile.industry = industry
+            profile.services = services
+            profile.save()
+        self.requester = User.objects.create_user(username='requester', email='r@example.com', password='Testpass123!')
+        ServiceRequest.objects.create(user=self.requester, title='Fix sink', description='d', location='x',
+                                      services_needed=['Repair'], industry=['Plumbing'])
+        ServiceRequest.objects.create(user=self.requester, title='New kitchen', description='d', location='x',
+                                      services_needed=['Renovation', 'Design'], industry=['Construction', 'Electrical'])
+
+    def test_masks_are_kept_in_sync_on_save(self):
+        profile = BusinessProfile.objects.get(business_name='Plumber')
+        self.assertEqual(profile.industry_mask, choices_mask(['Plumbing'], INDUSTRY_CHOICES))
+        profile.services = ['Inspection']
+        profile.save(update_fields=['services'])
+        profile.refresh_from_db()
+        self.assertEqual(profile.services_mask, choices_mask(['Inspection'], SERVICES_CHOICES))
+
+    def test_business_profiles_any_and_all(self):
+        response = self.client.get('/api/business-profiles/', {'industry': 'Plumbing'})
+        self.assertEqual(sorted(p['business_name'] for p in response.data), ['Builder', 'Plumber'])
+        response = self.client.get('/api/business-profiles/', {'industry': 'Plumbing', 'services': 'Repair'})
+        self.assertEqual([p['business_name'] for p in response.data], ['Plumber'])
+        response = self.client.get('/api/business-profiles/', {'services': 'Repair,Installation', 'match': 'all'})
+        self.assertEqual([p['business_name'] for p in response.data], ['Plumber'])
+
+    def test_service_requests_filter(self):
+        response = self.client.get('/api/service-requests/', {'services': 'Design,Repair'})
+        self.assertEqual(len(response.data['results']), 2)
+        response = self.client.get('/api/service-requests/', {'services': 'Design,Renovation', 'match': 'all'})
+        self.assertEqual([r['title'] for r in response.data['results']], ['New kitchen'])
+        response = self.client.get('/api/service-requests/', {'industry': 'Electrical'})
+        self.assertEqual([r['title'] for r in response.data['results']], ['New kitchen'])
+        response = self.client.get('/api/service-requests/', {'industry': 'Plumbing', 'services': 'Renovation'})
+        self.assertEqual(response.data['results'], [])
+        self.assertEqual(self.client.get('/api/service-requests/', {'industry': 'Dancing'}).status_code, 400)
+
+    def test_unknown_choice_is_rejected(self):
+        response = self.client.get('/api/business-profiles/', {'services': 'Juggling'})
+        self.assertEqual(response.status_code, 400)
+
+class ServiceRequestSearchTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.search_url = '/api/service-requests/search/'
+        self.user = User.objects.create_user(username='searcher', email='searcher@example.com', password='Testpass123!')
+        self.faucet = ServiceRequest.objects.create(user=self.user, title='Leaky faucet', description='Kitchen faucet drips all night', location='x')
+        self.roof = ServiceRequest.objects.create(user=self.user, title='Roof repair', description='Shingles blew off, maybe a leak', location='x')
+        ServiceRequest.objects.create(user=self.user, title='Paint fence', description='White picket fence', location='x')
+
+    def test_ranks_title_matches_first_and_highlights(self):
+        response = self.client.get(self.search_url, {'q': 'leak'})
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([r['id'] for r in results], [self.faucet.id, self.roof.id])
+        self.assertEqual(results[0]['highlighted_title'], '<mark>Leaky</mark> faucet')
+        self.assertIn('<mark>leak</mark>', results[1]['snippet'])
+
+    def test_highlighted_text_is_escaped(self):
+        ServiceRequest.objects.create(user=self.user, title='<img src=x onerror=alert(1)> fence',
+                                      description='Fence & <b>gate</b>', location='x')
+        result = self.client.get(self.search_url, {'q': 'gate'}).data['results'][0]
+        self.assertEqual(result['highlighted_title'], '&lt;img src=x onerror=alert(1)&gt; fence')
+        self.assertEqual(result['snippet'], 'Fence &amp; &lt;b&gt;<mark>gate</mark>&lt;/b&gt;')
+
+    def test_index_follows_updates_and_deletes(self):
+        self.faucet.title = 'Dripping tap'
+        self.faucet.description = 'Kitchen tap'
+        self.faucet.save()
+        self.roof.delete()
+        response = self.client.get(self.search_url, {'q': 'leak'})
+        self.assertEqual(response.data['results'], [])
+        response = self.client.get(self.search_url, {'q': 'tap'})
+        self.assertEqual([r['id'] for r in response.data['results']], [self.faucet.id])
+
+    def test_pagination_and_rebuild(self):
+        for i in range(3):
+            ServiceRequest.objects.create(user=self.user, title=f'Fence {i}', description='fence', location='x')
+        call_command('rebuild_search_index', stdout=StringIO())
+        response = self.client.get(self.search_url, {'q': 'fence', 'page_size': 3})
+        ids = [r['id'] for r in response.data['results']]
+        response = self.client.get(self.search_url, {'q': 'fence', 'page_size': 3, 'cursor': response.data['next']})
+        ids += [r['id'] for r in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(len(set(ids)), 4)
+
+    def test_malformed_cursor_is_rejected(self):
+        for key in ([0.0, 2 ** 70], [0.0, True], [2 ** 70, 1], [-1.5, -1], ['x', 1], [0.0]):
+            response = self.client.get(self.search_url, {'q': 'fence', 'cursor': encode_cursor(key)})
+            self.assertEqual(response.status_code, 400, key)
+
+    def test_query_syntax_is_escaped(self):
+        response = self.client.get(self.search_url, {'q': 'faucet" *('})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['id'] for r in response.data['results']], [self.faucet.id])
+
+class GeocodingTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='geo', email='geo@example.com', password='Testpass123!')
+        for title, location in [
+            ('Oshawa deck', '99 Simcoe St N, Oshawa, ON'),
+            ('Whitby fence', 'Whitby'),
+            ('Downtown condo', '1 Front St W, Toronto M5V 2T6'),
+            ('Ottawa roof', 'Ottawa, ON'),
+            ('Nowhere', 'Somewhere unknown'),
+        ]:
+            ServiceRequest.objects.create(user=self.user, title=title, description='d', location=location)
+
+    def test_locations_are_geocoded_on_save(self):
+        deck = ServiceRequest.objects.get(title='Oshawa deck')
+        self.assertAlmostEqual(deck.latitude, 43.8971, places=3)
+        self.assertIsNone(ServiceRequest.objects.get(title='Nowhere').latitude)
+        deck.location = 'Kingston, ON'
+        deck.save(update_fields=['location'])
+        deck.refresh_from_db()
+        self.assertAlmostEqual(deck.longitude, -76.4860, places=3)
+
+    def test_radius_search_sorted_by_distance(self):
+        response = self.client.get('/api/service-requests/', {'near': '43.8971,-78.8658', 'radius_km': 60})
+        self.assertEqual(response.status_code, 200)
+        titles = [r['title'] for r in response.data['results']]
+        self.assertEqual(titles, ['Oshawa deck', 'Whitby fence', 'Downtown condo'])
+        self.assertEqual(response.data['results'][0]['distance_km'], 0)
+
+        page = self.client.get('/api/service-requests/', {'near': '43.8971,-78.8658', 'radius_km': 60, 'page_size': 2})
+        rest = self.client.get('/api/service-requests/', {'near': '43.8971,-78.8658', 'radius_km': 60, 'cursor': page.data['next']})
+        self.assertEqual([r['title'] for r in rest.data['results']], ['Downtown condo'])
+        self.assertIsNone(rest.data['next'])
+
+    def test_pages_are_fetched_in_sql(self):
+        # Same place, same distance: the id breaks the tie across pages.
+        for i in range(4):
+            ServiceRequest.objects.create(user=self.user, title=f'Whitby {i}', description='d', location='Whitby')
+        titles, cursor = [], None
+        while True:
+            params = {'near': '43.8971,-78.8658', 'radius_km': 60, 'page_size': 2}
+            if cursor:
+                params['cursor'] = cursor
+            # The page of (distance, id), its rows, their images.
+            with self.assertNumQueries(3):
+                response = self.client.get('/api/service-requests/', params)
+            titles += [r['title'] for r in response.data['results']]
+            cursor = response.data['next']
+            if not cursor:
+                break
+        self.assertEqual(titles, ['Oshawa deck', 'Whitby fence', 'Whitby 0', 'Whitby 1', 'Whitby 2', 'Whitby 3', 'Downtown condo'])
+        bad = encode_cursor(['near', 1])
+        self.assertEqual(self.client.get('/api/service-requests/', {'near': '43.8971,-78.8658', 'cursor': bad}).status_code, 400)
+
+    def test_bad_near_is_rejected(self):
+        response = self.client.get('/api/service-requests/', {'near': 'here'})
+        self.assertEqual(response.status_code, 400)
+
+class MatchingTestCase(TestCase):
+    def setUp(self):
+        match_index.clear()
+        self.addCleanup(match_index.clear)
+        self.client = APIClient()
+        self.businesses = {}
+        for name, services in [('fixit', ['Repair', 'Installation']), ('reno', ['Renovation']), ('allround', ['Repair', 'Renovation', 'Design', 'Inspection'])]:
+            user = User.objects.create_user(username=name, email=f'{name}@example.com', password='Testpass123!')
+            profile = user.userprofile
+            profile.is_business_owner = True
+            profile.business_name = name
+            profile.industry = ['Construction']
+            profile.services = services
+            profile.save()
+            self.businesses[name] = user
+        self.requester = User.objects.create_user(username='homeowner', email='home@example.com', password='Testpass123!')
+        self.sink = ServiceRequest.objects.create(user=self.requester, title='Sink', description='d', location='Oshawa', services_needed=['Repair', 'Installation'])
+        self.kitchen = ServiceRequest.objects.create(user=self.requester, title='Kitchen', description='d', location='Ottawa', services_needed=['Renovation', 'Design'])
+
+    def test_top_businesses_for_request(self):
+        self.client.force_authenticate(self.requester)
+        response = self.client.get(f'/api/service-requests/{self.sink.id}/matches/')
+        self.assertEqual([b['business_name'] for b in response.data], ['fixit', 'allround'])
+        self.assertGreater(response.data[0]['match_score'], response.data[1]['match_score'])
+
+    def test_top_requests_for_business_follow_signals(self):
+        self.client.force_authenticate(self.businesses['allround'])
+        response = self.client.get('/api/matches/requests/', {'near': '45.42,-75.69'})
+        self.assertEqual([r['title'] for r in response.data], ['Kitchen', 'Sink'])
+
+        # The index is loaded now; new and deleted rows must show up without a reload,
+        # once their transaction commits.
+        with self.captureOnCommitCallbacks(execute=True):
+            fence = ServiceRequest.objects.create(user=self.requester, title='Fence', description='d', location='x', services_needed=['Inspection', 'Design'])
+            self.kitchen.delete()
+            self.assertNotIn(fence.id, match_index.requests)
+        response = self.client.get('/api/matches/requests/')
+        self.assertEqual([r['title'] for r in response.data], ['Fence', 'Sink'])
+        self.assertIn(fence.id, match_index.requests)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ServiceRequest.objects.create(user=self.requester, title='Rolled back', description='d', location='x', services_needed=['Design'])
+            raise IntegrityError('boom')
+        self.assertEqual([r['title'] for r in self.client.get('/api/matches/requests/').data], ['Fence', 'Sink'])
+
+    def test_industry_matches_without_shared_services(self):
+        self.client.force_authenticate(self.businesses['reno'])
+        with self.captureOnCommitCallbacks(execute=True):
+            pipes = ServiceRequest.objects.create(user=self.requester, title='Pipes', description='d', location='x', industry=['Construction'])
+        # Pipes asks only for an industry reno has; Kitchen's services are half covered.
+        self.assertEqual([r['title'] for r in self.client.get('/api/matches/requests/').data], ['Pipes', 'Kitchen'])
+        self.client.force_authenticate(self.requester)
+        response = self.client.get(f'/api/service-requests/{pipes.id}/matches/')
+        self.assertEqual({b['business_name'] for b in response.data}, {'fixit', 'reno', 'allround'})
+
+    def test_stale_index_is_rebuilt_in_the_background(self):
+        match_index.ensure_loaded()
+        with mock.patch.object(match_index, 'reload_in_background') as reload_in_background:
+            match_index._loaded_at -= settings.MATCHING_INDEX_TTL
+            self.client.force_authenticate(self.businesses['fixit'])
+            # The request is answered from the old copy; the rebuild runs elsewhere.
+            self.assertEqual([r['title'] for r in self.client.get('/api/matches/requests/').data], ['Sink'])
+        reload_in_background.assert_called_once()
+
+        # A change committed while the rebuild is reading is replayed onto its result.
+        values_list = BusinessProfile.objects.values_list
+        def delete_sink_midway(*args, **kwargs):
+            match_index.remove_request(self.sink.id)
+            return values_list(*args, **kwargs)
+        with mock.patch.object(BusinessProfile.objects, 'values_list', side_effect=delete_sink_midway):
+            match_index.reload()
+        self.assertNotIn(self.sink.id, match_index.requests)
+        self.assertIn(self.kitchen.id, match_index.requests)
+
+    def test_top_requests_stop_once_older_requests_cannot_win(self):
+        index, now = MatchIndex(), time.time()
+        index._loaded_at = time.monotonic()
+        index._add_business(1, 1, 0b0111, 0b1)
+        for pk in range(1, 401):
+            index._add_request(pk, 2, pk % 8, int(pk % 3 == 0), now - pk * 3600 * 6, 45.0 + pk / 1000, -75.0)
+        index._remove_request(5)
+
+        def brute_force(near):
+            scored = []
+            for pk, (_, needed, wanted, created, lat, lng) in index.requests.items():
+                if not (needed & 0b0111 or wanted & 0b1):
+                    continue
+                score = OVERLAP_WEIGHT * overlap(needed, wanted, 0b0111, 0b1) + recency(created, now)
+                if near:
+                    score += DISTANCE_WEIGHT * math.exp(-haversine_km(*near, lat, lng) / DISTANCE_SCALE_KM)
+                scored.append((score, -pk))
+            return [-neg_pk for _, neg_pk in sorted(scored, reverse=True)[:10]]
+
+        for near in (None, (45.1, -75.0)):
+            with mock.patch('client.matching.overlap', wraps=overlap) as scored, \
+                    mock.patch('client.matching.time.time', return_value=now):
+                ranked = index.top_requests_for_business(1, 10, near=near)
+            self.assertEqual([pk for _, pk in ranked], brute_force(near))
+            self.assertNotIn(5, [pk for _, pk in ranked])
+            self.assertLess(scored.call_count, 100)
+
+    def test_non_business_gets_403(self):
+        self.client.force_authenticate(self.requester)
+        response = self.client.get('/api/matches/requests/')
+        self.assertEqual(response.status_code, 403)
+
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='poller', email='poller@example.com', password='Testpass123!')
+        self.sr = ServiceRequest.objects.create(user=self.user, title='Gutters', description='d', location='x', services_needed=['Repair'])
+
+    def test_repeat_polls_are_served_from_cache(self):
+        self.client.get('/api/service-requests/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/service-requests/')
+        self.assertEqual(response.data['results'][0]['title'], 'Gutters')
+        # A different query-parameter set is cached separately.
+        self.assertEqual(self.client.get('/api/service-requests/', {'services': 'Design'}).data['results'], [])
+        stats = cache_stats()['service_requests']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_writes_invalidate_only_affected_listings(self):
+        self.client.get('/api/service-requests/')
+        self.client.get('/api/business-profiles/')
+        ServiceRequestImage.objects.create(service_request=self.sr, image='service_request_images/poller@example.com/a.jpg')
+        response = self.client.get('/api/service-requests/')
+        self.assertEqual(len(response.data['results'][0]['images']), 1)
+        with self.assertNumQueries(0):
+            self.client.get('/api/business-profiles/')
+
+        profile = self.user.userprofile
+        profile.is_business_owner = True
+        profile.business_name = 'Poller Co'
+        profile.save()
+        self.assertEqual([p['business_name'] for p in self.client.get('/api/business-profiles/').data], ['Poller Co'])
+
+        self.sr.delete()
+        self.assertEqual(self.client.get('/api/service-requests/').data['results'], [])
+
+class TokenCacheTestCase(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='tokened', email='tokened@example.com', password='Testpass123!')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_repeat_requests_do_not_query(self):
+        self.assertEqual(self.client.get('/api/hello/').data['username'], 'tokened')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/hello/').data['username'], 'tokened')
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(get_user)(self.token.key).username, 'tokened')
+
+    def test_deleted_token_is_rejected(self):
+        key = self.token.key
+        self.client.get('/api/hello/')
+        self.token.delete()
+        self.assertEqual(self.client.get('/api/hello/').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertIsInstance(async_to_sync(get_user)(key), AnonymousUser)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get('/api/hello/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/hello/').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertIsInstance(async_to_sync(get_user)(self.token.key), AnonymousUser)
+
+    @override_settings(TOKEN_CACHE_ALIAS='default')
+    def test_shared_tier_fills_other_processes(self):
+        cache.clear()
+        key = self.token.key
+        token_cache.resolve(key)
+        # A fresh process has nothing locally but finds the token in the shared cache.
+        token_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(token_cache.resolve(key).user, self.user)
+        token_cache.clear()
+        self.token.delete()
+        self.assertIsNone(token_cache.resolve(key))
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.owner = User.objects.create_user(username='owner', email='owner@example.com', password='Testpass123!')
+        self.helper = User.objects.create_user(username='helper', email='helper@example.com', password='Testpass123!')
+        self.sr = ServiceRequest.objects.create(user=self.owner, title='Porch', description='d', location='x')
+        self.room = ChatRoom.objects.create(service_request=self.sr, room_name='porch')
+        self.room.participants.add(self.owner, self.helper)
+
+    def test_etag_revalidation_skips_queries(self):
+        response = self.client.get('/api/service-requests/')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/service-requests/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertNotEqual(self.client.get('/api/service-requests/', {'page_size': 1})['ETag'], etag)
+
+        ServiceRequest.objects.create(user=self.owner, title='Shed', description='d', location='x')
+        response = self.client.get('/api/service-requests/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_modified_since(self):
+        response = self.client.get('/api/choices/')
+        self.assertIn('Last-Modified', response)
+        response = self.client.get('/api/choices/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_inbox_version_is_per_user(self):
+        self.client.force_authenticate(self.owner)
+        owner_etag = self.client.get('/api/chat-rooms/')['ETag']
+        self.client.force_authenticate(self.helper)
+        helper_etag = self.client.get('/api/chat-rooms/')['ETag']
+        outsider = User.objects.create_user(username='outsider', email='o@example.com', password='Testpass123!')
+        self.client.force_authenticate(outsider)
+        outsider_etag = self.client.get('/api/chat-rooms/')['ETag']
+
+        Message.objects.create(room=self.room, sender=self.helper, content='On my way')
+        self.client.force_authenticate(self.owner)
+        self.assertEqual(self.client.get('/api/chat-rooms/', HTTP_IF_NONE_MATCH=owner_etag).status_code, 200)
+        self.client.force_authenticate(self.helper)
+        self.assertEqual(self.client.get('/api/chat-rooms/', HTTP_IF_NONE_MATCH=helper_etag).status_code, 200)
+        self.client.force_authenticate(outsider)
+        self.assertEqual(self.client.get('/api/chat-rooms/', HTTP_IF_NONE_MATCH=outsider_etag).status_code, 304)
+
+@override_settings(SYNC_OVERLAP_SECONDS=0)
+class DeltaSyncTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='syncer', email='syncer@example.com', password='Testpass123!')
+        self.first = ServiceRequest.objects.create(user=self.user, title='First', description='d', location='x')
+        self.second = ServiceRequest.objects.create(user=self.user, title='Second', description='d', location='x')
+
+    def test_only_changes_since_token_are_returned(self):
+        response = self.client.get('/api/sync/')
+        self.assertEqual([r['title'] for r in response.data['service_requests']], ['First', 'Second'])
+        token = response.data['sync_token']
+
+        response = self.client.get('/api/sync/', {'since': token})
+        self.assertEqual(response.data['service_requests'], [])
+
+        self.first.title = 'First (edited)'
+        self.first.save()
+        second_id = self.second.id
+        self.second.delete()
+        ServiceRequest.objects.create(user=self.user, title='Third', description='d', location='x')
+        response = self.client.get('/api/sync/', {'since': token})
+        self.assertEqual([r['title'] for r in response.data['service_requests']], ['First (edited)', 'Third'])
+        self.assertEqual(response.data['deleted']['service_requests'], [second_id])
+
+        response = self.client.get('/api/sync/', {'since': response.data['sync_token']})
+        self.assertEqual(response.data['service_requests'], [])
+        self.assertEqual(response.data['deleted']['service_requests'], [])
+
+    @override_settings(SYNC_PAGE_SIZE=1)
+    def test_large_change_sets_are_paged(self):
+        titles, token, has_more = [], None, True
+        while has_more:
+            response = self.client.get('/api/sync/', {'since': token} if token else {})
+            titles += [r['title'] for r in response.data['service_requests']]
+            token, has_more = response.data['sync_token'], response.data['has_more']
+        self.assertEqual(titles, ['First', 'Second'])
+
+    def test_invalid_token(self):
+        self.assertEqual(self.client.get('/api/sync/', {'since': 'bogus'}).status_code, 400)
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.staff = User.objects.create_user(username='analyst', email='analyst@example.com', password='Testpass123!', is_staff=True)
+        for i in range(3):
+            ServiceRequest.objects.create(user=self.staff, title=f'Job {i}', description='line one\nline two', location='x', services_needed=['Repair', 'Design'])
+
+    def test_staff_only(self):
+        self.client.force_authenticate(User.objects.create_user(username='nobody', password='Testpass123!'))
+        self.assertEqual(self.client.get('/api/export/service_requests/').status_code, 403)
+
+    def test_jsonl_stream(self):
+        self.client.force_authenticate(self.staff)
+        response = self.client.get('/api/export/service_requests/')
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([r['title'] for r in rows], ['Job 0', 'Job 1', 'Job 2'])
+        self.assertEqual(rows[0]['services_needed'], ['Repair', 'Design'])
+
+    def test_gzipped_csv_with_since(self):
+        self.client.force_authenticate(self.staff)
+        response = self.client.get('/api/export/service_requests/', {'output': 'csv', 'gzip': '1', 'since': '2000-01-01'})
+        body = gzip.decompress(b''.join(response.streaming_content)).decode()
+        rows = list(csv.DictReader(StringIO(body)))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['description'], 'line one\nline two')
+        self.assertEqual(rows[0]['services_needed'], 'Repair,Design')
+
+        response = self.client.get('/api/export/service_requests/', {'since': '2999-01-01'})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_management_command(self):
+        out = StringIO()
+        path = os.path.join(settings.BASE_DIR, 'test_export.jsonl')
+        self.addCleanup(os.remove, path)
+        call_command('export_data', 'messages', '-o', path, stdout=out)
+        call_command('export_data', 'service_requests', '--format', 'csv', '-o', path, stdout=out)
+        with open(path) as f:
+            self.assertEqual(len(list(csv.reader(f))), 4)
+
+class ProjectionParityTestCase(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='parity', email='parity@example.com', password='Testpass123!')
+        profile = self.owner.userprofile
+        profile.is_business_owner = True
+        profile.business_name = 'Parity & Sons'
+        profile.industry = ['Plumbing']
+        profile.services = ['Repair', 'Design']
+        profile.save()
+        other = User.objects.create_user(username='other', email='', password='Testpass123!')
+        other.userprofile.is_business_owner = True
+        other.userprofile.business_name = 'Blank'
+        other.userprofile.save()
+        for services, price in [(['Repair'], '50.00'), (['Repair', 'Design'], None), ([], '7.5')]:
+            sr = ServiceRequest.objects.create(user=self.owner, title='Ünïcode "quotes"', description='d', location='x',
+                                               services_needed=services, price=price)
+        ServiceRequestImage.objects.create(service_request=sr, image='service_request_images/parity@example.com/b.jpg')
+        ServiceRequestImage.objects.create(service_request=sr, image='service_request_images/parity@example.com/a.jpg', renditions={
+            size: f'renditions/service_request_images/parity@example.com/a_{size}.webp' for size in ('thumb', 'medium', 'full')
+        })
+        room = ChatRoom.objects.create(service_request=sr, room_name='parity')
+        Message.objects.create(room=room, sender=self.owner, content='hi')
+        Message.objects.create(room=room, sender=other, content='there')
+
+    def assertSameJSON(self, serializer_data, projected):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(serializer_data), renderer.render(projected))
+
+    def test_service_requests(self):
+        queryset = ServiceRequest.objects.order_by('-created_at')
+        self.assertSameJSON(ServiceRequestListSerializer(queryset, many=True).data,
+                            render_service_requests(service_request_values(queryset)))
+
+    def test_business_profiles(self):
+        queryset = BusinessProfile.objects.order_by('id')
+        self.assertSameJSON(BusinessProfileListSerializer(queryset, many=True).data,
+                            render_business_profiles(business_profile_values(queryset)))
+
+    def test_chat_messages(self):
+        queryset = Message.objects.order_by('-timestamp')
+        self.assertSameJSON(ChatMessageSerializer(queryset, many=True).data,
+                            render_chat_messages(chat_message_values(queryset)))
+
+class RenditionTestCase(TransactionTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        cache.clear()
+        self.user = User.objects.create_user(username='photos', email='photos@example.com', password='Testpass123!')
+        self.sr = ServiceRequest.objects.create(user=self.user, title='Deck', description='d', location='x')
+
+    def photo(self, name='deck.jpg', size=(1600, 1200)):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+        exif[0x010F] = 'PhoneMaker'
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'orange').save(buffer, 'JPEG', exif=exif.tobytes())
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def wait_for_renditions(self, image):
+        for _ in range(100):
+            image.refresh_from_db()
+            if image.renditions:
+                return image.renditions
+            time.sleep(0.05)
+        self.fail('renditions were not made')
+
+    def test_uploads_are_rendered_in_the_background(self):
+        image = ServiceRequestImage.objects.create(service_request=self.sr, image=self.photo())
+        renditions = self.wait_for_renditions(image)
+        self.assertEqual(list(renditions), ['thumb', 'medium', 'full'])
+        storage = image.image.storage
+        with storage.open(renditions['thumb']) as f, Image.open(f) as thumb:
+            self.assertEqual(thumb.format, 'WEBP')
+            # Turned upright, scaled to fit 200px, EXIF gone.
+            self.assertEqual(thumb.size, (150, 200))
+            self.assertEqual(len(thumb.getexif()), 0)
+        with storage.open(renditions['full']) as f, Image.open(f) as full:
+            # Never enlarged.
+            self.assertEqual(full.size, (1200, 1600))
+
+        row = self.client.get('/api/service-requests/').data['results'][0]
+        self.assertEqual(row['renditions'], [{size: storage.url(name) for size, name in renditions.items()}])
+
+    @override_settings(IMAGE_RENDITION_FORMAT='JPEG')
+    def test_backfill_command(self):
+        # bulk_create skips the signal, like rows uploaded before renditions existed.
+        storage = ServiceRequestImage._meta.get_field('image').storage
+        names = [storage.save(f'service_request_images/photos/{i}.jpg', self.photo()) for i in range(3)]
+        names.append(storage.save('service_request_images/photos/broken.jpg', io.BytesIO(b'not an image')))
+        ServiceRequestImage.objects.bulk_create([ServiceRequestImage(service_request=self.sr, image=name) for name in names])
+        out = StringIO()
+        with self.assertLogs('client.renditions', 'ERROR'):
+            call_command('generate_renditions', '--workers', '2', stdout=out)
+        self.assertIn('Rendered 3 images.', out.getvalue())
+        self.assertIn('1 images could not be rendered', out.getvalue())
+        rendered = ServiceRequestImage.objects.exclude(renditions={})
+        self.assertEqual(rendered.count(), 3)
+        self.assertTrue(all(name.endswith('.jpg') for image in rendered for name in image.renditions.values()))
+
+        ServiceRequestImage.objects.filter(renditions={}).delete()
+        out = StringIO()
+        call_command('generate_renditions', '--all', stdout=out)
+        self.assertIn('Rendered 3 images.', out.getvalue())
+
+class ContentAddressedStorageTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root, BLOB_GC_GRACE=0))
+        self.user = User.objects.create_user(username='reposter', email='reposter@example.com', password='Testpass123!')
+        self.first = ServiceRequest.objects.create(user=self.user, title='Fence', description='d', location='x')
+        self.second = ServiceRequest.objects.create(user=self.user, title='Fence again', description='d', location='x')
+
+    def add_image(self, service_request, content, name='photo.jpg'):
+        return ServiceRequestImage.objects.create(service_request=service_request,
+                                                  image=SimpleUploadedFile(name, content, content_type='image/jpeg'))
+
+    def test_identical_files_are_stored_once(self):
+        a = self.add_image(self.first, b'same bytes', 'IMG_0001.JPG')
+        b = self.add_image(self.second, b'same bytes', 'copy.jpg')
+        c = self.add_image(self.second, b'other bytes')
+        self.assertEqual(a.image.name, blob_name(hashlib.sha256(b'same bytes').hexdigest(), '.jpg'))
+        self.assertEqual(a.image.name, b.image.name)
+        self.assertNotEqual(a.image.name, c.image.name)
+        self.assertEqual(ImageBlob.objects.get(name=a.image.name).refcount, 2)
+        self.assertEqual(ImageBlob.objects.get(name=a.image.name).size, len(b'same bytes'))
+
+    def test_sweep_deletes_unreferenced_blobs_and_renditions(self):
+        kept = self.add_image(self.first, b'kept')
+        dropped = self.add_image(self.second, b'dropped')
+        thumb = default_storage.save(rendition_name(dropped.image.name, 'thumb', 'WEBP'), StringIO('thumb'))
+        dropped.delete()
+        self.assertEqual(ImageBlob.objects.get(name=dropped.image.name).refcount, 0)
+
+        self.assertEqual(sweep_blobs(), 1)
+        self.assertFalse(image_storage.exists(dropped.image.name))
+        self.assertFalse(default_storage.exists(thumb))
+        self.assertTrue(image_storage.exists(kept.image.name))
+        self.assertEqual(list(ImageBlob.objects.values_list('name', flat=True)), [kept.image.name])
+
+    def test_resaved_blob_keeps_its_row_and_file(self):
+        image = self.add_image(self.first, b'again')
+        image.delete()
+        ImageBlob.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        # The file was just written: a save racing the sweep would have touched it like this.
+        with override_settings(BLOB_GC_GRACE=60):
+            self.assertEqual(sweep_blobs(), 0)
+        self.assertTrue(ImageBlob.objects.filter(name=image.image.name).exists())
+        self.assertTrue(image_storage.exists(image.image.name))
+
+    def test_saves_wait_for_a_sweep_holding_the_lock(self):
+        saved = threading.Event()
+        with blob_lock():
+            thread = threading.Thread(target=lambda: (image_storage.save('late.jpg', StringIO('late')), saved.set()))
+            thread.start()
+            self.assertFalse(saved.wait(0.2))
+        thread.join(5)
+        self.assertTrue(saved.is_set())
+
+    def test_scan_finds_files_without_rows(self):
+        orphan = image_storage.save('orphan.jpg', StringIO('orphan'))
+        bulk = image_storage.save('bulk.jpg', StringIO('bulk'))
+        # bulk_create skips the signals that count references.
+        ServiceRequestImage.objects.bulk_create([ServiceRequestImage(service_request=self.first, image=bulk)])
+        out = StringIO()
+        call_command('gc_image_blobs', stdout=out)
+        self.assertIn('Deleted 1 unreferenced blobs.', out.getvalue())
+        self.assertFalse(image_storage.exists(orphan))
+        self.assertEqual(ImageBlob.objects.get(name=bulk).refcount, 1)
+
+class ResumableUploadTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='uploader', email='uploader@example.com', password='Testpass123!')
+        self.client.force_authenticate(self.user)
+        self.sr = ServiceRequest.objects.create(user=self.user, title='Roof', description='d', location='x')
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 48), 'blue').save(buffer, 'JPEG')
+        self.photo = buffer.getvalue()
+
+    def start(self, length=None):
+        response = self.client.post('/api/uploads/', {'service_request': self.sr.id, 'filename': 'roof.jpg',
+                                                      'length': length or len(self.photo)}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response['Location']
+
+    def patch(self, url, offset, data):
+        return self.client.generic('PATCH', url, data, content_type='application/offset+octet-stream',
+                                   HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_chunks_resume_from_stored_offset(self):
+        url = self.start()
+        half = len(self.photo) // 2
+        self.assertEqual(self.patch(url, 0, self.photo[:half])['Upload-Offset'], str(half))
+        # A retry of a chunk that already arrived is refused with the real offset.
+        response = self.patch(url, 0, self.photo[:half])
+        self.assertEqual((response.status_code, response.data['offset']), (409, half))
+        self.assertEqual(self.client.get(url).data['offset'], half)
+        self.assertEqual(self.client.post(f'{url}finalize/').status_code, 409)
+
+        self.assertEqual(self.patch(url, half, self.photo[half:]).data['offset'], len(self.photo))
+        response = self.client.post(f'{url}finalize/')
+        self.assertEqual(response.status_code, 201)
+        image = ServiceRequestImage.objects.get(id=response.data['id'])
+        self.assertEqual(image.service_request, self.sr)
+        self.assertEqual(image.image.name, blob_name(hashlib.sha256(self.photo).hexdigest(), '.jpg'))
+        with image.image.open('rb') as f:
+            self.assertEqual(f.read(), self.photo)
+        self.assertFalse(ImageUpload.objects.exists())
+        # The partial file was moved, not copied.
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'service_request_images', 'uploader@example.com')), [])
+
+    def test_concurrent_requests_take_turns(self):
+        url = self.start()
+        upload = ImageUpload.objects.get()
+        # A first PATCH still writing holds the lock; its retry must not write over it.
+        with locked_partial_file(ImageUpload.objects.get()) as f:
+            self.assertEqual(self.patch(url, 0, self.photo).status_code, 423)
+            f.write(self.photo)
+            ImageUpload.objects.update(offset=len(self.photo))
+        self.assertEqual(self.patch(url, 0, self.photo).status_code, 409)
+        self.assertEqual(self.client.post(f'{url}finalize/').status_code, 201)
+        # A second finalize that raced the first finds the upload gone.
+        with self.assertRaises(ImageUpload.DoesNotExist):
+            finalize_upload(upload)
+
+    def test_limits_and_ownership(self):
+        self.assertEqual(self.client.post('/api/uploads/', {'service_request': self.sr.id, 'filename': 'x.jpg',
+                                                            'length': 10 ** 12}, format='json').status_code, 400)
+        for service_request in ('abc', 2 ** 70, None):
+            response = self.client.post('/api/uploads/', {'service_request': service_request, 'filename': 'x.jpg',
+                                                          'length': 10}, format='json')
+            self.assertEqual(response.status_code, 400, service_request)
+        url = self.start()
+        self.assertEqual(self.patch(url, 0, self.photo + b'extra').status_code, 400)
+        response = self.client.generic('PATCH', url, b'', content_type='application/offset+octet-stream',
+                                       HTTP_UPLOAD_OFFSET='0', CONTENT_LENGTH='')
+        self.assertEqual(response.status_code, 411)
+
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user(username='snoop', password='Testpass123!'))
+        self.assertEqual(other.get(url).status_code, 404)
+        self.assertEqual(other.post('/api/uploads/', {'service_request': self.sr.id, 'filename': 'x.jpg',
+                                                      'length': 10}, format='json').status_code, 404)
+
+    def test_non_images_and_abandoned_uploads_are_removed(self):
+        url = self.start(length=4)
+        self.patch(url, 0, b'junk')
+        self.assertEqual(self.client.post(f'{url}finalize/').status_code, 400)
+        self.assertFalse(ImageUpload.objects.exists())
+
+        self.start()
+        upload = ImageUpload.objects.get()
+        directory = os.path.dirname(ServiceRequestImage._meta.get_field('image').storage.path(upload.path))
+        self.assertEqual(os.listdir(directory), [os.path.basename(upload.path)])
+        ImageUpload.objects.update(updated_at=upload.updated_at - timedelta(days=2))
+        self.start()
+        self.assertEqual(os.listdir(directory), [os.path.basename(ImageUpload.objects.get().path)])
+        self.assertNotEqual(ImageUpload.objects.get().id, upload.id)
+
+class InboxTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.me = User.objects.create_user(username='me', email='me@example.com', password='Testpass123!')
+        self.client.force_authenticate(self.me)
+
+    def make_rooms(self, count):
+        for i in range(count):
+            other = User.objects.create_user(username=f'contact{i}', email=f'c{i}@example.com', password='Testpass123!')
+            sr = ServiceRequest.objects.create(user=other, title=f'Job {i}', description='d', location='x')
+            ServiceRequestImage.objects.create(service_request=sr, image=f'service_request_images/c{i}/1.jpg')
+            room = ChatRoom.objects.create(service_request=sr, room_name=f'room{i}')
+            room.participants.add(self.me, other)
+            Message.objects.create(room=room, sender=other, content=f'Hello from {i}')
+            Message.objects.create(room=room, sender=self.me, content=f'Reply {i}')
+
+    def test_latest_message_and_counterpart(self):
+        self.make_rooms(1)
+        room = self.client.get('/api/chat-rooms/').data['results'][0]
+        self.assertEqual(room['other_participant']['username'], 'contact0')
+        self.assertEqual(room['latest_message']['content'], 'Reply 0')
+        self.assertEqual(room['latest_message']['sender'], 'me')
+        self.assertEqual(room['service_request']['images'], ['/media/service_request_images/c0/1.jpg'])
+
+    def test_deleting_the_latest_message_falls_back_to_the_previous_one(self):
+        self.make_rooms(1)
+        latest = lambda: self.client.get('/api/chat-rooms/').data['results'][0]['latest_message']
+        Message.objects.get(content='Reply 0').delete()
+        self.assertEqual(latest()['content'], 'Hello from 0')
+        self.assertEqual(latest()['sender'], 'contact0')
+        Message.objects.all().delete()
+        self.assertIsNone(latest())
+        room = ChatRoom.objects.get(room_name='room0')
+        self.assertEqual((room.last_message_content, room.last_message_sender, room.last_message_at), ('', None, None))
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        self.make_rooms(2)
+        with self.assertNumQueries(3):
+            self.client.get('/api/chat-rooms/')
+        for i in range(2, 6):
+            other = User.objects.create_user(username=f'late{i}', email=f'l{i}@example.com', password='Testpass123!')
+            sr = ServiceRequest.objects.create(user=other, title=f'Late {i}', description='d', location='x')
+            room = ChatRoom.objects.create(service_request=sr, room_name=f'late{i}')
+            room.participants.add(self.me, other)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/chat-rooms/')
+        self.assertEqual(len(response.data['results']), 6)
+
+    def test_unread_counts_are_maintained_incrementally(self):
+        self.make_rooms(1)
+        room = ChatRoom.objects.get(room_name='room0')
+        other = User.objects.get(username='contact0')
+        unread = lambda: self.client.get('/api/chat-rooms/').data['results'][0]['unread_count']
+        # Replying read everything before it.
+        self.assertEqual(unread(), 0)
+        first = Message.objects.create(room=room, sender=other, content='one')
+        Message.objects.create(room=room, sender=other, content='two')
+        self.assertEqual(unread(), 2)
+        self.assertEqual(ReadCursor.objects.get(room=room, user=other).unread_count, 0)
+
+        ReadCursor.mark_read(room.id, self.me.id, first.id)
+        self.assertEqual(unread(), 1)
+        # Cursors never move backwards.
+        ReadCursor.mark_read(room.id, self.me.id, first.id - 5)
+        self.assertEqual(unread(), 1)
+        # Nor past the room's newest message, where later messages would never count as unread.
+        ReadCursor.mark_read(room.id, self.me.id, 10 ** 12)
+        self.assertEqual(ReadCursor.objects.get(room=room, user=self.me).last_read_message_id, Message.objects.latest('id').id)
+        self.assertEqual(unread(), 0)
+
+        MessageWriteBuffer.insert([Message(room=room, sender=other, content=f'bulk {i}') for i in range(3)])
+        self.assertEqual(unread(), 3)
+        with self.assertNumQueries(3):
+            self.client.get('/api/chat-rooms/')
+
+        room.participants.remove(self.me)
+        self.assertFalse(ReadCursor.objects.filter(room=room, user=self.me).exists())
+
+    def test_paginated_by_last_activity(self):
+        self.make_rooms(3)
+        oldest = ChatRoom.objects.get(room_name='room0')
+        Message.objects.create(room=oldest, sender=self.me, content='bump')
+        response = self.client.get('/api/chat-rooms/', {'page_size': 2})
+        self.assertEqual([r['service_request']['title'] for r in response.data['results']], ['Job 0', 'Job 2'])
+        response = self.client.get('/api/chat-rooms/', {'page_size': 2, 'cursor': response.data['next']})
+        self.assertEqual([r['service_request']['title'] for r in response.data['results']], ['Job 1'])
+
+class ChatHistoryTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(username='histowner', email='ho@example.com', password='Testpass123!')
+        self.helper = User.objects.create_user(username='histhelper', email='hh@example.com', password='Testpass123!')
+        sr = ServiceRequest.objects.create(user=self.owner, title='History', description='d', location='x')
+        self.room = ChatRoom.objects.create(service_request=sr, room_name='history')
+        self.room.participants.add(self.owner, self.helper)
+        for i in range(5):
+            Message.objects.create(room=self.room, sender=self.helper if i % 2 else self.owner, content=f'm{i}')
+        self.url = f'/api/chat-rooms/{self.room.id}/messages/'
+        self.client.force_authenticate(self.owner)
+
+    def contents(self, response):
+        return [m['content'] for m in response.data['results']]
+
+    def test_scroll_back_and_catch_up(self):
+        first = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual(self.contents(first), ['m4', 'm3'])
+        older = self.client.get(self.url, {'page_size': 2, 'before': first.data['before']})
+        self.assertEqual(self.contents(older), ['m2', 'm1'])
+        oldest = self.client.get(self.url, {'page_size': 2, 'before': older.data['before']})
+        self.assertEqual(self.contents(oldest), ['m0'])
+        self.assertIsNone(oldest.data['before'])
+        self.assertEqual([first.data['has_more'], older.data['has_more'], oldest.data['has_more']], [True, True, False])
+
+        self.assertEqual(self.client.get(self.url, {'after': first.data['after']}).data['results'], [])
+        Message.objects.create(room=self.room, sender=self.helper, content='m5')
+        newer = self.client.get(self.url, {'after': first.data['after']})
+        self.assertEqual(self.contents(newer), ['m5'])
+        self.assertEqual(newer.data['results'][0]['sender'], {'username': 'histhelper', 'id': self.helper.id})
+
+    def test_catch_up_pages_forward(self):
+        oldest = self.client.get(self.url, {'page_size': 2, 'before': self.client.get(
+            self.url, {'page_size': 4}).data['before']})
+        self.assertEqual(self.contents(oldest), ['m0'])
+        newer = self.client.get(self.url, {'page_size': 2, 'after': oldest.data['after']})
+        self.assertEqual(self.contents(newer), ['m2', 'm1'])
+        self.assertTrue(newer.data['has_more'])
+        newest = self.client.get(self.url, {'page_size': 2, 'after': newer.data['after']})
+        self.assertEqual(self.contents(newest), ['m4', 'm3'])
+        self.assertFalse(newest.data['has_more'])
+
+    def test_empty_or_conflicting_cursors_are_rejected(self):
+        cursor = self.client.get(self.url).data['after']
+        for params in [{'before': ''}, {'after': ''}, {'before': cursor, 'after': cursor}]:
+            self.assertEqual(self.client.get(self.url, params).status_code, 400, params)
+
+    def test_cost_does_not_depend_on_room_size(self):
+        # Membership EXISTS + one page query (the auth lookup is forced away).
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {'page_size': 3})
+
+    def test_malformed_cursor_is_rejected(self):
+        cursor = encode_cursor({'d': 'n', 'k': [[1], 1]})
+        for url, param in [(self.url, 'before'), (self.url, 'after'), ('/api/chat-rooms/', 'cursor')]:
+            self.assertEqual(self.client.get(url, {param: cursor}).status_code, 400, (url, param))
+
+    def test_membership(self):
+        self.client.force_authenticate(User.objects.create_user(username='snoop', password='Testpass123!'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.assertEqual(self.client.get('/api/chat-rooms/999/messages/').status_code, 404)
+
+class ChatConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        # A fresh layer file per test: room ids repeat between tests, and the
+        # live BASE_DIR/channels.sqlite3 must not be touched. Changing the
+        # setting drops the cached layer (channels.layers.channel_layers).
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        layers = {'default': {**settings.CHANNEL_LAYERS['default'], 'CONFIG': {
+            **settings.CHANNEL_LAYERS['default']['CONFIG'], 'path': os.path.join(directory, 'channels.sqlite3')}}}
+        self.enterContext(override_settings(CHANNEL_LAYERS=layers))
+        presence_registry.clear()
+        user_buckets.clear()
+        self.owner = User.objects.create_user(username='wsowner', email='wso@example.com', password='Testpass123!')
+        self.helper = User.objects.create_user(username='wshelper', email='wsh@example.com', password='Testpass123!')
+        sr = ServiceRequest.objects.create(user=self.owner, title='Sockets', description='d', location='x')
+        self.room = ChatRoom.objects.create(service_request=sr, room_name='sockets')
+        self.room.participants.add(self.owner, self.helper)
+
+    async def receive_message(self, communicator):
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame.get('type', 'message') == 'message':
+                return frame
+
+    def communicator(self, user, room_id=None):
+        application = URLRouter([path('ws/chat/<str:room_name>/', ChatConsumer.as_asgi())])
+        communicator = WebsocketCommunicator(application, f'ws/chat/{room_id or self.room.id}/')
+        communicator.scope['user'] = user
+        return communicator
+
+    async def test_messages_are_batched_and_broadcast_with_ids(self):
+        owner, helper = self.communicator(self.owner), self.communicator(self.helper)
+        self.assertTrue((await owner.connect())[0])
+        self.assertTrue((await helper.connect())[0])
+
+        await owner.send_json_to({'message': 'first'})
+        await helper.send_json_to({'message': 'second'})
+        received = [await self.receive_message(owner), await self.receive_message(owner)]
+        self.assertEqual({m['message'] for m in received}, {'first', 'second'})
+        self.assertTrue(all(m['id'] and m['timestamp'] for m in received))
+        self.assertEqual(len({m['id'] for m in received}), 2)
+
+        await owner.disconnect()
+        await helper.disconnect()
+        stored = await database_sync_to_async(lambda: list(Message.objects.order_by('id').values_list('id', 'content')))()
+        self.assertEqual(sorted(stored), sorted((m['id'], m['message']) for m in received))
+        room = await database_sync_to_async(ChatRoom.objects.get)(id=self.room.id)
+        self.assertIn(room.last_message_content, {'first', 'second'})
+
+    async def test_outsiders_are_rejected(self):
+        outsider = await database_sync_to_async(User.objects.create_user)(username='wsout', password='Testpass123!')
+        connected, _ = await self.communicator(outsider).connect()
+        self.assertFalse(connected)
+        connected, _ = await self.communicator(AnonymousUser()).connect()
+        self.assertFalse(connected)
+
+    async def test_one_socket_multiplexes_every_room(self):
+        other = await database_sync_to_async(ChatRoom.objects.create)(
+            service_request=self.room.service_request, room_name='sockets-2')
+        await database_sync_to_async(other.participants.add)(self.owner)
+        outsider_room = await database_sync_to_async(ChatRoom.objects.create)(
+            service_request=self.room.service_request, room_name='sockets-3')
+
+        application = URLRouter([path('ws/chat/', UserChatConsumer.as_asgi())])
+        mux = WebsocketCommunicator(application, 'ws/chat/')
+        mux.scope['user'] = self.owner
+        self.assertTrue((await mux.connect())[0])
+        legacy = self.communicator(self.helper)
+        self.assertTrue((await legacy.connect())[0])
+
+        await legacy.send_json_to({'message': 'from legacy'})
+        frame = await self.receive_message(mux)
+        self.assertEqual((frame['type'], frame['room_id'], frame['message']), ('message', self.room.id, 'from legacy'))
+        self.assertEqual((await self.receive_message(legacy))['message'], 'from legacy')
+
+        await mux.send_json_to({'type': 'message', 'room_id': other.id, 'message': 'second room'})
+        frame = await self.receive_message(mux)
+        self.assertEqual((frame['room_id'], frame['message'], frame['username']), (other.id, 'second room', 'wsowner'))
+
+        await mux.send_json_to({'type': 'subscribe', 'room_id': outsider_room.id})
+        self.assertEqual(await mux.receive_json_from(),
+                         {'type': 'error', 'room_id': outsider_room.id, 'error': 'Chat room not found'})
+
+        await mux.send_json_to({'type': 'unsubscribe', 'room_id': self.room.id})
+        self.assertEqual((await mux.receive_json_from())['type'], 'unsubscribed')
+        await legacy.send_json_to({'message': 'not for mux'})
+        await self.receive_message(legacy)
+        self.assertTrue(await mux.receive_nothing(0.3))
+
+        await mux.send_json_to({'type': 'subscribe', 'room_id': self.room.id})
+        self.assertEqual(await mux.receive_json_from(), {'type': 'subscribed', 'room_id': self.room.id})
+        await mux.disconnect()
+        await legacy.disconnect()
+
+    async def test_bad_frames_get_errors_and_keep_the_socket(self):
+        owner = self.communicator(self.owner)
+        await owner.connect()
+        await owner.receive_json_from()
+        for frame in ['not json', '[1, 2]', '{}', '{"message": 5}', '{"message": "  "}', '{"message": "hi", "time": 3}']:
+            await owner.send_to(text_data=frame)
+            error = await owner.receive_json_from()
+            self.assertEqual(error['type'], 'error', frame)
+        await owner.send_json_to({'message': 'still here'})
+        self.assertEqual((await self.receive_message(owner))['message'], 'still here')
+        await owner.disconnect()
+
+        mux = WebsocketCommunicator(URLRouter([path('ws/chat/', UserChatConsumer.as_asgi())]), 'ws/chat/')
+        mux.scope['user'] = self.owner
+        await mux.connect()
+        await mux.receive_json_from()
+        await mux.send_json_to({'type': 'message', 'room_id': self.room.id, 'message': ['not', 'text']})
+        self.assertEqual(await mux.receive_json_from(), {'type': 'error', 'room_id': self.room.id, 'error': 'Message is required'})
+        await mux.disconnect()
+        self.assertFalse(await database_sync_to_async(Message.objects.exclude(content='still here').exists)())
+
+    async def test_multiplexed_socket_requires_login(self):
+        application = URLRouter([path('ws/chat/', UserChatConsumer.as_asgi())])
+        mux = WebsocketCommunicator(application, 'ws/chat/')
+        mux.scope['user'] = AnonymousUser()
+        self.assertFalse((await mux.connect())[0])
+
+    @override_settings(CHAT_TYPING_INTERVAL=0.2)
+    async def test_presence_and_coalesced_typing(self):
+        owner, helper = self.communicator(self.owner), self.communicator(self.helper)
+        await owner.connect()
+        self.assertEqual(await owner.receive_json_from(), {
+            'type': 'presence', 'room_id': self.room.id, 'online': True,
+            'user': {'id': self.owner.id, 'username': 'wsowner'},
+        })
+        await helper.connect()
+        self.assertEqual((await owner.receive_json_from())['user']['username'], 'wshelper')
+
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        response = await database_sync_to_async(client.get)(f'/api/chat-rooms/presence/?rooms={self.room.id},999')
+        self.assertEqual(response.json(), {'rooms': {str(self.room.id): [
+            {'id': self.owner.id, 'username': 'wsowner'}, {'id': self.helper.id, 'username': 'wshelper'},
+        ]}})
+        for rooms in ('99999999999999999999999', '-1', 'abc'):
+            response = await database_sync_to_async(client.get)(f'/api/chat-rooms/presence/?rooms={rooms}')
+            self.assertEqual(response.status_code, 400, rooms)
+
+        for _ in range(5):
+            await helper.send_json_to({'type': 'typing'})
+            await owner.send_json_to({'type': 'typing'})
+        frame = await owner.receive_json_from()
+        self.assertEqual(frame['type'], 'typing')
+        self.assertEqual([user['username'] for user in frame['users']], ['wsowner', 'wshelper'])
+        self.assertTrue(await owner.receive_nothing(0.4))
+
+        await helper.disconnect()
+        self.assertEqual(await owner.receive_json_from(), {
+            'type': 'presence', 'room_id': self.room.id, 'online': False,
+            'user': {'id': self.helper.id, 'username': 'wshelper'},
+        })
+        await owner.disconnect()
+        self.assertEqual(presence_registry.online([self.room.id]), {self.room.id: []})
+
+    @override_settings(PRESENCE_TIMEOUT=0.3)
+    async def test_any_frame_keeps_a_socket_online(self):
+        owner = self.communicator(self.owner)
+        await owner.connect()
+        await owner.receive_json_from()
+        online = lambda: [user['id'] for user in presence_registry.online([self.room.id])[self.room.id]]
+        for frame in ({'type': 'typing'}, {'type': 'heartbeat'}, {'type': 'typing'}):
+            await asyncio.sleep(0.2)
+            await owner.send_json_to(frame)
+            await asyncio.sleep(0.05)
+            self.assertEqual(online(), [self.owner.id])
+        await asyncio.sleep(0.35)
+        self.assertEqual(online(), [])
+        await owner.disconnect()
+
+    async def test_read_frames_move_the_cursor(self):
+        owner, helper = self.communicator(self.owner), self.communicator(self.helper)
+        await owner.connect()
+        await helper.connect()
+        await helper.send_json_to({'message': 'one'})
+        first = await self.receive_message(owner)
+        await helper.send_json_to({'message': 'two'})
+        await self.receive_message(owner)
+        cursor = await database_sync_to_async(ReadCursor.objects.get)(room=self.room, user=self.owner)
+        self.assertEqual(cursor.unread_count, 2)
+
+        await owner.send_json_to({'type': 'read', 'message_id': first['id']})
+        ack = await owner.receive_json_from()
+        while ack['type'] != 'read':
+            ack = await owner.receive_json_from()
+        self.assertEqual(ack, {'type': 'read', 'room_id': self.room.id, 'message_id': first['id'], 'unread_count': 1})
+
+        # A malformed read frame is answered with an error; the socket stays up.
+        await owner.send_json_to({'type': 'read', 'message_id': 'latest'})
+        error = await owner.receive_json_from()
+        self.assertEqual(error['error'], 'message_id must be an integer')
+        await owner.send_json_to({'type': 'read', 'message_id': 10 ** 12})
+        ack = await owner.receive_json_from()
+        self.assertEqual((ack['type'], ack['unread_count']), ('read', 0))
+        self.assertNotEqual(ack['message_id'], 10 ** 12)
+        await owner.disconnect()
+        await helper.disconnect()
+
+    @override_settings(CHAT_REPLAY_BATCH=2)
+    async def test_reconnect_replays_missed_messages_once(self):
+        create = database_sync_to_async(Message.objects.create)
+        seen = await create(room=self.room, sender=self.helper, content='seen')
+        for i in range(3):
+            await create(room=self.room, sender=self.helper, content=f'missed {i}')
+
+        application = URLRouter([path('ws/chat/<str:room_name>/', ChatConsumer.as_asgi())])
+        owner = WebsocketCommunicator(application, f'ws/chat/{self.room.id}/?last_seen_id={seen.id}')
+        owner.scope['user'] = self.owner
+        await owner.connect()
+        frames = []
+        while not frames or not frames[-1]['done']:
+            frame = await owner.receive_json_from()
+            if frame['type'] == 'history':
+                frames.append(frame)
+        self.assertEqual([[m['content'] for m in frame['messages']] for frame in frames],
+                         [['missed 0', 'missed 1'], ['missed 2']])
+        self.assertFalse(frames[0]['truncated'])
+
+        # A broadcast of a message that was already replayed is not sent twice.
+        replayed = frames[-1]['messages'][-1]
+        await get_channel_layer().group_send(f'chat_{self.room.id}', {
+            'type': 'sendMessage', 'room_id': self.room.id, 'id': replayed['id'],
+            'frame': json.dumps({'type': 'message', 'message': 'missed 2'}),
+        })
+        await self.helper_sends('live')
+        self.assertEqual((await self.receive_message(owner))['message'], 'live')
+        await owner.disconnect()
+
+        mux = WebsocketCommunicator(URLRouter([path('ws/chat/', UserChatConsumer.as_asgi())]), 'ws/chat/?history=1')
+        mux.scope['user'] = self.owner
+        await mux.connect()
+        frame = await mux.receive_json_from()
+        while frame['type'] != 'history':
+            frame = await mux.receive_json_from()
+        self.assertEqual(frame['room_id'], self.room.id)
+        self.assertEqual([m['content'] for m in frame['messages']], ['live'])
+        self.assertTrue(frame['truncated'] and frame['done'])
+        await mux.disconnect()
+
+    async def helper_sends(self, text):
+        helper = self.communicator(self.helper)
+        await helper.connect()
+        await helper.send_json_to({'message': text})
+        await self.receive_message(helper)
+        await helper.disconnect()
+
+    async def test_batched_and_deflated_protocols(self):
+        application = URLRouter([path('ws/chat/<str:room_name>/', ChatConsumer.as_asgi())])
+        batched = WebsocketCommunicator(application, f'ws/chat/{self.room.id}/', subprotocols=['chat.batch'])
+        batched.scope['user'] = self.owner
+        deflated = WebsocketCommunicator(application, f'ws/chat/{self.room.id}/', subprotocols=['chat.batch.deflate'])
+        deflated.scope['user'] = self.helper
+        self.assertEqual(await batched.connect(), (True, 'chat.batch'))
+        self.assertEqual(await deflated.connect(), (True, 'chat.batch.deflate'))
+        await batched.receive_nothing(0.1)
+        await deflated.receive_nothing(0.1)
+
+        for i in range(3):
+            await batched.send_json_to({'message': f'burst {i}'})
+        inflater = zlib.decompressobj(wbits=-15)
+        received = {'plain': [], 'deflate': []}
+        while len(received['plain']) < 3:
+            frame = await batched.receive_json_from()
+            self.assertEqual(frame['type'], 'batch')
+            received['plain'] += [f['message'] for f in frame['frames'] if f['type'] == 'message']
+        while len(received['deflate']) < 3:
+            frame = json.loads(inflater.decompress(await deflated.receive_from()))
+            self.assertEqual(frame['type'], 'batch')
+            received['deflate'] += [f['message'] for f in frame['frames'] if f['type'] == 'message']
+        self.assertEqual(received['plain'], ['burst 0', 'burst 1', 'burst 2'])
+        self.assertEqual(received['deflate'], received['plain'])
+        await batched.disconnect()
+        await deflated.disconnect()
+
+    async def receive_until_close(self, communicator):
+        errors = []
+        while True:
+            output = await communicator.receive_output()
+            if output['type'] == 'websocket.close':
+                return errors, output.get('code')
+            frame = json.loads(output['text'])
+            if frame['type'] == 'error':
+                errors.append(frame)
+
+    @override_settings(CHAT_CONNECTION_RATE=0.01, CHAT_CONNECTION_BURST=3, CHAT_RATE_LIMIT_STRIKES=2)
+    async def test_flooding_socket_is_rejected_then_closed(self):
+        owner = self.communicator(self.owner)
+        await owner.connect()
+        for _ in range(6):
+            await owner.send_json_to({'type': 'typing'})
+        errors, code = await self.receive_until_close(owner)
+        self.assertEqual(code, 4029)
+        self.assertEqual([error['error'] for error in errors], ['Rate limit exceeded'] * 2)
+        self.assertGreater(errors[0]['retry_after'], 0)
+
+    @override_settings(CHAT_USER_RATE=0.01, CHAT_USER_BURST=2)
+    async def test_user_limit_spans_sockets(self):
+        first, second = self.communicator(self.owner), self.communicator(self.owner)
+        await first.connect()
+        self.assertEqual((await first.receive_json_from())['type'], 'presence')
+        await second.connect()
+        await first.send_json_to({'type': 'heartbeat'})
+        await first.send_json_to({'type': 'heartbeat'})
+        self.assertTrue(await first.receive_nothing(0.1))
+        await second.send_json_to({'type': 'heartbeat'})
+        frame = await second.receive_json_from()
+        self.assertEqual(frame['error'], 'Rate limit exceeded')
+        await first.disconnect()
+        await second.disconnect()
+
+    @override_settings(CHAT_SEND_QUEUE_LIMIT=3)
+    async def test_slow_client_is_dropped(self):
+        sent, stalled = [], asyncio.Event()
+        async def base_send(message):
+            sent.append(message)
+            if message['type'] == 'websocket.send':
+                # The client never reads.
+                await stalled.wait()
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.owner}
+        consumer.base_send = base_send
+        await consumer.accept_protocol()
+        await consumer.send_frame(json.dumps({'type': 'message', 'message': 'first'}))
+        await asyncio.sleep(0.01)
+        for i in range(10):
+            await consumer.send_frame(json.dumps({'type': 'message', 'message': str(i)}))
+        await asyncio.sleep(0.05)
+        self.assertEqual(sent[-1], {'type': 'websocket.close', 'code': 4008})
+        self.assertEqual(len([message for message in sent if message['type'] == 'websocket.send']), 1)
+
+    @override_settings(CHAT_SEND_BUFFER_LIMIT=100)
+    async def test_slow_client_is_dropped_by_transport_backlog(self):
+        # daphne's send: writes land in the Twisted transport's buffer and never block.
+        transport = SimpleNamespace(dataBuffer=b'', offset=0, _tempDataLen=0)
+        sent = []
+        async def handle_reply(protocol, message):
+            sent.append(message)
+            protocol.transport._tempDataLen += len(message.get('text', ''))
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.owner}
+        consumer.base_send = functools.partial(handle_reply, SimpleNamespace(transport=transport))
+        await consumer.accept_protocol()
+        for i in range(10):
+            await consumer.send_frame(json.dumps({'type': 'message', 'message': 'x' * 40}))
+        await asyncio.sleep(0.05)
+        # Two frames of 73 bytes are over the limit; nothing is written after them.
+        self.assertEqual(sent[-1], {'type': 'websocket.close', 'code': 4008})
+        self.assertEqual(len([message for message in sent if message['type'] == 'websocket.send']), 2)
+
+    @override_settings(CHAT_CONNECTION_RATE=0.01, CHAT_USER_RATE=0.01, CHAT_USER_BURST=1)
+    async def test_rejected_frame_costs_no_tokens(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.owner}
+        consumer.base_send = lambda message: asyncio.sleep(0)
+        await consumer.accept_protocol()
+        self.assertTrue(await consumer.admit_frame())
+        tokens = consumer.connection_bucket.tokens
+        self.assertFalse(await consumer.admit_frame())
+        self.assertAlmostEqual(consumer.connection_bucket.tokens, tokens, places=2)
+
+    async def test_failed_scheduled_flush_is_logged(self):
+        buffer = MessageWriteBuffer()
+        future = asyncio.get_running_loop().create_future()
+        buffer._pending.append((Message(room_id=self.room.id, sender_id=self.owner.id, content='lost'), future))
+        with mock.patch.object(MessageWriteBuffer, 'insert', side_effect=RuntimeError('disk full')), \
+                self.assertLogs('client.chat_buffer', 'ERROR') as logs:
+            buffer._scheduled_flush()
+            self.assertEqual(len(buffer._tasks), 1)
+            await asyncio.gather(*buffer._tasks)
+        self.assertEqual(buffer._tasks, set())
+        self.assertIsInstance(future.exception(), RuntimeError)
+        self.assertIn('Could not write 1 chat messages', logs.output[0])
+
+    def test_pending_messages_are_flushed_on_shutdown(self):
+        buffer = MessageWriteBuffer()
+        buffer._pending.append((Message(room_id=self.room.id, sender_id=self.owner.id, content='late'), None))
+        buffer.flush_sync()
+        self.assertTrue(Message.objects.filter(content='late').exists())
+
+WORKER_SCRIPT = '''
+import asyncio, os, sys
+from client.channel_layers import SQLiteChannelLayer
+
+async def main(path, ready_fd, expected):
+    layer = SQLiteChannelLayer(path=path, poll_interval=0.01)
+    channel = await layer.new_channel()
+    await layer.group_add('chat_1', channel)
+    # Hand the channel name to the parent; closing the pipe says we are listening.
+    with os.fdopen(ready_fd, 'w') as ready:
+        ready.write(channel)
+    message = await asyncio.wait_for(layer.receive(channel), 20)
+    return message['message'] == expected
+
+sys.exit(0 if asyncio.run(main(sys.argv[1], int(sys.argv[2]), sys.argv[3])) else 1)
+'''
+
+class SQLiteChannelLayerTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'channels.sqlite3')
+
+    def layer(self, **config):
+        return SQLiteChannelLayer(path=self.path, poll_interval=0.01, **config)
+
+    def test_group_send_reaches_every_worker_process(self):
+        workers, channels = [], []
+        try:
+            for _ in range(3):
+                read_fd, write_fd = os.pipe()
+                workers.append(subprocess.Popen(
+                    [sys.executable, '-c', WORKER_SCRIPT, self.path, str(write_fd), 'hello all'],
+                    cwd=settings.BASE_DIR, pass_fds=(write_fd,), stderr=subprocess.PIPE, text=True))
+                os.close(write_fd)
+                with os.fdopen(read_fd) as ready:
+                    channels.append(ready.read())
+            self.assertEqual(len({channel.split('!')[0] for channel in channels}), 3)
+            async_to_sync(self.layer().group_send)('chat_1', {'type': 'sendMessage', 'message': 'hello all'})
+            for worker in workers:
+                _, err = worker.communicate(timeout=30)
+                self.assertEqual(worker.returncode, 0, err)
+        finally:
+            for worker in workers:
+                worker.kill()
+
+    def test_capacity_and_metrics(self):
+        layer = self.layer(capacity=2)
+        async def fill():
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            await layer.send(channel, {'type': 'a'})
+            await layer.send(channel, {'type': 'b'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'c'})
+            await layer.group_send('room', {'type': 'd'})
+            return channel, layer.stats(), await layer.receive(channel)
+        channel, stats, first = async_to_sync(fill)()
+        self.assertEqual(first, {'type': 'a'})
+        self.assertEqual(stats['channels'][channel], {'pending': 2, 'capacity': 2})
+        self.assertEqual(stats['full_channels'], [channel])
+        self.assertEqual(stats['groups'], {'room': 1})
+        self.assertEqual(stats['dropped'], 1)
+
+    def test_poller_waits_when_other_writes_bring_nothing(self):
+        layer = self.layer()
+        polls = []
+        def poll(target):
+            # data_version moved, but the rows were for another worker.
+            polls.append(target)
+            return []
+        async def idle_receive():
+            channel = await layer.new_channel()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(channel), 0.3)
+        with mock.patch.object(layer, '_poll', side_effect=poll):
+            async_to_sync(idle_receive)()
+        self.assertLess(len(polls), 60)
+
+    def test_group_membership_expires(self):
+        layer = self.layer(group_expiry=0)
+        async def send():
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            await layer.group_send('room', {'type': 'a'})
+            return layer.stats()
+        self.assertEqual(async_to_sync(send)()['pending'], 0)
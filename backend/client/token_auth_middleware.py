@@ -1,16 +1,17 @@
 from django.contrib.auth.models import AnonymousUser
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
-from rest_framework.authtoken.models import Token
 from urllib.parse import parse_qs
+from .token_cache import token_cache
 
-@database_sync_to_async
-def get_user(token_key):
-    try:
-        token = Token.objects.get(key=token_key)
-        return token.user
-    except Token.DoesNotExist:
+async def get_user(token_key):
+    # A hit in this process's cache needs no thread hop, let alone a query.
+    token = token_cache.get(token_key)
+    if token is None:
+        token = await database_sync_to_async(token_cache.resolve)(token_key)
+    if token is None or not token.user.is_active:
         return AnonymousUser()
+    return token.user
 
 class TokenAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
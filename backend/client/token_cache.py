@@ -0,0 +1,120 @@
+"""
+Token -> user resolution for REST requests and WebSocket handshakes without
+a database query per request.
+
+Resolved tokens (with their user) are kept in a small in-process LRU for
+TOKEN_CACHE_TTL seconds and, when TOKEN_CACHE_ALIAS names a Django cache, in
+that shared cache for TOKEN_CACHE_SHARED_TTL seconds. The signals in
+signals.py drop a token when it is deleted and when its user is changed or
+deactivated. The shared tier is cleared for every worker, the local tier only
+in the worker that made the change, so TOKEN_CACHE_TTL bounds how long other
+workers may still accept a revoked token.
+"""
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+def shared_key(token_key):
+    # Token keys are credentials; the shared cache only sees a digest.
+    return 'token:%s' % hashlib.sha256(token_key.encode()).hexdigest()
+
+
+class TokenCache:
+    def __init__(self):
+        # token key -> (expires, pickled Token with its user), oldest use first.
+        # Entries are stored pickled so every request gets its own instances.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token_key):
+        """The cached Token for token_key from this process, or None. Never queries."""
+        with self._lock:
+            entry = self._entries.get(token_key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[token_key]
+                return None
+            self._entries.move_to_end(token_key)
+        return pickle.loads(entry[1])
+
+    def resolve(self, token_key):
+        """The Token for token_key with its user loaded, or None if there is no such token."""
+        token = self.get(token_key)
+        if token is not None:
+            return token
+        shared = self._shared()
+        if shared is not None:
+            token = shared.get(shared_key(token_key))
+            if token is not None:
+                self._remember(token)
+                return token
+        try:
+            token = Token.objects.select_related('user').get(key=token_key)
+        except Token.DoesNotExist:
+            return None
+        # Only tokens that authenticate are worth keeping.
+        if token.user.is_active:
+            self._remember(token)
+            if shared is not None:
+                shared.set(shared_key(token_key), token, settings.TOKEN_CACHE_SHARED_TTL)
+        return token
+
+    def invalidate(self, *token_keys):
+        """
+        Forget the given tokens, now and again after commit, so a request that
+        re-resolved them from pre-commit rows in between is not trusted either.
+        """
+        def drop():
+            with self._lock:
+                for token_key in token_keys:
+                    self._entries.pop(token_key, None)
+            shared = self._shared()
+            if shared is not None:
+                shared.delete_many([shared_key(token_key) for token_key in token_keys])
+        if token_keys:
+            drop()
+            transaction.on_commit(drop)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def _remember(self, token):
+        entry = (time.monotonic() + settings.TOKEN_CACHE_TTL, pickle.dumps(token))
+        with self._lock:
+            self._entries[token.key] = entry
+            self._entries.move_to_end(token.key)
+            while len(self._entries) > settings.TOKEN_CACHE_MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _shared():
+        alias = settings.TOKEN_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that resolves tokens through token_cache."""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.resolve(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (token.user, token)
@@ -0,0 +1,148 @@
+"""
+Resumable image uploads for service requests, modelled on tus: the client
+declares the file's length, sends it in PATCH chunks that each say at which
+offset they start, and finalizes once every byte has arrived. A dropped
+connection costs at most one chunk; the client asks for the offset and
+carries on from there.
+
+Chunks are appended to a partial file in the image storage next to where the
+image will live, so no request ever holds more than one chunk, and
+finalizing moves the file into the content-addressed store (storage.py)
+instead of copying it. Requests for the same upload take turns through a lock
+on the partial file.
+"""
+import os
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import locks
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+
+from .models import ImageUpload, ServiceRequestImage
+
+COPY_BUFFER = 64 * 1024
+
+
+class InvalidUpload(Exception):
+    pass
+
+
+class UploadLocked(Exception):
+    """Another request is writing to or finalizing the upload."""
+
+
+class OffsetMismatch(Exception):
+    """A chunk or finalize request that does not match the stored offset."""
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.offset = offset
+
+
+def image_field():
+    return ServiceRequestImage._meta.get_field('image')
+
+
+def target_name(service_request, filename):
+    """Where the finished image goes: service_request_image_path, sanitized by the storage."""
+    return image_field().generate_filename(ServiceRequestImage(service_request=service_request), filename)
+
+
+def start_upload(user, service_request, filename, length):
+    if not 0 < length <= settings.UPLOAD_MAX_LENGTH:
+        raise InvalidUpload(f'length must be between 1 and {settings.UPLOAD_MAX_LENGTH} bytes')
+    delete_expired_uploads()
+    storage = image_field().storage
+    path = f'{target_name(service_request, os.path.basename(filename))}.{uuid.uuid4().hex[:12]}.part'
+    full_path = storage.path(path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    open(full_path, 'xb').close()
+    return ImageUpload.objects.create(user=user, service_request=service_request, filename=filename,
+                                      path=path, length=length)
+
+
+@contextmanager
+def locked_partial_file(upload, blocking=False):
+    """
+    The partial file, opened and locked against other requests (in any worker
+    process) for the same upload. Raises UploadLocked if another request holds
+    it and not blocking, and ImageUpload.DoesNotExist if the upload is gone.
+    """
+    try:
+        f = open(image_field().storage.path(upload.path), 'r+b')
+    except FileNotFoundError:
+        raise ImageUpload.DoesNotExist
+    with f:
+        if not locks.lock(f, locks.LOCK_EX if blocking else locks.LOCK_EX | locks.LOCK_NB):
+            raise UploadLocked
+        # Whoever held the lock before may have moved the offset, or finished the upload.
+        upload.refresh_from_db(fields=['offset'])
+        yield f
+
+
+def append_chunk(upload, offset, stream, size):
+    """
+    Write `size` bytes from `stream` at `offset` and return the new offset.
+    Anything a failed earlier attempt left past `offset` is overwritten.
+    """
+    if size > settings.UPLOAD_CHUNK_MAX_SIZE:
+        raise InvalidUpload(f'chunks may be at most {settings.UPLOAD_CHUNK_MAX_SIZE} bytes')
+    # A client retrying after a timeout while its first PATCH is still
+    # running is told to wait rather than writing over it.
+    with locked_partial_file(upload) as f:
+        if offset != upload.offset:
+            raise OffsetMismatch(upload.offset)
+        if offset + size > upload.length:
+            raise InvalidUpload('chunk goes past the end of the upload')
+        written = 0
+        f.seek(offset)
+        f.truncate()
+        while written < size:
+            data = stream.read(min(COPY_BUFFER, size - written))
+            if not data:
+                break
+            f.write(data)
+            written += len(data)
+        f.flush()
+        ImageUpload.objects.filter(id=upload.id).update(offset=offset + written, updated_at=timezone.now())
+    upload.offset = offset + written
+    return upload.offset
+
+
+def finalize_upload(upload):
+    """Move a complete upload into place as a ServiceRequestImage of its service request."""
+    storage = image_field().storage
+    # Finalizing is quick, so a concurrent finalize waits and then finds the upload gone.
+    with locked_partial_file(upload, blocking=True):
+        if upload.offset != upload.length:
+            raise OffsetMismatch(upload.offset)
+        try:
+            with Image.open(storage.path(upload.path)) as image:
+                image.verify()
+        except Exception:
+            upload.delete()
+            raise InvalidUpload('upload is not an image')
+        # Hashed in place and moved into the content-addressed store, not copied.
+        name = storage.adopt(storage.path(upload.path), os.path.splitext(upload.filename)[1])
+        with transaction.atomic():
+            image = ServiceRequestImage.objects.create(service_request=upload.service_request, image=name)
+            upload.delete()
+    return image
+
+
+def delete_expired_uploads():
+    """Drop uploads nobody has added to for UPLOAD_EXPIRY seconds, partial files included."""
+    cutoff = timezone.now() - timedelta(seconds=settings.UPLOAD_EXPIRY)
+    for upload in ImageUpload.objects.filter(updated_at__lt=cutoff):
+        upload.delete()
+
+
+def delete_partial_file(upload):
+    path = image_field().storage.path(upload.path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -2,8 +2,10 @@ from django.urls import path
 from .views import (
     RegisterView, VerifyCodeView, CustomLoginView, 
     HelloView, ChoicesView, ServiceRequestView, 
-    BusinessProfileListView, ServiceRequestListView,
-    ChatRoomView, ChatMessageView, CreateChatRoomView,
+    BusinessProfileListView, ServiceRequestListView, ServiceRequestSearchView,
+    BusinessMatchesView, ServiceRequestMatchesView, ResponseCacheStatsView, ChannelLayerStatsView, SyncView,
+    ExportView, ImageUploadView, ImageUploadDetailView, ImageUploadFinalizeView,
+    ChatRoomView, ChatMessageView, CreateChatRoomView, ChatRoomPresenceView,
     GoogleLoginView, UpdateBusinessInfoView
 )
 
@@ -17,11 +19,22 @@ urlpatterns = [
     path('api/choices/', ChoicesView.as_view(), name='choices'),
     path('choices/', ChoicesView.as_view(), name='choices'),
     path('service-request/', ServiceRequestView.as_view(), name='service-request'),
+    path('uploads/', ImageUploadView.as_view(), name='image-uploads'),
+    path('uploads/<int:upload_id>/', ImageUploadDetailView.as_view(), name='image-upload'),
+    path('uploads/<int:upload_id>/finalize/', ImageUploadFinalizeView.as_view(), name='image-upload-finalize'),
     path('business-profiles/', BusinessProfileListView.as_view(), name='business-profiles'),
     path('service-requests/', ServiceRequestListView.as_view(), name='service-requests'),
+    path('service-requests/search/', ServiceRequestSearchView.as_view(), name='service-request-search'),
+    path('service-requests/<int:request_id>/matches/', ServiceRequestMatchesView.as_view(), name='service-request-matches'),
+    path('matches/requests/', BusinessMatchesView.as_view(), name='business-matches'),
+    path('sync/', SyncView.as_view(), name='sync'),
+    path('export/<str:dataset>/', ExportView.as_view(), name='export'),
+    path('cache-stats/', ResponseCacheStatsView.as_view(), name='cache-stats'),
+    path('channel-layer-stats/', ChannelLayerStatsView.as_view(), name='channel-layer-stats'),
     
     # Chat endpoints
     path('chat-rooms/', ChatRoomView.as_view(), name='chat-rooms'),
+    path('chat-rooms/presence/', ChatRoomPresenceView.as_view(), name='chat-room-presence'),
     path('chat-rooms/create/', CreateChatRoomView.as_view(), name='create-chat-room'),
     path('chat-rooms/<int:room_id>/messages/', ChatMessageView.as_view(), name='chat-messages'),
 ]
\ No newline at end of file
@@ -6,13 +6,34 @@ from rest_framework.response import Response
 from rest_framework import status, permissions
 from rest_framework.authtoken.models import Token
 from django.shortcuts import get_object_or_404
-from .models import INDUSTRY_CHOICES, SERVICES_CHOICES, ServiceRequest, ServiceRequestImage, BusinessProfile, UserProfile, ChatRoom, Message
+from .models import INDUSTRY_CHOICES, SERVICES_CHOICES, choices_mask, masks_matching, ServiceRequest, ImageUpload, BusinessProfile, UserProfile, ChatRoom, Message, ReadCursor
 from .email_utils import send_verification_email
+from .pagination import KeysetPagination, InvalidCursor, decode_cursor, encode_cursor, is_row_id
+from .search import search_service_requests
+from .geo import nearby, parse_near
+from .matching import match_index
+from .presence import presence_registry
+from .renditions import rendition_urls
+from .ingest import IngestError, ingest_service_request
+from .uploads import InvalidUpload, OffsetMismatch, UploadLocked, append_chunk, finalize_upload, start_upload
+from .sync import collect_changes
+from .projections import (
+    business_profile_values, chat_message_values, render_business_profiles,
+    render_chat_messages, render_service_requests, service_request_values,
+    service_requests_by_id,
+)
+from .export import DATASETS, FORMATS, aiterate, export_chunks, parse_since
+from .cache import cache_response, cache_stats, conditional_response, chat_rooms_namespace, SERVICE_REQUESTS, BUSINESS_PROFILES
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import serializers
-from django.db.models import Q
+from django.db.models import OuterRef, Q, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from channels.layers import get_channel_layer
+from django.conf import settings
 
 # New API to update business owner info
 class UpdateBusinessInfoView(APIView):
@@ -139,6 +160,7 @@ class HelloView(APIView):
 class ChoicesView(APIView):
     permission_classes = [permissions.AllowAny]
 
+    @conditional_response('choices')
     def get(self, request):
         industry = [choice[0] for choice in INDUSTRY_CHOICES]
         services = [choice[0] for choice in SERVICES_CHOICES]
@@ -148,53 +170,105 @@ class ServiceRequestView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        data = request.data
-        title = data.get('title')
-        description = data.get('description')
-        price = data.get('price')
-        location = data.get('location')
-        services_needed_json = data.get('services_needed', '[]')
-        business_posted = data.get('business_posted', False)
-        images = []
-        # Collect all files with key starting with 'image'
-        for key in request.FILES:
-            if key.startswith('image'):
-                img = request.FILES[key]
-                if img:
-                    images.append(img)
-        # Handle services_needed as either JSON string or list
-        if isinstance(services_needed_json, str):
-            import json
-            try:
-                services_needed = json.loads(services_needed_json)
-            except Exception:
-                services_needed = []
-        else:
-            services_needed = services_needed_json
+        # Every file whose field name starts with 'image': image0, image1, ...
+        images = [request.FILES[key] for key in request.FILES if key.startswith('image') and request.FILES[key]]
+        try:
+            sr = ingest_service_request(request.user, request.data, images)
+        except IngestError as e:
+            return Response({'error': str(e)}, status=400)
+        return Response({'detail': 'Service request created.', 'id': sr.id}, status=201)
 
-        # Convert business_posted string to boolean if needed
-        if isinstance(business_posted, str):
-            business_posted = business_posted.lower() in ['true', 'yes', '1']
+def upload_state(upload):
+    return {'id': upload.id, 'offset': upload.offset, 'length': upload.length}
 
-        if not title or not description or not location:
-            return Response({'error': 'Title, description, and location are required.'}, status=400)
+def upload_response(upload, status=200):
+    return Response(upload_state(upload), status=status, headers={
+        'Upload-Offset': str(upload.offset), 'Upload-Length': str(upload.length),
+    })
 
+class ImageUploadView(APIView):
+    """Start a resumable image upload for one of your service requests (see uploads.py)."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
         try:
-            sr = ServiceRequest.objects.create(
-                user=request.user,
-                title=title,
-                description=description,
-                price=price if price else None,
-                location=location,
-                services_needed=services_needed,
-                business_posted=business_posted,
-            )
-            # Save images
-            for img in images:
-                ServiceRequestImage.objects.create(service_request=sr, image=img)
-            return Response({'detail': 'Service request created.'}, status=201)
-        except Exception as e:
-            return Response({'error': str(e)}, status=500)
+            length = int(request.data.get('length'))
+        except (TypeError, ValueError):
+            return Response({'error': 'length must be an integer'}, status=400)
+        filename = request.data.get('filename')
+        if not filename:
+            return Response({'error': 'filename is required'}, status=400)
+        try:
+            service_request_id = int(request.data.get('service_request'))
+            if not is_row_id(service_request_id):
+                raise ValueError(service_request_id)
+        except (TypeError, ValueError):
+            return Response({'error': 'service_request must be a service request id'}, status=400)
+        service_request = ServiceRequest.objects.filter(id=service_request_id, user=request.user).first()
+        if service_request is None:
+            return Response({'error': 'Service request not found'}, status=404)
+        try:
+            upload = start_upload(request.user, service_request, filename, length)
+        except InvalidUpload as e:
+            return Response({'error': str(e)}, status=400)
+        response = upload_response(upload, status=201)
+        response['Location'] = f'{request.path}{upload.id}/'
+        return response
+
+class ImageUploadDetailView(APIView):
+    """
+    GET (or HEAD) reports how much has arrived; PATCH appends the raw request
+    body at the Upload-Offset header's position; DELETE abandons the upload.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, upload_id):
+        return upload_response(get_object_or_404(ImageUpload, id=upload_id, user=request.user))
+
+    def patch(self, request, upload_id):
+        upload = get_object_or_404(ImageUpload, id=upload_id, user=request.user)
+        if not request.META.get('CONTENT_LENGTH'):
+            return Response({'error': 'Content-Length is required'}, status=411)
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            size = int(request.META['CONTENT_LENGTH'])
+            if size < 0:
+                raise ValueError(size)
+        except (KeyError, ValueError):
+            return Response({'error': 'Upload-Offset header and Content-Length are required'}, status=400)
+        try:
+            # The body is read straight from the request, never parsed.
+            append_chunk(upload, offset, request.stream, size)
+        except OffsetMismatch as e:
+            return Response({'error': 'Upload-Offset does not match', 'offset': e.offset}, status=409,
+                            headers={'Upload-Offset': str(e.offset)})
+        except InvalidUpload as e:
+            return Response({'error': str(e)}, status=400)
+        except UploadLocked:
+            return Response({'error': 'Another request is writing to this upload'}, status=423)
+        except ImageUpload.DoesNotExist:
+            return Response({'error': 'Upload not found'}, status=404)
+        return upload_response(upload)
+
+    def delete(self, request, upload_id):
+        get_object_or_404(ImageUpload, id=upload_id, user=request.user).delete()
+        return Response(status=204)
+
+class ImageUploadFinalizeView(APIView):
+    """Attach a complete upload to its service request as an image."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id):
+        upload = get_object_or_404(ImageUpload.objects.select_related('service_request__user'), id=upload_id, user=request.user)
+        try:
+            image = finalize_upload(upload)
+        except OffsetMismatch as e:
+            return Response({'error': 'Upload is incomplete', 'offset': e.offset}, status=409)
+        except InvalidUpload as e:
+            return Response({'error': str(e)}, status=400)
+        except ImageUpload.DoesNotExist:
+            return Response({'error': 'Upload not found'}, status=404)
+        return Response({'id': image.id, 'service_request': image.service_request_id, 'image': image.image.url}, status=201)
 
 class BusinessProfileListSerializer(serializers.ModelSerializer):
     user = serializers.CharField(source='user_profile.user.username')
@@ -206,50 +280,250 @@ class BusinessProfileListSerializer(serializers.ModelSerializer):
 class ServiceRequestListSerializer(serializers.ModelSerializer):
     user = serializers.CharField(source='user.username')
     images = serializers.SerializerMethodField()
+    renditions = serializers.SerializerMethodField()
     class Meta:
         model = ServiceRequest
-        fields = ['id', 'title', 'description', 'price', 'location', 'services_needed', 'business_posted', 'created_at', 'user', 'images']
+        fields = ['id', 'title', 'description', 'price', 'location', 'services_needed', 'industry', 'business_posted', 'created_at', 'user', 'images', 'renditions']
     def get_images(self, obj):
         return [img.image.url for img in obj.images.all()]
+    def get_renditions(self, obj):
+        # One entry per image, in the same order; None until it has been processed.
+        return [rendition_urls(img.renditions, img.image.storage.url) for img in obj.images.all()]
+
+CHOICE_FILTERS = {
+    'industry': ('industry_mask', INDUSTRY_CHOICES),
+    'services': ('services_mask', SERVICES_CHOICES),
+}
+
+def filter_by_choices(queryset, request, params):
+    # ?services=Repair,Design&match=all -> rows offering both; match defaults to 'any'.
+    match = request.query_params.get('match', 'any')
+    if match not in ('any', 'all'):
+        raise ValueError("match must be 'any' or 'all'")
+    for param in params:
+        values = [v.strip() for raw in request.query_params.getlist(param) for v in raw.split(',') if v.strip()]
+        if not values:
+            continue
+        field, choices = CHOICE_FILTERS[param]
+        unknown = [v for v in values if v not in dict(choices)]
+        if unknown:
+            raise ValueError(f"Unknown {param}: {', '.join(unknown)}")
+        mask = choices_mask(values, choices)
+        queryset = queryset.filter(**{f'{field}__in': masks_matching(mask, choices, match)})
+    return queryset
 
 class BusinessProfileListView(APIView):
     permission_classes = [permissions.AllowAny]
+    @conditional_response(BUSINESS_PROFILES)
+    @cache_response(BUSINESS_PROFILES)
     def get(self, request):
-        queryset = BusinessProfile.objects.all()
-        serializer = BusinessProfileListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        try:
+            queryset = filter_by_choices(BusinessProfile.objects.all(), request, ['industry', 'services'])
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        return Response(render_business_profiles(business_profile_values(queryset)))
 
 class ServiceRequestListView(APIView):
     permission_classes = [permissions.AllowAny]
+    @conditional_response(SERVICE_REQUESTS)
+    @cache_response(SERVICE_REQUESTS)
     def get(self, request):
-        queryset = ServiceRequest.objects.all().order_by('-created_at')
-        serializer = ServiceRequestListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        try:
+            queryset = filter_by_choices(ServiceRequest.objects.all(), request, ['industry', 'services'])
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        if 'near' in request.query_params:
+            return self.get_nearby(request, queryset)
+        try:
+            page = KeysetPagination(ordering=('-created_at', '-id')).paginate(service_request_values(queryset), request)
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=400)
+        return Response(page.response_data(render_service_requests(page.rows)))
+
+    def get_nearby(self, request, queryset):
+        # ?near=lat,lng&radius_km= : nearest first, paged on a (distance, id) cursor.
+        try:
+            lat, lng, radius = parse_near(request.query_params['near'], request.query_params.get('radius_km'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        key = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                key = decode_cursor(cursor)
+                if not (isinstance(key, list) and len(key) == 2 and isinstance(key[0], (int, float))
+                        and isinstance(key[1], int) and 0 <= key[1] < 2 ** 63):
+                    raise InvalidCursor(cursor)
+            except InvalidCursor:
+                return Response({'error': 'Invalid cursor'}, status=400)
+        page_size = KeysetPagination(ordering=('distance', 'id')).get_page_size(request)
+        hits = nearby(queryset, lat, lng, radius, after=key, limit=page_size + 1)
+        page, more = hits[:page_size], len(hits) > page_size
+
+        rows = service_requests_by_id([pk for _, pk in page])
+        results = []
+        for distance, pk in page:
+            data = rows[pk]
+            data['distance_km'] = round(distance, 2)
+            results.append(data)
+        next_cursor = encode_cursor(list(page[-1])) if more else None
+        return Response({'next': next_cursor, 'previous': None, 'results': results})
+
+class ServiceRequestSearchView(APIView):
+    permission_classes = [permissions.AllowAny]
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'Query parameter q is required.'}, status=400)
+        paginator = KeysetPagination(ordering=('score', 'id'))
+        try:
+            hits, next_cursor = search_service_requests(query, paginator.get_page_size(request), request.query_params.get('cursor'))
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=400)
+
+        rows = service_requests_by_id([hit['id'] for hit in hits])
+        results = []
+        for hit in hits:
+            if hit['id'] not in rows:
+                continue
+            data = rows[hit['id']]
+            data['score'] = hit['score']
+            data['highlighted_title'] = hit['title']
+            data['snippet'] = hit['snippet']
+            results.append(data)
+        return Response({'next': next_cursor, 'results': results})
+
+def parse_limit(request, default=10, maximum=50):
+    try:
+        return max(1, min(int(request.query_params.get('limit', default)), maximum))
+    except ValueError:
+        return default
+
+class BusinessMatchesView(APIView):
+    permission_classes = [IsAuthenticated]
+    def get(self, request):
+        business = BusinessProfile.objects.filter(user_profile__user=request.user).first()
+        if business is None:
+            return Response({'error': 'Only business owners have matches.'}, status=403)
+        near = None
+        if 'near' in request.query_params:
+            try:
+                near = parse_near(request.query_params['near'], None)[:2]
+            except ValueError as e:
+                return Response({'error': str(e)}, status=400)
+        ranked = match_index.top_requests_for_business(business.id, parse_limit(request), near=near)
+        rows = service_requests_by_id([pk for _, pk in ranked])
+        results = []
+        for score, pk in ranked:
+            if pk in rows:
+                data = rows[pk]
+                data['match_score'] = round(score, 4)
+                results.append(data)
+        return Response(results)
+
+class ServiceRequestMatchesView(APIView):
+    permission_classes = [IsAuthenticated]
+    def get(self, request, request_id):
+        service_request = get_object_or_404(ServiceRequest, id=request_id)
+        ranked = match_index.top_businesses_for_request(service_request.id, parse_limit(request))
+        rows = BusinessProfile.objects.select_related('user_profile__user').in_bulk([pk for _, pk in ranked])
+        results = []
+        for score, pk in ranked:
+            if pk in rows:
+                data = BusinessProfileListSerializer(rows[pk]).data
+                data['match_score'] = round(score, 4)
+                results.append(data)
+        return Response(results)
+
+class SyncView(APIView):
+    permission_classes = [permissions.AllowAny]
+    def get(self, request):
+        try:
+            changes, token, has_more = collect_changes(request.query_params.get('since'))
+        except InvalidCursor:
+            return Response({'error': 'Invalid sync token'}, status=400)
+        deleted = {'service_requests': [], 'business_profiles': []}
+        for tombstone in changes['deleted']:
+            deleted[f'{tombstone.model}s'].append(tombstone.object_id)
+        return Response({
+            'service_requests': ServiceRequestListSerializer(changes['service_requests'], many=True).data,
+            'business_profiles': BusinessProfileListSerializer(changes['business_profiles'], many=True).data,
+            'deleted': deleted,
+            'sync_token': token,
+            'has_more': has_more,
+        })
+
+class ExportView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, dataset):
+        if dataset not in DATASETS:
+            return Response({'error': f'Unknown dataset: {dataset}'}, status=404)
+        output = request.query_params.get('output', 'jsonl')
+        if output not in FORMATS:
+            return Response({'error': f"output must be one of {', '.join(FORMATS)}"}, status=400)
+        try:
+            since = parse_since(request.query_params.get('since'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        compress = request.query_params.get('gzip') in ('1', 'true', 'True')
+
+        chunks = export_chunks(dataset, output, since, compress)
+        if isinstance(request._request, ASGIRequest):
+            chunks = aiterate(chunks)
+        filename = f'{dataset}.{output}' + ('.gz' if compress else '')
+        response = StreamingHttpResponse(chunks, content_type='application/gzip' if compress else FORMATS[output])
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+class ResponseCacheStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+    def get(self, request):
+        return Response(cache_stats())
+
+class ChannelLayerStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+    def get(self, request):
+        layer = get_channel_layer()
+        if not hasattr(layer, 'stats'):
+            return Response({'error': 'Channel layer does not report stats'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(layer.stats())
 
 class ChatRoomSerializer(serializers.ModelSerializer):
     other_participant = serializers.SerializerMethodField()
     service_request = ServiceRequestListSerializer()
     latest_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatRoom
-        fields = ['id', 'service_request', 'created_at', 'other_participant', 'latest_message']
+        fields = ['id', 'service_request', 'created_at', 'other_participant', 'latest_message', 'unread_count']
 
     def get_other_participant(self, obj):
-        user = self.context['request'].user
-        other_user = obj.participants.exclude(id=user.id).first()
+        # ChatRoomView prefetches everyone but the requesting user into other_participants.
+        others = getattr(obj, 'other_participants', None)
+        if others is None:
+            user = self.context['request'].user
+            others = list(obj.participants.exclude(id=user.id).order_by('id')[:1])
+        other_user = others[0] if others else None
         return {'username': other_user.username, 'id': other_user.id} if other_user else None
 
     def get_latest_message(self, obj):
-        latest = obj.messages.order_by('-timestamp').first()
-        if latest:
+        if obj.last_message_at:
             return {
-                'content': latest.content,
-                'sender': latest.sender.username,
-                'timestamp': latest.timestamp
+                'content': obj.last_message_content,
+                'sender': obj.last_message_sender.username if obj.last_message_sender else None,
+                'timestamp': obj.last_message_at
             }
         return None
 
+    def get_unread_count(self, obj):
+        # ChatRoomView annotates this from the user's ReadCursor.
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
+        cursor = obj.read_cursors.filter(user=self.context['request'].user).first()
+        return cursor.unread_count if cursor else 0
+
 class ChatMessageSerializer(serializers.ModelSerializer):
     sender = serializers.SerializerMethodField()
 
@@ -263,10 +537,41 @@ class ChatMessageSerializer(serializers.ModelSerializer):
 class ChatRoomView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @conditional_response(lambda request: chat_rooms_namespace(request.user.id))
+    def get(self, request):
+        unread = ReadCursor.objects.filter(room=OuterRef('pk'), user=request.user).values('unread_count')[:1]
+        rooms = ChatRoom.objects.filter(participants=request.user).annotate(
+            unread_count=Coalesce(Subquery(unread), 0),
+        ).select_related(
+            'service_request__user', 'last_message_sender',
+        ).prefetch_related(
+            'service_request__images',
+            Prefetch('participants', queryset=User.objects.exclude(id=request.user.id).order_by('id').only('id', 'username'),
+                     to_attr='other_participants'),
+        )
+        try:
+            page = KeysetPagination(ordering=('-last_activity_at', '-id')).paginate(rooms, request)
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=400)
+        serializer = ChatRoomSerializer(page.rows, many=True, context={'request': request})
+        return Response(page.response_data(serializer.data))
+
+class ChatRoomPresenceView(APIView):
+    permission_classes = [IsAuthenticated]
+
     def get(self, request):
-        rooms = ChatRoom.objects.filter(participants=request.user)
-        serializer = ChatRoomSerializer(rooms, many=True, context={'request': request})
-        return Response(serializer.data)
+        try:
+            room_ids = [int(room_id) for room_id in request.query_params.get('rooms', '').split(',') if room_id]
+            if not all(is_row_id(room_id) for room_id in room_ids):
+                raise ValueError(room_ids)
+        except ValueError:
+            return Response({'error': 'rooms must be a comma-separated list of room ids'}, status=400)
+        if len(room_ids) > settings.PAGINATION_MAX_PAGE_SIZE:
+            return Response({'error': f'At most {settings.PAGINATION_MAX_PAGE_SIZE} rooms per request'}, status=400)
+        # Rooms the user is not in are left out rather than reported as empty.
+        allowed = ChatRoom.objects.filter(id__in=room_ids, participants=request.user).values_list('id', flat=True)
+        online = presence_registry.online(sorted(allowed))
+        return Response({'rooms': {str(room_id): users for room_id, users in online.items()}})
 
 class CreateChatRoomView(APIView):
     permission_classes = [IsAuthenticated]
@@ -292,13 +597,42 @@ class ChatMessageView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, room_id):
-        room = get_object_or_404(ChatRoom, id=room_id)
-        if request.user not in room.participants.all():
+        is_member = ChatRoom.participants.through.objects.filter(chatroom_id=room_id, user_id=request.user.id).exists()
+        if not is_member:
+            get_object_or_404(ChatRoom, id=room_id)
             return Response({'error': 'Not authorized'}, status=403)
-            
-        messages = Message.objects.filter(room=room).order_by('-timestamp')
-        serializer = ChatMessageSerializer(messages, many=True)
-        return Response(serializer.data)
+
+        # Newest first. ?before=<cursor> scrolls back, ?after=<cursor> fetches what arrived since;
+        # has_more says whether another page lies further in the same direction.
+        if 'before' in request.query_params and 'after' in request.query_params:
+            return Response({'error': 'Use either before or after'}, status=400)
+        paginator = KeysetPagination(ordering=('-timestamp', '-id'))
+        page_size = paginator.get_page_size(request)
+        messages = chat_message_values(Message.objects.filter(room_id=room_id))
+        newer = 'after' in request.query_params
+        cursor = request.query_params.get('after' if newer else 'before')
+        try:
+            if cursor is not None:
+                key = paginator.parse_key(Message, decode_cursor(cursor))
+                messages = messages.filter(paginator.range_filter(key, after=not newer))
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=400)
+
+        ordering = ('timestamp', 'id') if newer else ('-timestamp', '-id')
+        rows = list(messages.order_by(*ordering)[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if newer:
+            rows.reverse()
+
+        before = after = None
+        if rows:
+            if has_more or newer:
+                before = encode_cursor(paginator.key_for(rows[-1]))
+            after = encode_cursor(paginator.key_for(rows[0]))
+        elif newer:
+            after = cursor
+        return Response({'results': render_chat_messages(rows), 'before': before, 'after': after, 'has_more': has_more})
 
 class GoogleLoginView(APIView):
     permission_classes = [permissions.AllowAny]
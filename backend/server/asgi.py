@@ -3,13 +3,14 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from django.urls import re_path
-from client.consumer import ChatConsumer
+from client.consumer import ChatConsumer, UserChatConsumer
 from client.token_auth_middleware import TokenAuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
 
 # WebSocket URL patterns
 websocket_urlpatterns = [
+    re_path(r'ws/chat/$', UserChatConsumer.as_asgi()),
     re_path(r'ws/chat/(?P<room_name>\w+)/$', ChatConsumer.as_asgi()),
 ]
 
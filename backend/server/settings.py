@@ -192,18 +192,75 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'upload-offset',
 ]
+CORS_EXPOSE_HEADERS = ['Upload-Offset', 'Upload-Length', 'Location']
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'client.token_cache.CachedTokenAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
 }
 
+# Keyset pagination for list endpoints (see client/pagination.py)
+PAGINATION_PAGE_SIZE = 20
+PAGINATION_MAX_PAGE_SIZE = 100
+
+# Response cache for the public directory endpoints (see client/cache.py).
+# Any Django cache backend works; with several workers use a shared one, e.g.
+# 'django.core.cache.backends.redis.RedisCache' or
+# 'django.core.cache.backends.filebased.FileBasedCache'.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+RESPONSE_CACHE_ALIAS = 'default'
+RESPONSE_CACHE_TIMEOUT = 300
+
+# Resolved auth tokens (client/token_cache.py) are kept in process for
+# TOKEN_CACHE_TTL seconds, which bounds how long another worker may accept a
+# deleted token, and in the TOKEN_CACHE_ALIAS cache (None: no shared tier)
+TOKEN_CACHE_TTL = 30
+TOKEN_CACHE_MAX_ENTRIES = 10000
+TOKEN_CACHE_ALIAS = None
+TOKEN_CACHE_SHARED_TTL = 600
+
+# Service request images get downsized copies without EXIF (client/renditions.py):
+# size name -> longest edge in pixels, encoded as IMAGE_RENDITION_FORMAT (WEBP,
+# or JPEG) by IMAGE_RENDITION_WORKERS background threads
+IMAGE_RENDITIONS = {'thumb': 200, 'medium': 800, 'full': 2048}
+IMAGE_RENDITION_FORMAT = 'WEBP'
+IMAGE_RENDITION_QUALITY = 80
+IMAGE_RENDITION_WORKERS = 2
+
+# Service request images are stored once per content (client/storage.py);
+# blobs nothing has referenced for BLOB_GC_GRACE seconds are deleted
+BLOB_GC_GRACE = 15 * 60
+
+# Creating a service request (client/ingest.py): images accepted per request
+# and threads writing their files
+INGEST_MAX_IMAGES = 10
+INGEST_WRITE_WORKERS = 4
+
+# Resumable image uploads (client/uploads.py): largest file and PATCH chunk in
+# bytes, and seconds after the last chunk before an unfinished upload is dropped
+UPLOAD_MAX_LENGTH = 25 * 1024 * 1024
+UPLOAD_CHUNK_MAX_SIZE = 4 * 1024 * 1024
+UPLOAD_EXPIRY = 24 * 60 * 60
+
+# Delta sync (see client/sync.py): rows per stream per response, and how far
+# a caught-up client's position is pulled back to cover in-flight commits
+SYNC_PAGE_SIZE = 500
+SYNC_OVERLAP_SECONDS = 5
+
+# Seconds before the in-process matching index is rebuilt in the background
+# to pick up writes made by other workers (see client/matching.py)
+MATCHING_INDEX_TTL = 300
 
 LOGIN_REDIRECT_URL = '/'  # Redirect to home after login
 LOGOUT_REDIRECT_URL = '/'  # Optional: redirect to home after logout
@@ -219,9 +276,53 @@ REST_AUTH = {
 ACCOUNT_LOGIN_METHODS = {'username', 'email'}
 ACCOUNT_EMAIL_VERIFICATION = 'none'  # Set to 'mandatory' for production
 
+# Chat messages are written in batches (see client/chat_buffer.py): a batch is
+# flushed when this many are waiting or after this many seconds
+CHAT_WRITE_BUFFER_MAX_BATCH = 100
+CHAT_WRITE_BUFFER_INTERVAL = 0.05
+
+# Chat presence (client/presence.py): a user counts as offline once no frame
+# has arrived for PRESENCE_TIMEOUT seconds (idle clients send a heartbeat
+# frame well within it); typing notifications
+# are broadcast at most once per CHAT_TYPING_INTERVAL seconds per room
+PRESENCE_TIMEOUT = 60
+CHAT_TYPING_INTERVAL = 1.0
+
+# History replay on (re)connect: at most CHAT_REPLAY_LIMIT messages, sent in
+# frames of CHAT_REPLAY_BATCH
+CHAT_REPLAY_LIMIT = 200
+CHAT_REPLAY_BATCH = 50
+
+# Sockets on the chat.batch subprotocols get the frames produced within
+# CHAT_BATCH_TICK seconds in one frame, flushed early at CHAT_BATCH_MAX_FRAMES
+CHAT_BATCH_TICK = 0.02
+CHAT_BATCH_MAX_FRAMES = 100
+
+# Inbound chat frames are limited by token buckets of RATE frames per second
+# and BURST capacity, per socket and per user. Sockets are closed after
+# CHAT_RATE_LIMIT_STRIKES rejected frames in a row (code 4029), or when
+# CHAT_SEND_QUEUE_LIMIT outgoing frames, or CHAT_SEND_BUFFER_LIMIT bytes in
+# daphne's transport buffer, are waiting on a slow client (4008)
+CHAT_CONNECTION_RATE = 5
+CHAT_CONNECTION_BURST = 20
+CHAT_USER_RATE = 10
+CHAT_USER_BURST = 40
+CHAT_RATE_LIMIT_STRIKES = 10
+CHAT_SEND_QUEUE_LIMIT = 500
+CHAT_SEND_BUFFER_LIMIT = 1024 * 1024
+
+# Shared by every worker process on this host (see client/channel_layers.py).
+# capacity bounds each channel's queue; group memberships lapse after
+# group_expiry seconds.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'client.channel_layers.SQLiteChannelLayer',
+        'CONFIG': {
+            'path': BASE_DIR / 'channels.sqlite3',
+            'capacity': 100,
+            'expiry': 60,
+            'group_expiry': 86400,
+        },
     },
 }
 
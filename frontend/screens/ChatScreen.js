@@ -4,10 +4,17 @@ import AsyncStorage from '@react-native-async-storage/async-storage';
 import axios from 'axios';
 import { format } from 'date-fns';
 
+// Idle sockets still count as online as long as a frame arrives within the
+// server's PRESENCE_TIMEOUT (60 s).
+const HEARTBEAT_INTERVAL_MS = 20000;
+
 export default function ChatScreen({ route, navigation }) {
   const [messages, setMessages] = useState([]);
   const [input, setInput] = useState('');
   const ws = useRef(null);
+  const heartbeat = useRef(null);
+  // Newest message id we have; reconnects ask the server for everything after it.
+  const lastSeenId = useRef(null);
   const [username, setUsername] = useState('');
   const [roomId, setRoomId] = useState(route?.params?.roomId || null);
   const [roomTitle, setRoomTitle] = useState(route?.params?.roomTitle || 'Chat');
@@ -76,24 +83,6 @@ export default function ChatScreen({ route, navigation }) {
     fetchUser();
   }, [roomId]);
 
-  useEffect(() => {
-    if (!roomId) return;
-    
-    const fetchMessages = async () => {
-      try {
-        const token = await AsyncStorage.getItem('authToken');
-        const res = await axios.get(
-          `http://127.0.0.1:8000/api/chat-rooms/${roomId}/messages/`, 
-          { headers: { Authorization: `Token ${token}` }}
-        );
-        setMessages(res.data.reverse()); // Reverse to show newest messages at bottom
-      } catch (error) {
-        console.error('Error fetching messages:', error);
-      }
-    };
-    fetchMessages();
-  }, [roomId]);
-
   useEffect(() => {
     if (!roomId) return;
     
@@ -101,22 +90,41 @@ export default function ChatScreen({ route, navigation }) {
       const token = await AsyncStorage.getItem('authToken');
       if (token) {
         try {
+          // First connect loads recent history over the socket itself.
+          const history = lastSeenId.current ? `last_seen_id=${lastSeenId.current}` : 'history=50';
           ws.current = new WebSocket(
-            `ws://127.0.0.1:8000/ws/chat/${roomId}/?token=${token}`
+            `ws://127.0.0.1:8000/ws/chat/${roomId}/?token=${token}&${history}`
           );
 
           ws.current.onopen = () => {
             console.log('WebSocket Connected');
+            clearInterval(heartbeat.current);
+            heartbeat.current = setInterval(() => {
+              if (ws.current && ws.current.readyState === WebSocket.OPEN) {
+                ws.current.send(JSON.stringify({ type: 'heartbeat' }));
+              }
+            }, HEARTBEAT_INTERVAL_MS);
           };
 
           ws.current.onmessage = (e) => {
             const data = JSON.parse(e.data);
+            if (data.type === 'history') {
+              if (data.messages.length) {
+                lastSeenId.current = data.messages[data.messages.length - 1].id;
+                setMessages((prev) => [...prev, ...data.messages]);
+              }
+              return;
+            }
+            // Presence and typing frames carry a type; chat messages don't.
+            if (data.type && data.type !== 'message') return;
+            lastSeenId.current = data.id;
             setMessages((prev) => [
               ...prev,
               {
+                id: data.id,
                 content: data.message,
                 sender: { username: data.username },
-                timestamp: new Date().toISOString(),
+                timestamp: data.timestamp || new Date().toISOString(),
               },
             ]);
           };
@@ -127,6 +135,7 @@ export default function ChatScreen({ route, navigation }) {
 
           ws.current.onclose = () => {
             console.log('WebSocket closed');
+            clearInterval(heartbeat.current);
             // Try to reconnect after 3 seconds
             setTimeout(connectWebSocket, 3000);
           };
@@ -138,6 +147,7 @@ export default function ChatScreen({ route, navigation }) {
 
     connectWebSocket();
     return () => {
+      clearInterval(heartbeat.current);
       if (ws.current) {
         ws.current.close();
       }
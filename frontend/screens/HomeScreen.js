@@ -36,7 +36,7 @@ export default function HomeScreen() {
           axios.get('http://127.0.0.1:8000/api/service-requests/'),
         ]);
         setBusinessProfiles(bizRes.data);
-        setServiceRequests(reqRes.data);
+        setServiceRequests(reqRes.data.results);
         if (userRes && userRes.data && userRes.data.username) {
           setCurrentUser(userRes.data);
         } else {
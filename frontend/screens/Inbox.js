@@ -27,7 +27,7 @@ export default function Inbox({ navigation }) {
                 headers: { Authorization: `Token ${token}` }
             });
 
-            setChatRooms(response.data);
+            setChatRooms(response.data.results);
             setLoading(false);
         } catch (error) {
             console.error('Error fetching chat rooms:', error);